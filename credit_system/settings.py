@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -37,6 +38,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'loans.db_router.PrimaryPinningMiddleware',
 ]
 
 ROOT_URLCONF = 'credit_system.urls'
@@ -71,6 +73,51 @@ DATABASES = {
     }
 }
 
+# Read replicas: comma-separated hosts, each exposed as a 'replica_N' alias.
+# Pointing a replica at the primary host gives an aliased second connection
+# for local testing.
+# Replica connections are opened and health-checked on the request path, so
+# an unreachable or stuck replica must fail fast and fall back to the primary
+REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', '2'))
+REPLICA_STATEMENT_TIMEOUT_MS = int(os.getenv('REPLICA_STATEMENT_TIMEOUT_MS', '5000'))
+DATABASE_REPLICAS = []
+for index, replica_host in enumerate(h.strip() for h in os.getenv('POSTGRES_REPLICA_HOSTS', '').split(',') if h.strip()):
+    alias = f'replica_{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': replica_host,
+        'OPTIONS': {
+            **DATABASES['default'].get('OPTIONS', {}),
+            'connect_timeout': REPLICA_CONNECT_TIMEOUT,
+            'options': f'-c statement_timeout={REPLICA_STATEMENT_TIMEOUT_MS}',
+        },
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+# Hash shards for customers and their loans (loans.sharding): comma-separated
+# hosts, each exposed as a 'shard_N' alias next to 'default', which is shard 0
+# and keeps the loan_id index. POSTGRES_SHARD_NAMES optionally gives each
+# shard its own database name, e.g. several shards on one local server.
+DATABASE_SHARDS = ['default']
+_shard_names = [n.strip() for n in os.getenv('POSTGRES_SHARD_NAMES', '').split(',') if n.strip()]
+for index, shard_host in enumerate((h.strip() for h in os.getenv('POSTGRES_SHARD_HOSTS', '').split(',') if h.strip()), 1):
+    alias = f'shard_{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': shard_host,
+        'NAME': _shard_names[index - 1] if index <= len(_shard_names) else DATABASES['default']['NAME'],
+    }
+    DATABASE_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['loans.sharding.ShardRouter', 'loans.db_router.PrimaryReplicaRouter']
+
+# Replicas lagging more than this are skipped until they catch up
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '2'))
+# How long a client stays pinned to the primary after a write
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '10'))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -110,6 +157,69 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Redis used by request-path features (rate limiting, caching)
+REDIS_URL = os.getenv('REDIS_URL') or (
+    f"redis://{os.getenv('REDIS_HOST')}:{os.getenv('REDIS_PORT', '6379')}/2" if os.getenv('REDIS_HOST') else None
+)
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '0.05'))
+
+# Admission control for check-eligibility and create-loan
+ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', '1').lower() in ['true', '1', 'yes']
+# Per-client token bucket: sustained requests per second and burst size
+ADMISSION_RATE_PER_SECOND = float(os.getenv('ADMISSION_RATE_PER_SECOND', '50'))
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', '100'))
+# Addresses of proxies/gateways whose X-Client-ID header identifies the
+# client. Buckets of everyone else are keyed on their remote address.
+ADMISSION_TRUSTED_PROXIES = {p.strip() for p in os.getenv('ADMISSION_TRUSTED_PROXIES', '').split(',') if p.strip()}
+# Request threads per gunicorn worker process (see gunicorn.conf.py)
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '1'))
+# Concurrent admitted requests per worker process, or 0 for no limit. A worker
+# never runs more requests than it has threads, so this only sheds load with
+# threaded workers and a limit below their thread count, e.g.
+# GUNICORN_THREADS - 1 to keep a thread free for the other endpoints.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '0'))
+# Reject requests with less than this much time left before their deadline
+ADMISSION_MIN_BUDGET_MS = int(os.getenv('ADMISSION_MIN_BUDGET_MS', '20'))
+
+# Customer profile cache: per-process LRU in front of Redis
+CUSTOMER_CACHE_ENABLED = os.getenv('CUSTOMER_CACHE_ENABLED', '1').lower() in ['true', '1', 'yes']
+# Entries per worker process (a profile is well under 1KB) and their maximum age.
+# The age bounds staleness if an invalidation message is lost.
+CUSTOMER_CACHE_LOCAL_SIZE = int(os.getenv('CUSTOMER_CACHE_LOCAL_SIZE', '10000'))
+CUSTOMER_CACHE_LOCAL_TTL = float(os.getenv('CUSTOMER_CACHE_LOCAL_TTL', '30'))
+# Expiry of the shared Redis entries, which bounds the tier's memory to the active customers
+CUSTOMER_CACHE_REDIS_TTL = int(os.getenv('CUSTOMER_CACHE_REDIS_TTL', '300'))
+
+# Transactional outbox for create-loan side effects
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+# Events whose handlers fail this many times are left for manual inspection
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+# Seconds between periodic drains that catch events no worker was queued for
+OUTBOX_DRAIN_INTERVAL = float(os.getenv('OUTBOX_DRAIN_INTERVAL', '30'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+
+# Bulk repayment posting: entries applied per statement/transaction, and the
+# largest request accepted (larger requests than one batch go to Celery)
+REPAYMENT_BATCH_SIZE = int(os.getenv('REPAYMENT_BATCH_SIZE', '5000'))
+REPAYMENT_MAX_ENTRIES = int(os.getenv('REPAYMENT_MAX_ENTRIES', '200000'))
+# How long applied batches are remembered, so retries with the same
+# idempotency key within this time are not applied twice
+REPAYMENT_KEY_RETENTION_DAYS = int(os.getenv('REPAYMENT_KEY_RETENTION_DAYS', '7'))
+# Group commit for /register: registrations arriving within the window in
+# one worker process are inserted together (needs GUNICORN_THREADS > 1)
+REGISTER_GROUP_COMMIT = os.getenv('REGISTER_GROUP_COMMIT', '0').lower() in ['true', '1', 'yes']
+REGISTER_BATCH_WINDOW_MS = float(os.getenv('REGISTER_BATCH_WINDOW_MS', '5'))
+# A batch is written early once this many registrations are waiting
+REGISTER_BATCH_MAX_SIZE = int(os.getenv('REGISTER_BATCH_MAX_SIZE', '200'))
+# Directory holding customer_data.xlsx and loan_data.xlsx
+INGEST_DATA_DIR = os.getenv('INGEST_DATA_DIR', '/app/data')
+# Rows ingest_excel_data writes at a time; progress is reported after each chunk
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '5000'))
+# Customers per /view-loans/batch request
+LOAN_BATCH_MAX_CUSTOMERS = int(os.getenv('LOAN_BATCH_MAX_CUSTOMERS', '10000'))
+# Request bodies up to 16MB, enough for REPAYMENT_MAX_ENTRIES repayments as JSON
+DATA_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('DATA_UPLOAD_MAX_MEMORY_SIZE', str(16 * 1024 * 1024)))
+
 # Celery Configuration
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
@@ -119,3 +229,26 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_CACHE_BACKEND = 'django-cache'
 CELERY_RESULT_BACKEND_DB_ENGINE = 'django.db.backends.postgresql'
+# Task results are deleted after this many seconds (by beat's nightly
+# celery.backend_cleanup for database backends); ingestion history is kept in
+# the ingestion_job table
+CELERY_RESULT_EXPIRES = int(os.getenv('CELERY_RESULT_EXPIRES', str(3 * 24 * 3600)))
+
+CELERY_BEAT_SCHEDULE = {
+    'create-loan-partitions': {
+        'task': 'loans.tasks.create_loan_partitions',
+        'schedule': crontab(minute=0, hour=3),
+    },
+    'drain-outbox': {
+        'task': 'loans.tasks.drain_outbox',
+        'schedule': OUTBOX_DRAIN_INTERVAL,
+    },
+    'purge-outbox': {
+        'task': 'loans.tasks.purge_outbox',
+        'schedule': crontab(minute=30, hour=3),
+    },
+    'purge-repayment-batches': {
+        'task': 'loans.tasks.purge_repayment_batches',
+        'schedule': crontab(minute=45, hour=3),
+    },
+}
@@ -0,0 +1,29 @@
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# More than one thread switches to gthread workers, which lets concurrent
+# registrations share a group commit (REGISTER_GROUP_COMMIT)
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+
+# Load Django once in the master so workers fork with the app already
+# imported and configured instead of each paying the start-up cost.
+preload_app = True
+
+
+def when_ready(server):
+    # Import URLconf, views, serializers and DRF in the master as well
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+
+
+def pre_fork(server, worker):
+    # Connections opened while preloading must not be shared with workers
+    from django.db import connections
+    connections.close_all()
+
+    # Move preloaded objects out of the GC's generations so collections in
+    # the workers don't touch (and copy) the master's shared pages.
+    gc.freeze()
@@ -1,18 +1,116 @@
 from django.contrib import admin
-from .models import Customer, Loan
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from .models import Customer, IngestionError, IngestionJob, Loan, OutboxEvent
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that avoids exact COUNT(*) over large tables: unfiltered
+    changelists use the planner's pg_class.reltuples estimate and filtered
+    ones stop counting at MAX_COUNT.
+    """
+    # Below this many estimated rows an exact count is cheap enough
+    ESTIMATE_THRESHOLD = 100000
+    MAX_COUNT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self._estimated_rows(queryset)
+            if estimate is not None and estimate > self.ESTIMATE_THRESHOLD:
+                return estimate
+            return super().count
+        return queryset.order_by()[:self.MAX_COUNT].count()
+
+    @staticmethod
+    def _estimated_rows(queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            # Partitioned tables keep their estimates on the partitions
+            cursor.execute(
+                """
+                SELECT SUM(GREATEST(c.reltuples, 0))
+                FROM pg_class c
+                WHERE c.oid = %s::regclass
+                   OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)
+                """,
+                [queryset.model._meta.db_table] * 2,
+            )
+            estimate = cursor.fetchone()[0]
+        return int(estimate) if estimate else None
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList exposing a "next page" link that filters on the keyset field
+    (`?loan_id__gt=...`) instead of using a deep OFFSET.
+    """
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.keyset_next_url = None
+        key = self.model_admin.keyset_field
+        ordered_by_key = tuple(self.queryset.query.order_by)[:1] == (key,)
+        if ordered_by_key and len(self.result_list) == self.list_per_page:
+            last = getattr(self.result_list[len(self.result_list) - 1], key)
+            self.keyset_next_url = self.get_query_string({f'{key}__gt': last}, [PAGE_VAR])
+
+
+class ScalableAdminMixin:
+    """Changelist settings for multi-million-row tables"""
+    keyset_field = None
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
 
 
 @admin.register(Customer)
-class CustomerAdmin(admin.ModelAdmin):
+class CustomerAdmin(ScalableAdminMixin, admin.ModelAdmin):
     list_display = ['customer_id', 'first_name', 'last_name', 'age', 'monthly_salary', 'approved_limit', 'current_debt']
-    list_filter = ['age', 'created_at']
-    search_fields = ['first_name', 'last_name', 'phone_number', 'customer_id']
+    list_filter = ['created_at']
+    # Name and phone searches are served by trigram indexes (migration 0004)
+    search_fields = ['first_name', 'last_name', 'phone_number', '=customer_id']
     ordering = ['customer_id']
+    keyset_field = 'customer_id'
 
 
 @admin.register(Loan)
-class LoanAdmin(admin.ModelAdmin):
+class LoanAdmin(ScalableAdminMixin, admin.ModelAdmin):
     list_display = ['loan_id', 'customer', 'loan_amount', 'tenure', 'interest_rate', 'monthly_repayment', 'start_date', 'end_date']
-    list_filter = ['interest_rate', 'tenure', 'start_date', 'created_at']
-    search_fields = ['loan_id', 'customer__first_name', 'customer__last_name']
+    list_select_related = ['customer']
+    list_filter = ['start_date', 'created_at']
+    search_fields = ['=loan_id', 'customer__first_name', 'customer__last_name', 'customer__phone_number']
+    raw_id_fields = ['customer']
     ordering = ['loan_id']
+    keyset_field = 'loan_id'
+
+
+@admin.register(IngestionError)
+class IngestionErrorAdmin(admin.ModelAdmin):
+    list_display = ['task_id', 'source', 'row_number', 'reason', 'created_at']
+    list_filter = ['source', 'created_at']
+    search_fields = ['=task_id']
+    ordering = ['task_id', 'source', 'row_number']
+
+
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ['task_id', 'status', 'stage', 'created_at', 'started_at', 'finished_at', 'updated_at']
+    list_filter = ['status']
+    search_fields = ['=task_id']
+    ordering = ['-created_at']
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'event_type', 'created_at', 'processed_at', 'attempts', 'last_error']
+    list_filter = ['event_type', 'processed_at']
+    ordering = ['-id']
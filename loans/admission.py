@@ -0,0 +1,187 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from redis.exceptions import RedisError
+from rest_framework import status
+from rest_framework.response import Response
+
+from .redis_client import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_HEADER = 'X-Request-Timeout-Ms'
+CLIENT_HEADER = 'X-Client-ID'
+
+# Refill, take one token and return {allowed, retry_after_ms}. Uses the Redis
+# clock so every worker agrees on elapsed time.
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+local allowed = 0
+local retry_ms = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_ms = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {allowed, retry_ms}
+"""
+
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The caller's deadline passed before the work finished"""
+
+
+class _InFlightLimiter:
+    """
+    Bounded count of admitted requests in this worker process. Sync workers
+    serve one request at a time, so it only rejects anything under threaded
+    workers with a limit below their thread count.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def try_acquire(self, limit):
+        with self._lock:
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.count -= 1
+
+
+_in_flight = _InFlightLimiter()
+_token_bucket = None
+
+
+def parse_deadline(request):
+    """
+    Deadline on this process's monotonic clock from the request's relative
+    timeout in milliseconds, or None. The timeout runs from arrival, so the
+    client's clock doesn't matter.
+    """
+    value = request.headers.get(TIMEOUT_HEADER)
+    if not value:
+        return None
+    try:
+        timeout_ms = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(timeout_ms):
+        return None
+    return time.monotonic() + timeout_ms / 1000
+
+
+def remaining_ms():
+    """Milliseconds left before the current request's deadline, or None"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return (deadline - time.monotonic()) * 1000
+
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current request's deadline has passed"""
+    remaining = remaining_ms()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
+
+
+def client_identity(request):
+    """
+    Rate-limit key of a request: the remote address, or the X-Client-ID set
+    by a trusted proxy. Clients can't pick their own bucket.
+    """
+    remote_addr = request.META.get('REMOTE_ADDR', 'unknown')
+    if remote_addr in settings.ADMISSION_TRUSTED_PROXIES:
+        return request.headers.get(CLIENT_HEADER) or remote_addr
+    return remote_addr
+
+
+def take_token(scope, client_id):
+    """
+    Take a token from the client's bucket. Returns (allowed, retry_after_ms).
+    Fails open when Redis is not configured or unavailable.
+    """
+    global _token_bucket
+    client = get_redis()
+    if client is None:
+        return True, 0
+    if _token_bucket is None:
+        _token_bucket = client.register_script(TOKEN_BUCKET_SCRIPT)
+    try:
+        allowed, retry_ms = _token_bucket(
+            keys=[f'admission:{scope}:{client_id}'],
+            args=[settings.ADMISSION_RATE_PER_SECOND, settings.ADMISSION_BURST],
+        )
+    except RedisError:
+        logger.warning('Rate limiter unavailable, admitting request', exc_info=True)
+        return True, 0
+    return bool(allowed), int(retry_ms)
+
+
+def _reject(status_code, message, retry_after_seconds):
+    response = Response({'error': message}, status=status_code)
+    response['Retry-After'] = str(max(0, math.ceil(retry_after_seconds)))
+    return response
+
+
+def admission_control(scope):
+    """
+    Decorator shedding load before a view does any work: requests whose
+    deadline has passed, clients over their rate limit and requests beyond
+    the per-worker concurrency limit, if one is set, are rejected with
+    Retry-After.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not settings.ADMISSION_CONTROL_ENABLED:
+                return view(request, *args, **kwargs)
+
+            deadline = parse_deadline(request)
+            if deadline is not None and (deadline - time.monotonic()) * 1000 < settings.ADMISSION_MIN_BUDGET_MS:
+                return _reject(status.HTTP_503_SERVICE_UNAVAILABLE, 'Request deadline exceeded', 0)
+
+            allowed, retry_ms = take_token(scope, client_identity(request))
+            if not allowed:
+                return _reject(status.HTTP_429_TOO_MANY_REQUESTS, 'Rate limit exceeded', retry_ms / 1000)
+
+            limited = settings.ADMISSION_MAX_IN_FLIGHT > 0
+            if limited and not _in_flight.try_acquire(settings.ADMISSION_MAX_IN_FLIGHT):
+                return _reject(status.HTTP_503_SERVICE_UNAVAILABLE, 'Server overloaded', 1)
+
+            token = _deadline.set(deadline)
+            try:
+                return view(request, *args, **kwargs)
+            except DeadlineExceeded:
+                return _reject(status.HTTP_503_SERVICE_UNAVAILABLE, 'Request deadline exceeded', 0)
+            finally:
+                _deadline.reset(token)
+                if limited:
+                    _in_flight.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,231 @@
+"""
+Backtests of a candidate ScoringPolicy against a baseline over the whole
+loan book, for `manage.py backtest_policy`.
+
+Every customer is evaluated for the same loan application. The customers of
+each shard are split into ranges of ids, and a pool of worker processes
+reads each range's score inputs with two index range queries, then scores
+and decides it under both policies with NumPy. Workers return per-segment
+totals, which are added up into the report.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+
+import django
+import numpy as np
+from django.db import connections
+from django.db.models import BigIntegerField, Count, F, Max, Min, Q, Sum
+from django.db.models.functions import Cast
+
+from .models import Customer, Loan
+from .money import PAISE_PER_RUPEE, BasisPoints, Paise
+
+
+SCORE_INPUTS = (
+    'monthly_salary', 'approved_limit', 'current_debt', 'total_emi',
+    'total_tenure', 'emis_paid_on_time', 'loan_count', 'current_year_loans',
+)
+# Band upper bounds (inclusive) of the segments besides credit_score, whose
+# bands follow the slab boundaries of the policies being compared
+SALARY_BANDS = tuple(rupees * PAISE_PER_RUPEE for rupees in (25000, 50000, 100000, 200000))
+LOAN_COUNT_BANDS = (0, 2, 5)
+METRICS = (
+    'customers', 'baseline_approved', 'candidate_approved', 'newly_approved', 'newly_rejected',
+    'baseline_rate_sum', 'candidate_rate_sum', 'approved_by_both', 'rate_change_sum',
+)
+
+
+@dataclass(frozen=True)
+class Application:
+    """The loan every customer is evaluated for"""
+    loan_amount: Paise
+    interest_rate: BasisPoints
+    tenure: int
+
+
+def _paise(expression):
+    return Cast(expression * PAISE_PER_RUPEE, BigIntegerField())
+
+
+def customer_ranges(using, chunk_size):
+    """(using, first_id, last_id) ranges of chunk_size customer ids covering a database"""
+    ids = Customer.objects.using(using).aggregate(first=Min('id'), last=Max('id'))
+    if ids['first'] is None:
+        return []
+    return [
+        (using, first_id, min(first_id + chunk_size - 1, ids['last']))
+        for first_id in range(ids['first'], ids['last'] + 1, chunk_size)
+    ]
+
+
+def score_inputs(using, first_id, last_id, year):
+    """{input: int64 array} for the customers in an id range, in id order, with money in paise"""
+    customers = np.array(list(
+        Customer.objects.using(using).filter(id__range=(first_id, last_id)).order_by('id')
+        .values_list('id', _paise(F('monthly_salary')), _paise(F('approved_limit')), _paise(F('current_debt')))
+    ), dtype=np.int64).reshape(-1, 4)
+    loans = np.array(list(
+        Loan.objects.using(using).filter(customer_id__gte=first_id, customer_id__lte=last_id)
+        .order_by('customer_id').values('customer_id')
+        .annotate(
+            total_emi=_paise(Sum('monthly_repayment')),
+            total_tenure=Sum('tenure'),
+            emis_paid_on_time=Sum('emis_paid_on_time'),
+            loan_count=Count('id'),
+            current_year_loans=Count('id', filter=Q(start_date__year=year)),
+        )
+        .values_list('customer_id', 'total_emi', 'total_tenure', 'emis_paid_on_time',
+                     'loan_count', 'current_year_loans')
+    ), dtype=np.int64).reshape(-1, 6)
+
+    ids = customers[:, 0]
+    chunk = dict(zip(SCORE_INPUTS[:3], customers[:, 1:].T))
+    rows = np.searchsorted(ids, loans[:, 0])
+    for column, name in enumerate(SCORE_INPUTS[3:], start=1):
+        values = np.zeros(len(ids), dtype=np.int64)
+        values[rows] = loans[:, column]
+        chunk[name] = values
+    return chunk
+
+
+def credit_scores(chunk):
+    """utils.credit_score_from_inputs over arrays of score inputs"""
+    debt, limit, tenure = chunk['current_debt'], chunk['approved_limit'], chunk['total_tenure']
+    on_time = np.zeros(len(debt), dtype=np.int64)
+    has_tenure = tenure > 0
+    # Same float operations as the scalar version, so truncation agrees
+    on_time[has_tenure] = np.floor(
+        chunk['emis_paid_on_time'][has_tenure] / tenure[has_tenure] * 35
+    ).astype(np.int64)
+    score = np.minimum(35, on_time)
+    score += np.minimum(20, chunk['loan_count'] * 2)
+    score += np.minimum(20, chunk['current_year_loans'] * 5)
+    score += np.select(
+        [limit <= 0, debt * 2 <= limit, debt * 4 <= limit * 3, debt <= limit],
+        [0, 25, 15, 5], default=0,
+    )
+    score[debt > limit] = 0
+    return np.clip(score, 0, 100)
+
+
+def segment_bands(baseline, candidate):
+    """{segment: (score input or None for the credit score, band upper bounds)}"""
+    return {
+        'credit_score': (None, tuple(sorted({slab.min_score for policy in (baseline, candidate)
+                                             for slab in policy.slabs}))),
+        'monthly_salary': ('monthly_salary', SALARY_BANDS),
+        'loan_count': ('loan_count', LOAN_COUNT_BANDS),
+    }
+
+
+def evaluate_chunk(chunk, baseline, candidate, application):
+    """{segment: int64 array of METRICS per band} for one chunk of customers"""
+    scores = credit_scores(chunk)
+    decisions = [
+        policy.decide(scores, application.interest_rate, chunk['total_emi'], chunk['monthly_salary'],
+                      policy.proposed_emi(application.loan_amount, application.tenure))
+        for policy in (baseline, candidate)
+    ]
+    (baseline_approved, baseline_rate), (candidate_approved, candidate_rate) = decisions
+    approved_by_both = baseline_approved & candidate_approved
+    weights = (
+        np.ones(len(scores), dtype=np.int64),
+        baseline_approved,
+        candidate_approved,
+        candidate_approved & ~baseline_approved,
+        baseline_approved & ~candidate_approved,
+        np.where(baseline_approved, baseline_rate, 0),
+        np.where(candidate_approved, candidate_rate, 0),
+        approved_by_both,
+        np.where(approved_by_both, candidate_rate - baseline_rate, 0),
+    )
+
+    totals = {}
+    for segment, (score_input, bands) in segment_bands(baseline, candidate).items():
+        values = scores if score_input is None else chunk[score_input]
+        band = np.searchsorted(bands, values, side='left')
+        totals[segment] = np.stack([
+            np.bincount(band, weights=weight.astype(np.int64), minlength=len(bands) + 1)
+            for weight in weights
+        ], axis=1).round().astype(np.int64)
+    return totals
+
+
+def evaluate_range(customer_range, baseline, candidate, application, year):
+    return evaluate_chunk(score_inputs(*customer_range, year), baseline, candidate, application)
+
+
+def run_backtest(baseline, candidate, application, ranges, year, workers=1):
+    """
+    Evaluate the customers in ranges (see customer_ranges) and return the
+    report (see backtest_report)
+    """
+    evaluate = partial(evaluate_range, baseline=baseline, candidate=candidate,
+                       application=application, year=year)
+    totals = {
+        segment: np.zeros((len(bands) + 1, len(METRICS)), dtype=np.int64)
+        for segment, (_, bands) in segment_bands(baseline, candidate).items()
+    }
+
+    def add(results):
+        for chunk_totals in results:
+            for segment, segment_totals in chunk_totals.items():
+                totals[segment] += segment_totals
+
+    if workers <= 1:
+        add(map(evaluate, ranges))
+    else:
+        # Workers open their own connections, which must not be copies of ours
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            add(pool.map(evaluate, ranges))
+    return backtest_report(totals, segment_bands(baseline, candidate))
+
+
+def _band_labels(segment, bands):
+    if segment == 'monthly_salary':
+        rupees = [band // PAISE_PER_RUPEE for band in bands]
+        return ([f'<={rupees[0]}']
+                + [f'{low}-{high}' for low, high in zip(rupees, rupees[1:])]
+                + [f'>{rupees[-1]}'])
+    labels = [str(bands[0]) if bands[0] == 0 else f'0-{bands[0]}']
+    labels += [str(high) if low + 1 == high else f'{low + 1}-{high}' for low, high in zip(bands, bands[1:])]
+    return labels + [f'{bands[-1] + 1}+']
+
+
+def _report_row(totals):
+    row = dict(zip(METRICS, (int(total) for total in totals)))
+    customers = row['customers']
+    for policy in ('baseline', 'candidate'):
+        approved = row[f'{policy}_approved']
+        row[f'{policy}_approval_rate'] = round(approved * 100 / customers, 2) if customers else None
+        # Mean corrected interest rate (%) of the approved customers
+        rate_sum = row.pop(f'{policy}_rate_sum')
+        row[f'{policy}_mean_rate'] = round(rate_sum / approved / 100, 2) if approved else None
+    row['approval_rate_change'] = (
+        round((row['candidate_approved'] - row['baseline_approved']) * 100 / customers, 2) if customers else None
+    )
+    # In percentage points, over the customers both policies approve
+    rate_change_sum = row.pop('rate_change_sum')
+    row['mean_rate_change'] = (
+        round(rate_change_sum / row['approved_by_both'] / 100, 2) if row['approved_by_both'] else None
+    )
+    return row
+
+
+def backtest_report(totals, bands):
+    """
+    {'overall': row, 'segments': {segment: [row, ...]}}, where each row has
+    the METRICS counts, approval rates (%) and mean corrected rates (%) under
+    both policies, and their changes
+    """
+    segments = {
+        segment: [
+            {'band': label, **_report_row(band_totals)}
+            for label, band_totals in zip(_band_labels(segment, bands[segment][1]), segment_totals)
+        ]
+        for segment, segment_totals in totals.items()
+    }
+    overall = next(iter(totals.values())).sum(axis=0)
+    return {'overall': _report_row(overall), 'segments': segments}
@@ -0,0 +1,156 @@
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+
+PIN_COOKIE = 'primary_pin'
+
+# alias -> (checked_at, healthy)
+_replica_health = {}
+
+_state = contextvars.ContextVar('db_routing_state', default=None)
+
+
+class _RoutingState:
+    __slots__ = ('replica_reads', 'pinned', 'wrote', 'replica')
+
+    def __init__(self, pinned=False):
+        self.replica_reads = False
+        self.pinned = pinned
+        self.wrote = False
+        # The database serving this request's replica reads, once chosen
+        self.replica = None
+
+
+def replica_lag(alias):
+    """Return replication lag of a replica in seconds (0 for a primary)"""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END
+            """
+        )
+        return float(cursor.fetchone()[0])
+
+
+def replica_is_healthy(alias):
+    """
+    Check that a replica is reachable and within REPLICA_MAX_LAG_SECONDS.
+    Results are cached for REPLICA_LAG_CHECK_INTERVAL seconds per process.
+    """
+    now = time.monotonic()
+    cached = _replica_health.get(alias)
+    if cached and now - cached[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return cached[1]
+
+    try:
+        healthy = replica_lag(alias) <= settings.REPLICA_MAX_LAG_SECONDS
+    except DatabaseError:
+        healthy = False
+    _replica_health[alias] = (now, healthy)
+    return healthy
+
+
+def choose_replica():
+    """Pick a healthy replica alias, or None to fall back to the primary"""
+    candidates = [alias for alias in settings.DATABASE_REPLICAS if replica_is_healthy(alias)]
+    return random.choice(candidates) if candidates else None
+
+
+@contextmanager
+def replica_reads():
+    """Allow reads inside the block to be served by a replica"""
+    state = _state.get()
+    token = None
+    if state is None:
+        state = _RoutingState()
+        token = _state.set(state)
+    previous = state.replica_reads
+    state.replica_reads = True
+    try:
+        yield
+    finally:
+        state.replica_reads = previous
+        if token is not None:
+            _state.reset(token)
+
+
+def use_replica(view):
+    """Decorator for read-only views whose queries may go to a replica"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    """
+    Send reads from read-only views to replicas and everything else to the
+    primary. A request reads from one replica throughout, so its queries
+    agree with each other. Any write pins the rest of the request to the
+    primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replica_reads or state.pinned:
+            return 'default'
+        if state.replica is None:
+            state.replica = choose_replica() or 'default'
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = True
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class PrimaryPinningMiddleware:
+    """
+    Keep read-your-writes consistency: once a client writes, its requests are
+    served by the primary for REPLICA_PIN_SECONDS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = _RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        if state.wrote:
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
@@ -0,0 +1,85 @@
+"""
+Progress tracking for ingest_excel_data.
+
+The task keeps an IngestionJob row up to date and reports the same progress
+as a custom PROGRESS Celery state after every chunk of rows. /ingest-jobs
+reads the rows, which outlive task results (expired after
+CELERY_RESULT_EXPIRES).
+"""
+from datetime import datetime
+
+from django.utils import timezone
+
+from .models import IngestionJob
+
+
+PROGRESS = 'PROGRESS'
+COUNTERS = ('rows_read', 'rows_validated', 'rows_rejected', 'rows_skipped', 'rows_written')
+
+
+class JobProgress:
+    """Per-stage row counts of a running ingestion job"""
+
+    def __init__(self, task, task_id):
+        self.task = task
+        self.job, _ = IngestionJob.objects.get_or_create(task_id=task_id)
+        self.job.status = IngestionJob.RUNNING
+        self.job.started_at = timezone.now()
+        self.job.progress = {}
+        self.job.save()
+
+    def start_stage(self, stage):
+        self.job.stage = stage
+        self.job.progress[stage] = {
+            **dict.fromkeys(COUNTERS, 0),
+            'started_at': timezone.now().isoformat(),
+            'finished_at': None,
+        }
+        self._flush()
+
+    def add(self, **counts):
+        """Add to the current stage's counters and publish the new totals"""
+        stage = self.job.progress[self.job.stage]
+        for counter, count in counts.items():
+            stage[counter] += int(count)
+        self._flush()
+
+    def finish_stage(self):
+        self.job.progress[self.job.stage]['finished_at'] = timezone.now().isoformat()
+        self._flush()
+
+    def finish(self, results):
+        self.job.status = IngestionJob.FAILED if 'error' in results else IngestionJob.SUCCEEDED
+        self.job.stage = ''
+        self.job.results = results
+        self.job.finished_at = timezone.now()
+        self.job.save()
+
+    def _flush(self):
+        self.job.save(update_fields=['stage', 'progress', 'updated_at'])
+        self.task.update_state(
+            task_id=self.job.task_id, state=PROGRESS,
+            meta={'stage': self.job.stage, 'progress': self.job.progress},
+        )
+
+
+def stage_stats(counts, now=None):
+    """
+    A stage's counters with its elapsed time, throughput since the stage
+    started and, while it runs, the estimated seconds left
+    """
+    now = now or timezone.now()
+    started = datetime.fromisoformat(counts['started_at'])
+    finished = counts['finished_at'] and datetime.fromisoformat(counts['finished_at'])
+    elapsed = ((finished or now) - started).total_seconds()
+    done = counts['rows_written'] + counts['rows_skipped']
+    rate = done / elapsed if elapsed > 0 else None
+    eta = None
+    if not finished and rate:
+        eta = round(max(counts['rows_validated'] - done, 0) / rate, 1)
+    return {
+        **counts,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(rate, 1) if rate is not None else None,
+        'eta_seconds': eta,
+    }
@@ -0,0 +1,148 @@
+"""
+Column-wise validation of the customer and loan spreadsheets.
+
+Each validator returns the valid rows with normalized column names and a
+DataFrame of rejected rows (spreadsheet row number and reason), so the task
+never builds per-row error messages in Python. Money columns come back in
+whole paise and interest rates in basis points.
+"""
+import pandas as pd
+
+from .models import IngestionError
+from .money import to_paise
+
+
+# Spreadsheet row of the first data row (row 1 is the header)
+FIRST_DATA_ROW = 2
+
+ERROR_BATCH_SIZE = 1000
+
+
+def _column(df, name):
+    if name in df.columns:
+        return df[name]
+    return pd.Series(pd.NA, index=df.index, dtype=object)
+
+
+def _numbers(df, name):
+    return pd.to_numeric(_column(df, name), errors='coerce')
+
+
+def _hundredths(df, name):
+    """
+    Amounts as whole paise, or rates as whole basis points, rounded half up
+    from the decimal value like loans.money.to_paise
+    """
+    values = _numbers(df, name)
+    scaled = values * 100
+    # Float rounding agrees with to_paise except near half a paisa, where the
+    # float product can land either side of .5 (1.005 * 100 == 100.49999...)
+    near_half = ((scaled.abs() % 1) - 0.5).abs() < 1e-6
+    return scaled.round().mask(near_half, values[near_half].map(lambda value: float(to_paise(value))))
+
+
+def _whole_numbers(df, name):
+    values = _numbers(df, name)
+    return values.where(values % 1 == 0)
+
+
+def _text(df, name):
+    values = _column(df, name)
+    return values.where(values.notna(), '').astype(str).str.strip()
+
+
+def _dates(df, name):
+    return pd.to_datetime(_column(df, name), errors='coerce', format='ISO8601')
+
+
+def _split(frame, checks):
+    """
+    Apply (mask, message) checks; rows matching any mask are rejected with
+    all of their messages joined.
+    """
+    reasons = pd.Series('', index=frame.index, dtype=object)
+    for mask, message in checks:
+        mask = mask.fillna(True).astype(bool)
+        reasons[mask] = reasons[mask] + message + '; '
+    rejected = reasons != ''
+
+    errors = pd.DataFrame({
+        'row_number': frame.index[rejected] + FIRST_DATA_ROW,
+        'reason': reasons[rejected].str.rstrip('; ').str.slice(0, 255),
+    })
+    return frame[~rejected], errors
+
+
+def validate_customers(df):
+    """Validate the customer sheet. Returns (valid rows, rejected rows)"""
+    frame = pd.DataFrame({
+        'customer_id': _whole_numbers(df, 'Customer ID'),
+        'first_name': _text(df, 'First Name'),
+        'last_name': _text(df, 'Last Name'),
+        'age': _whole_numbers(df, 'Age'),
+        'phone_number': _text(df, 'Phone Number'),
+        'monthly_salary': _hundredths(df, 'Monthly Salary'),
+        'approved_limit': _hundredths(df, 'Approved Limit'),
+    }, index=df.index)
+
+    checks = [
+        (~(frame['customer_id'] > 0), 'invalid Customer ID'),
+        (frame['customer_id'].duplicated(keep='first') & frame['customer_id'].notna(), 'duplicate Customer ID'),
+        ((frame['first_name'] == '') | (frame['first_name'].str.len() > 50), 'invalid First Name'),
+        ((frame['last_name'] == '') | (frame['last_name'].str.len() > 50), 'invalid Last Name'),
+        (~frame['age'].between(18, 100), 'invalid Age'),
+        ((frame['phone_number'] == '') | (frame['phone_number'].str.len() > 15), 'invalid Phone Number'),
+        (~frame['monthly_salary'].between(0, 10 ** 10, inclusive='left'), 'invalid Monthly Salary'),
+        (~frame['approved_limit'].between(0, 10 ** 12, inclusive='left'), 'invalid Approved Limit'),
+    ]
+    return _split(frame, checks)
+
+
+def loan_customer_ids(df):
+    """Distinct well-formed Customer IDs referenced by the loan sheet"""
+    return _whole_numbers(df, 'Customer ID').dropna().unique().astype(int).tolist()
+
+
+def validate_loans(df, known_customer_ids):
+    """
+    Validate the loan sheet. Loans whose Customer ID is not in
+    known_customer_ids are rejected as orphans.
+    Returns (valid rows, rejected rows)
+    """
+    frame = pd.DataFrame({
+        'customer_id': _whole_numbers(df, 'Customer ID'),
+        'loan_id': _whole_numbers(df, 'Loan ID'),
+        'loan_amount': _hundredths(df, 'Loan Amount'),
+        'tenure': _whole_numbers(df, 'Tenure'),
+        'interest_rate': _hundredths(df, 'Interest Rate'),
+        'monthly_repayment': _hundredths(df, 'Monthly payment'),
+        'emis_paid_on_time': _whole_numbers(df, 'EMIs paid on Time'),
+        'start_date': _dates(df, 'Date of Approval'),
+        'end_date': _dates(df, 'End Date'),
+    }, index=df.index)
+
+    checks = [
+        (~(frame['loan_id'] > 0), 'invalid Loan ID'),
+        (frame['loan_id'].duplicated(keep='first') & frame['loan_id'].notna(), 'duplicate Loan ID'),
+        (~frame['customer_id'].isin(known_customer_ids), 'Customer ID not found'),
+        (~frame['loan_amount'].between(0, 10 ** 12, inclusive='left'), 'invalid Loan Amount'),
+        (~(frame['tenure'] > 0), 'invalid Tenure'),
+        (~frame['interest_rate'].between(0, 10 ** 5, inclusive='left'), 'invalid Interest Rate'),
+        (~frame['monthly_repayment'].between(0, 10 ** 10, inclusive='left'), 'invalid Monthly payment'),
+        (~frame['emis_paid_on_time'].between(0, frame['tenure']), 'invalid EMIs paid on Time'),
+        (frame['start_date'].isna(), 'invalid Date of Approval'),
+        (frame['end_date'].isna(), 'invalid End Date'),
+        (frame['end_date'] < frame['start_date'], 'End Date before Date of Approval'),
+    ]
+    return _split(frame, checks)
+
+
+def record_errors(task_id, source, errors):
+    """Write rejected rows to the ingestion_error table"""
+    IngestionError.objects.bulk_create(
+        (
+            IngestionError(task_id=task_id, source=source, row_number=int(row_number), reason=reason)
+            for row_number, reason in zip(errors['row_number'], errors['reason'])
+        ),
+        batch_size=ERROR_BATCH_SIZE,
+    )
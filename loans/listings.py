@@ -0,0 +1,65 @@
+"""
+Loan lists for many customers at once, for /view-loans/batch.
+
+Each shard answers with one query for the requested customers that exist
+and one query for all of their loans, ordered by customer. The loan rows are
+read in chunks and grouped in a single pass, so a streamed batch never holds
+more than one customer's loans in memory.
+"""
+import heapq
+from itertools import groupby
+from operator import attrgetter
+
+from django.db import router
+from django.db.models import F
+
+from .models import Customer, Loan
+from .serializers import CustomerLoansSerializer
+from .sharding import shard_for_customer
+
+
+LOAN_LIST_FIELDS = ('loan_id', 'loan_amount', 'interest_rate', 'monthly_repayment',
+                    'tenure', 'emis_paid_on_time', 'emis_paid_late')
+CHUNK_SIZE = 2000
+
+
+def customer_loan_lists(customer_ids):
+    """
+    Yield {'customer_id', 'loans'} for each of the distinct, sorted
+    customer_ids, or {'customer_id', 'error'} for unknown customers. Loans
+    have the CustomerLoansSerializer shape.
+    """
+    by_shard = {}
+    for customer_id in customer_ids:
+        by_shard.setdefault(shard_for_customer(customer_id), []).append(customer_id)
+
+    known = set()
+    shard_loans = []
+    for shard, ids in by_shard.items():
+        # Pick the database now: a streamed response is iterated after the
+        # view (and its replica routing) has returned
+        db = shard or router.db_for_read(Loan)
+        known.update(Customer.objects.using(db).filter(customer_id__in=ids).values_list('customer_id', flat=True))
+        loans = (Loan.objects.using(db)
+                 .filter(customer__customer_id__in=ids)
+                 .annotate(customer_number=F('customer__customer_id'))
+                 .only(*LOAN_LIST_FIELDS)
+                 .order_by('customer__customer_id', 'loan_id'))
+        shard_loans.append(loans.iterator(chunk_size=CHUNK_SIZE))
+    return _group_loans(customer_ids, known, shard_loans)
+
+
+def _group_loans(customer_ids, known, shard_loans):
+    serializer = CustomerLoansSerializer()
+    customer_number = attrgetter('customer_number')
+    groups = groupby(heapq.merge(*shard_loans, key=customer_number), key=customer_number)
+    group = next(groups, None)
+    for customer_id in customer_ids:
+        if customer_id not in known:
+            yield {'customer_id': customer_id, 'error': 'Customer not found'}
+            continue
+        loans = []
+        if group is not None and group[0] == customer_id:
+            loans = [serializer.to_representation(loan) for loan in group[1]]
+            group = next(groups, None)
+        yield {'customer_id': customer_id, 'loans': loans}
@@ -0,0 +1,109 @@
+import json
+import os
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from loans import money
+from loans.backtest import Application, customer_ranges, run_backtest
+from loans.policy import CURRENT_POLICY, ScoringPolicy
+from loans.sharding import shard_aliases
+
+
+COLUMNS = (
+    ('band', 'band', 14),
+    ('customers', 'customers', 10),
+    ('baseline_approval_rate', 'base %', 8),
+    ('candidate_approval_rate', 'cand %', 8),
+    ('approval_rate_change', 'change', 8),
+    ('newly_approved', '+approved', 10),
+    ('newly_rejected', '-approved', 10),
+    ('baseline_mean_rate', 'base rate', 10),
+    ('candidate_mean_rate', 'cand rate', 10),
+    ('mean_rate_change', 'rate chg', 9),
+)
+
+
+class Command(BaseCommand):
+    help = ('Compare a candidate approval policy (JSON) with the current one over every customer, '
+            'reporting approval and interest rate changes by segment')
+
+    def add_arguments(self, parser):
+        parser.add_argument('policy', help='Candidate policy JSON file (see loans.policy.ScoringPolicy.from_dict)')
+        parser.add_argument('--baseline', help='Baseline policy JSON file (default: the current policy)')
+        parser.add_argument('--loan-amount', default='500000', help='Requested loan amount in rupees')
+        parser.add_argument('--interest-rate', default='12', help='Requested interest rate in percent')
+        parser.add_argument('--tenure', type=int, default=24, help='Requested tenure in months')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Worker processes (1 evaluates in this process)')
+        parser.add_argument('--chunk-size', type=int, default=20000, help='Customer ids per chunk')
+        parser.add_argument('--output', help='Also write the report as JSON to this file')
+
+    def handle(self, *args, **options):
+        try:
+            candidate = ScoringPolicy.load(options['policy'])
+            baseline = ScoringPolicy.load(options['baseline']) if options['baseline'] else CURRENT_POLICY
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        try:
+            application = Application(
+                loan_amount=money.to_paise(Decimal(options['loan_amount'])),
+                interest_rate=money.to_basis_points(Decimal(options['interest_rate'])),
+                tenure=options['tenure'],
+            )
+        except InvalidOperation:
+            raise CommandError('--loan-amount and --interest-rate must be numbers')
+        if application.loan_amount <= 0 or application.interest_rate < 0 or application.tenure <= 0:
+            raise CommandError('The loan amount and tenure must be positive and the interest rate non-negative')
+        if options['chunk_size'] <= 0:
+            raise CommandError('--chunk-size must be positive')
+
+        year = datetime.now().year
+        started = time.perf_counter()
+        ranges = list(chain.from_iterable(
+            customer_ranges(shard or DEFAULT_DB_ALIAS, options['chunk_size']) for shard in shard_aliases()
+        ))
+        report = run_backtest(baseline, candidate, application, ranges, year, workers=options['workers'])
+        elapsed = time.perf_counter() - started
+
+        customers = report['overall']['customers']
+        self.stdout.write(
+            f"Candidate '{candidate.name}' against '{baseline.name}' for a loan of "
+            f"{money.from_paise(application.loan_amount)} at {money.from_basis_points(application.interest_rate)}% "
+            f"over {application.tenure} months"
+        )
+        self.stdout.write('Rates are mean corrected interest rates (%) of approved customers; '
+                          'rate chg is over customers approved by both')
+        self._table('overall', [{'band': 'all', **report['overall']}])
+        for segment, rows in report['segments'].items():
+            self._table(segment, rows)
+        rate = customers / elapsed if elapsed > 0 else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Evaluated {customers} customers in {elapsed:.2f}s ({rate:,.0f}/s, {options["workers"]} workers)'
+        ))
+
+        if options['output']:
+            report.update({
+                'baseline': baseline.to_dict(),
+                'candidate': candidate.to_dict(),
+                'application': {
+                    'loan_amount': str(money.from_paise(application.loan_amount)),
+                    'interest_rate': str(money.from_basis_points(application.interest_rate)),
+                    'tenure': application.tenure,
+                },
+                'seconds': round(elapsed, 3),
+            })
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def _table(self, title, rows):
+        self.stdout.write(f'\n{title}')
+        self.stdout.write(''.join(heading.rjust(width) for _, heading, width in COLUMNS))
+        for row in rows:
+            self.stdout.write(''.join(
+                ('-' if row[key] is None else str(row[key])).rjust(width) for key, _, width in COLUMNS
+            ))
@@ -0,0 +1,99 @@
+import json
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from loans.models import Customer, Loan
+from loans.partitioning import is_loan_partitioned
+
+
+def _scanned_relations(plan):
+    """Collect the relations a query plan touches"""
+    relations = set()
+    if 'Relation Name' in plan:
+        relations.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        relations |= _scanned_relations(child)
+    return relations
+
+
+class Command(BaseCommand):
+    help = 'Benchmark current-year and per-customer loan queries and report partition pruning'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-loans', type=int, default=0,
+                            help='Insert this many synthetic loans for the run (rolled back afterwards)')
+        parser.add_argument('--years', type=int, default=5,
+                            help='Spread synthetic loans over this many past years')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partition benchmarks require PostgreSQL')
+
+        self.stdout.write(f'loan table partitioned: {is_loan_partitioned()}')
+        with transaction.atomic():
+            if options['seed_loans']:
+                self._seed(options['seed_loans'], options['years'])
+            self._run(options['repeat'])
+            # Never keep synthetic data
+            transaction.set_rollback(True)
+
+    def _seed(self, n_loans, years):
+        started = time.perf_counter()
+        n_customers = max(1, n_loans // 10)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT (SELECT COALESCE(MAX(customer_id), 0) FROM customer), '
+                '(SELECT COALESCE(MAX(loan_id), 0) FROM loan)'
+            )
+            max_customer_id, max_loan_id = cursor.fetchone()
+            cursor.execute(
+                """
+                INSERT INTO customer (customer_id, first_name, last_name, age, phone_number,
+                                      monthly_salary, approved_limit, current_debt, created_at)
+                SELECT %s + g, 'Bench', 'Customer', 30, '0000000000', 50000, 1800000, 0, now()
+                FROM generate_series(1, %s) g
+                """,
+                [max_customer_id, n_customers],
+            )
+            cursor.execute(
+                """
+                INSERT INTO loan (loan_id, loan_amount, tenure, interest_rate, monthly_repayment,
+                                  emis_paid_on_time, start_date, end_date, created_at, customer_id)
+                SELECT %s + g, 100000, 12, 12, 8884.88, 6,
+                       current_date - ((g %% (365 * %s)) || ' days')::interval,
+                       current_date, now(),
+                       (SELECT id FROM customer WHERE customer_id = %s + 1 + g %% %s)
+                FROM generate_series(1, %s) g
+                """,
+                [max_loan_id, years, max_customer_id, n_customers, n_loans],
+            )
+            cursor.execute('ANALYZE loan')
+        self.stdout.write(f'seeded {n_loans} loans in {time.perf_counter() - started:.1f}s')
+
+    def _run(self, repeat):
+        year = date.today().year
+        customer = Customer.objects.order_by('-customer_id').first()
+        if customer is None:
+            raise CommandError('No customers found; use --seed-loans')
+
+        queries = {
+            'current-year loans': Loan.objects.filter(start_date__year=year),
+            'customer loans': customer.loans.all(),
+            'customer current-year loans': customer.loans.filter(start_date__year=year),
+        }
+        for label, queryset in queries.items():
+            timings = []
+            relations = set()
+            for _ in range(repeat):
+                plan = json.loads(queryset.values('id').explain(format='json', analyze=True))[0]
+                timings.append(plan['Execution Time'])
+                relations = _scanned_relations(plan['Plan'])
+            timings.sort()
+            self.stdout.write(
+                f'{label}: median {timings[len(timings) // 2]:.2f}ms, '
+                f'scans {", ".join(sorted(relations))}'
+            )
@@ -0,0 +1,91 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from loans.models import Customer
+from loans.registrations import RegistrationBatcher, create_customers
+from loans.sharding import shard_aliases
+
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Measure registration inserts/s and latency, one transaction per customer against group commit'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Registrations per mode')
+        parser.add_argument('--concurrency', type=int, default=32, help='Concurrent registering threads')
+        parser.add_argument('--window-ms', type=float, default=settings.REGISTER_BATCH_WINDOW_MS)
+        parser.add_argument('--max-batch', type=int, default=settings.REGISTER_BATCH_MAX_SIZE)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Registration benchmarks require PostgreSQL')
+        if options['requests'] <= 0 or options['concurrency'] <= 0:
+            raise CommandError('--requests and --concurrency must be positive')
+
+        batcher = RegistrationBatcher(options['window_ms'] / 1000, options['max_batch'])
+        modes = {
+            'per-customer': lambda registration: create_customers([registration])[0],
+            'group commit': batcher.register,
+        }
+        for label, register in modes.items():
+            latencies, errors, customer_ids, elapsed = self._run(
+                register, options['requests'], options['concurrency']
+            )
+            # Never keep synthetic customers
+            for shard in shard_aliases():
+                Customer.objects.using(shard or DEFAULT_DB_ALIAS).filter(customer_id__in=customer_ids).delete()
+            if not latencies:
+                self.stdout.write(f'{label}: every registration failed ({errors} errors)')
+                continue
+            latencies.sort()
+            self.stdout.write(
+                f'{label}: {len(latencies)} customers in {elapsed:.2f}s ({len(latencies) / elapsed:,.0f}/s), '
+                f'p50 {_percentile(latencies, 50) * 1000:.1f}ms, p99 {_percentile(latencies, 99) * 1000:.1f}ms, '
+                f'{errors} errors'
+            )
+
+    def _run(self, register, n_requests, concurrency):
+        latencies, customer_ids = [], []
+        errors = 0
+        lock = threading.Lock()
+
+        def worker(count):
+            nonlocal errors
+            try:
+                for _ in range(count):
+                    registration = {
+                        'first_name': 'Bench', 'last_name': 'Customer', 'age': 30,
+                        'phone_number': '0000000000', 'monthly_income': Decimal('50000.00'),
+                    }
+                    started = time.perf_counter()
+                    try:
+                        customer = register(registration)
+                    except Exception:
+                        with lock:
+                            errors += 1
+                        continue
+                    latency = time.perf_counter() - started
+                    with lock:
+                        latencies.append(latency)
+                        customer_ids.append(customer.customer_id)
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=worker, args=(n_requests // concurrency + (i < n_requests % concurrency),))
+            for i in range(concurrency)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, errors, customer_ids, time.perf_counter() - started
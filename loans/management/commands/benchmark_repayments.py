@@ -0,0 +1,94 @@
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
+
+from loans.models import Customer, Loan
+from loans.repayments import post_repayments
+
+
+class Command(BaseCommand):
+    help = 'Measure repayment posting throughput, set-based against per-loan saves'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loans', type=int, default=100000,
+                            help='Synthetic loans to post against (rolled back afterwards)')
+        parser.add_argument('--entries', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Entries per statement (default: REPAYMENT_BATCH_SIZE)')
+        parser.add_argument('--per-loan-sample', type=int, default=2000,
+                            help='Entries to post one loan at a time for comparison (0 to skip)')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Repayment benchmarks require PostgreSQL')
+
+        with transaction.atomic():
+            loan_ids = self._seed(options['loans'])
+            rng = random.Random(0)
+            entries = [(rng.choice(loan_ids), 1, rng.random() < 0.9) for _ in range(options['entries'])]
+
+            started = time.perf_counter()
+            results = post_repayments(entries, f'benchmark-{uuid.uuid4()}', batch_size=options['batch_size'])
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"set-based: {len(entries)} entries in {elapsed:.2f}s "
+                f"({len(entries) / elapsed:,.0f}/s), {results['loans_updated']} loan updates"
+            )
+
+            sample = entries[:options['per_loan_sample']]
+            if sample:
+                started = time.perf_counter()
+                self._post_per_loan(sample)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'per-loan saves: {len(sample)} entries in {elapsed:.2f}s ({len(sample) / elapsed:,.0f}/s)'
+                )
+            # Never keep synthetic data
+            transaction.set_rollback(True)
+
+    def _seed(self, n_loans):
+        n_customers = max(1, n_loans // 10)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT (SELECT COALESCE(MAX(customer_id), 0) FROM customer), '
+                '(SELECT COALESCE(MAX(loan_id), 0) FROM loan)'
+            )
+            max_customer_id, max_loan_id = cursor.fetchone()
+            cursor.execute(
+                """
+                INSERT INTO customer (customer_id, first_name, last_name, age, phone_number,
+                                      monthly_salary, approved_limit, current_debt, created_at)
+                SELECT %s + g, 'Bench', 'Customer', 30, '0000000000', 50000, 1800000, 1000000, now()
+                FROM generate_series(1, %s) g
+                """,
+                [max_customer_id, n_customers],
+            )
+            cursor.execute(
+                """
+                INSERT INTO loan (loan_id, loan_amount, tenure, interest_rate, monthly_repayment,
+                                  emis_paid_on_time, emis_paid_late, start_date, end_date, created_at,
+                                  customer_id)
+                SELECT %s + g, 100000, 120, 12, 1434.71, 0, 0, current_date, current_date, now(),
+                       (SELECT id FROM customer WHERE customer_id = %s + 1 + g %% %s)
+                FROM generate_series(1, %s) g
+                """,
+                [max_loan_id, max_customer_id, n_customers, n_loans],
+            )
+            cursor.execute('ANALYZE loan')
+            cursor.execute('ANALYZE customer')
+        return list(range(max_loan_id + 1, max_loan_id + n_loans + 1))
+
+    def _post_per_loan(self, entries):
+        """The row-at-a-time alternative: one loan and one customer save per entry"""
+        for loan_id, emis_paid, on_time in entries:
+            loan = Loan.objects.select_for_update().get(loan_id=loan_id)
+            field = 'emis_paid_on_time' if on_time else 'emis_paid_late'
+            setattr(loan, field, getattr(loan, field) + emis_paid)
+            loan.save(update_fields=[field])
+            Customer.objects.filter(pk=loan.customer_id).update(
+                current_debt=F('current_debt') - loan.loan_amount * emis_paid / loan.tenure
+            )
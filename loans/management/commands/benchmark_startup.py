@@ -0,0 +1,78 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# What each process type imports before it can serve its first unit of work
+PROCESS_TYPES = {
+    'web': (
+        'from credit_system.wsgi import application\n'
+        'from django.urls import get_resolver\n'
+        'get_resolver().url_patterns\n'
+    ),
+    'worker': (
+        'import django\n'
+        'django.setup()\n'
+        'from credit_system.celery import app\n'
+        'app.loader.import_default_modules()\n'
+    ),
+    'command': (
+        'import django\n'
+        'django.setup()\n'
+        'from loans.management.commands import enqueue_ingest\n'
+    ),
+    'ingestion': (
+        'import django\n'
+        'django.setup()\n'
+        'import loans.ingestion\n'
+    ),
+}
+
+PROBE = """
+import resource, sys, time
+started = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - started
+print(__import__('json').dumps({{
+    'import_ms': elapsed * 1000,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'pandas_loaded': 'pandas' in sys.modules,
+}}))
+"""
+
+
+class Command(BaseCommand):
+    help = 'Measure import time and RSS for each process type in a fresh interpreter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('process_types', nargs='*',
+                            help=f'Process types to measure: {", ".join(PROCESS_TYPES)} (default: all)')
+
+    def handle(self, *args, **options):
+        unknown = set(options['process_types']) - set(PROCESS_TYPES)
+        if unknown:
+            raise CommandError(f'Unknown process types: {", ".join(sorted(unknown))}')
+
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'credit_system.settings')}
+        for process_type in options['process_types'] or PROCESS_TYPES:
+            probe = PROBE.format(code=PROCESS_TYPES[process_type])
+            samples = []
+            for _ in range(options['repeat']):
+                output = subprocess.run(
+                    [sys.executable, '-c', probe],
+                    cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+                ).stdout
+                samples.append(json.loads(output.strip().splitlines()[-1]))
+
+            samples.sort(key=lambda sample: sample['import_ms'])
+            median = samples[len(samples) // 2]
+            self.stdout.write(
+                f"{process_type}: import {median['import_ms']:.0f}ms, "
+                f"max RSS {median['max_rss_kb'] / 1024:.1f}MB, "
+                f"pandas loaded: {median['pandas_loaded']}"
+            )
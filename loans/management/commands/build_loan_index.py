@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from loans import sharding
+from loans.models import Customer, Loan
+
+
+class Command(BaseCommand):
+    help = 'Index the loans on every shard by loan_id and report customers stored on the wrong shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=sharding.LOOKUP_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if not sharding.is_sharded():
+            raise CommandError('DATABASE_SHARDS has a single database, there is nothing to index')
+
+        for shard in sharding.shard_aliases():
+            loans = (Loan.objects.using(shard).order_by('loan_id')
+                     .values_list('loan_id', 'customer__customer_id'))
+            indexed = 0
+            batch = []
+            for pair in loans.iterator(chunk_size=options['batch_size']):
+                batch.append(pair)
+                if len(batch) == options['batch_size']:
+                    sharding.index_loans(batch)
+                    indexed += len(batch)
+                    batch = []
+            sharding.index_loans(batch)
+            indexed += len(batch)
+
+            misplaced = sum(
+                1 for customer_id in Customer.objects.using(shard).values_list('customer_id', flat=True).iterator()
+                if sharding.shard_for_customer(customer_id) != shard
+            )
+            style = self.style.WARNING if misplaced else self.style.SUCCESS
+            self.stdout.write(style(f'{shard}: indexed {indexed} loans, {misplaced} customers on the wrong shard'))
@@ -1,4 +1,7 @@
+import uuid
+
 from django.core.management.base import BaseCommand
+from loans.models import IngestionJob
 from loans.tasks import ingest_excel_data
 
 
@@ -6,8 +9,10 @@ class Command(BaseCommand):
     help = 'Enqueue Excel data ingestion task'
 
     def handle(self, *args, **options):
-        # Enqueue the task
-        task = ingest_excel_data.delay()
+        # Record the job before enqueueing it, so it is listed while queued
+        job = IngestionJob.objects.create(task_id=str(uuid.uuid4()))
+        ingest_excel_data.apply_async(task_id=job.task_id)
         self.stdout.write(
-            self.style.SUCCESS(f'Successfully enqueued ingestion task with ID: {task.id}')
+            self.style.SUCCESS(f'Successfully enqueued ingestion task with ID: {job.task_id}')
         )
+        self.stdout.write(f'Follow its progress at /ingest-jobs/{job.task_id}')
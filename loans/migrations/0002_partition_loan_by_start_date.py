@@ -0,0 +1,188 @@
+"""
+Convert the loan table into a declarative range-partitioned table on
+start_date with one partition per year plus a default partition.
+
+Postgres can't enforce a unique index across partitions unless it includes
+the partition key, so global loan_id uniqueness is kept by the
+loan_id_registry table, maintained by triggers. Inserting a duplicate
+loan_id still raises an IntegrityError.
+
+On large books run this in a maintenance window: the existing rows are
+copied into the new table inside the migration transaction. Only runs on
+PostgreSQL; other backends keep the plain table.
+"""
+from datetime import date
+
+from django.db import migrations
+
+
+LOAN_COLUMNS = (
+    'id, loan_id, loan_amount, tenure, interest_rate, monthly_repayment, '
+    'emis_paid_on_time, start_date, end_date, created_at, customer_id'
+)
+
+REGISTRY_TRIGGERS = """
+CREATE TABLE loan_id_registry (loan_id integer PRIMARY KEY, id bigint NOT NULL);
+
+-- A row moving between partitions is re-inserted with the same id, which
+-- must not count as a duplicate.
+CREATE FUNCTION loan_id_registry_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO loan_id_registry (loan_id, id) VALUES (NEW.loan_id, NEW.id)
+    ON CONFLICT (loan_id) DO UPDATE SET id = EXCLUDED.id
+    WHERE loan_id_registry.id = EXCLUDED.id;
+    IF NOT FOUND THEN
+        RAISE unique_violation USING
+            MESSAGE = 'duplicate key value violates unique constraint "loan_loan_id_key"',
+            DETAIL = format('Key (loan_id)=(%s) already exists.', NEW.loan_id);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION loan_id_registry_update() RETURNS trigger AS $$
+BEGIN
+    IF NEW.loan_id <> OLD.loan_id THEN
+        UPDATE loan_id_registry SET loan_id = NEW.loan_id WHERE loan_id = OLD.loan_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION loan_id_registry_delete() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM loan_id_registry
+    WHERE loan_id = OLD.loan_id
+      AND NOT EXISTS (SELECT 1 FROM loan WHERE loan_id = OLD.loan_id);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION loan_id_registry_truncate() RETURNS trigger AS $$
+BEGIN
+    TRUNCATE loan_id_registry;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER loan_id_registry_insert BEFORE INSERT ON loan
+    FOR EACH ROW EXECUTE FUNCTION loan_id_registry_insert();
+CREATE TRIGGER loan_id_registry_update BEFORE UPDATE OF loan_id ON loan
+    FOR EACH ROW EXECUTE FUNCTION loan_id_registry_update();
+CREATE TRIGGER loan_id_registry_delete AFTER DELETE ON loan
+    FOR EACH ROW EXECUTE FUNCTION loan_id_registry_delete();
+CREATE TRIGGER loan_id_registry_truncate AFTER TRUNCATE ON loan
+    FOR EACH STATEMENT EXECUTE FUNCTION loan_id_registry_truncate();
+"""
+
+DROP_REGISTRY = """
+DROP FUNCTION IF EXISTS loan_id_registry_insert() CASCADE;
+DROP FUNCTION IF EXISTS loan_id_registry_update() CASCADE;
+DROP FUNCTION IF EXISTS loan_id_registry_delete() CASCADE;
+DROP FUNCTION IF EXISTS loan_id_registry_truncate() CASCADE;
+DROP TABLE IF EXISTS loan_id_registry;
+"""
+
+
+def _restore_constraints(cursor, primary_key):
+    cursor.execute(f'ALTER TABLE loan ADD CONSTRAINT loan_pkey PRIMARY KEY ({primary_key})')
+    cursor.execute('CREATE INDEX loan_customer_id_3ade2aad ON loan (customer_id)')
+    cursor.execute(
+        'ALTER TABLE loan ADD CONSTRAINT loan_customer_id_3ade2aad_fk_customer_id '
+        'FOREIGN KEY (customer_id) REFERENCES customer (id) DEFERRABLE INITIALLY DEFERRED'
+    )
+    cursor.execute(
+        "SELECT setval(pg_get_serial_sequence('loan', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM loan"
+    )
+
+
+def partition_loan_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT MIN(start_date) FROM loan')
+        first_date = cursor.fetchone()[0]
+        current_year = date.today().year
+        first_year = min(first_date.year, current_year) if first_date else current_year
+
+        cursor.execute(
+            """
+            CREATE TABLE loan_partitioned (
+                id bigint NOT NULL GENERATED BY DEFAULT AS IDENTITY,
+                loan_id integer NOT NULL,
+                loan_amount numeric(12, 2) NOT NULL,
+                tenure integer NOT NULL,
+                interest_rate numeric(5, 2) NOT NULL,
+                monthly_repayment numeric(10, 2) NOT NULL,
+                emis_paid_on_time integer NOT NULL,
+                start_date date NOT NULL,
+                end_date date NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                customer_id bigint NOT NULL
+            ) PARTITION BY RANGE (start_date)
+            """
+        )
+        for year in range(first_year, current_year + 2):
+            cursor.execute(
+                f'CREATE TABLE loan_y{year} PARTITION OF loan_partitioned '
+                f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+            )
+        cursor.execute('CREATE TABLE loan_default PARTITION OF loan_partitioned DEFAULT')
+
+        cursor.execute(
+            f'INSERT INTO loan_partitioned ({LOAN_COLUMNS}) SELECT {LOAN_COLUMNS} FROM loan'
+        )
+        cursor.execute('DROP TABLE loan')
+        cursor.execute('ALTER TABLE loan_partitioned RENAME TO loan')
+        cursor.execute('ALTER SEQUENCE loan_partitioned_id_seq RENAME TO loan_id_seq')
+
+        _restore_constraints(cursor, 'id, start_date')
+        cursor.execute('CREATE INDEX loan_loan_id_idx ON loan (loan_id)')
+
+        cursor.execute(REGISTRY_TRIGGERS)
+        cursor.execute('INSERT INTO loan_id_registry (loan_id, id) SELECT loan_id, id FROM loan')
+
+
+def unpartition_loan_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(DROP_REGISTRY)
+        cursor.execute(
+            """
+            CREATE TABLE loan_heap (
+                id bigint NOT NULL GENERATED BY DEFAULT AS IDENTITY,
+                loan_id integer NOT NULL UNIQUE,
+                loan_amount numeric(12, 2) NOT NULL,
+                tenure integer NOT NULL,
+                interest_rate numeric(5, 2) NOT NULL,
+                monthly_repayment numeric(10, 2) NOT NULL,
+                emis_paid_on_time integer NOT NULL,
+                start_date date NOT NULL,
+                end_date date NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                customer_id bigint NOT NULL
+            )
+            """
+        )
+        cursor.execute(
+            f'INSERT INTO loan_heap ({LOAN_COLUMNS}) SELECT {LOAN_COLUMNS} FROM loan'
+        )
+        cursor.execute('DROP TABLE loan CASCADE')
+        cursor.execute('ALTER TABLE loan_heap RENAME TO loan')
+        cursor.execute('ALTER SEQUENCE loan_heap_id_seq RENAME TO loan_id_seq')
+        cursor.execute('ALTER INDEX loan_heap_loan_id_key RENAME TO loan_loan_id_key')
+        _restore_constraints(cursor, 'id')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_loan_table, unpartition_loan_table),
+    ]
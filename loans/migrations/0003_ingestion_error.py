@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0002_partition_loan_by_start_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionError',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(db_index=True, max_length=255)),
+                ('source', models.CharField(max_length=20)),
+                ('row_number', models.IntegerField()),
+                ('reason', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'ingestion_error',
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+"""
+Trigram indexes backing the admin's substring searches on customer names and
+phone numbers. Django runs icontains as UPPER(col::text) LIKE UPPER('%x%'),
+so the indexes are on the same expression.
+
+Only runs on PostgreSQL servers that ship the pg_trgm extension.
+"""
+from django.db import migrations
+
+
+TRIGRAM_COLUMNS = ['first_name', 'last_name', 'phone_number']
+
+
+def _has_pg_trgm(cursor):
+    cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    return cursor.fetchone() is not None
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        if not _has_pg_trgm(cursor):
+            return
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for column in TRIGRAM_COLUMNS:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS customer_{column}_trgm '
+                f'ON customer USING gin (UPPER({column}::text) gin_trgm_ops)'
+            )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for column in TRIGRAM_COLUMNS:
+            cursor.execute(f'DROP INDEX IF EXISTS customer_{column}_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0003_ingestion_error'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0005_outbox_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='emis_paid_late',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0006_loan_emis_paid_late'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoanIndex',
+            fields=[
+                ('loan_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('customer_id', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'loan_index',
+            },
+        ),
+    ]
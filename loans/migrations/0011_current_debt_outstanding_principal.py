@@ -0,0 +1,41 @@
+"""
+Set each customer's current_debt to the principal outstanding on its loans.
+
+Ingestion used to leave current_debt at 0 while create-loan added each
+loan's amount, so repaying an ingested loan took off principal that had never
+been added. Principal is repaid straight-line, as in loans.repayments.
+"""
+from django.db import migrations
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Least, Round
+
+
+def set_outstanding_debt(apps, schema_editor):
+    Customer = apps.get_model('loans', 'Customer')
+    Loan = apps.get_model('loans', 'Loan')
+    using = schema_editor.connection.alias
+    money = DecimalField(max_digits=12, decimal_places=2)
+
+    repaid = Round(ExpressionWrapper(
+        F('loan_amount') * Least(F('emis_paid_on_time') + F('emis_paid_late'), F('tenure')) / F('tenure'),
+        output_field=money,
+    ), 2)
+    outstanding = (Loan.objects.using(using).filter(customer_id=OuterRef('pk'))
+                   .values('customer_id')
+                   .annotate(total=Sum(F('loan_amount') - repaid, output_field=money))
+                   .values('total'))
+    Customer.objects.using(using).filter(pk__in=Loan.objects.using(using).values('customer_id')).update(
+        current_debt=Coalesce(Subquery(outstanding), 0, output_field=money),
+        version=F('version') + 1,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0010_repayment_batch'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_outstanding_debt, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,33 @@
 from django.db import models
+from django.db.models.functions import Now
+from django.utils import timezone
 from decimal import Decimal
 
 
-class Customer(models.Model):
+class VersionedModel(models.Model):
+    """
+    A row with a version that goes up on every change, for strong ETags.
+    Bulk and raw SQL writers bump version and updated_at themselves.
+    """
+    version = models.PositiveIntegerField(default=1, db_default=1)
+    updated_at = models.DateTimeField(auto_now=True, db_default=Now())
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        bumped = not self._state.adding
+        if bumped:
+            # Incremented in the database so concurrent saves get distinct versions
+            self.version = models.F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version', 'updated_at'}
+        super().save(*args, **kwargs)
+        if bumped:
+            self.refresh_from_db(fields=['version'])
+
+
+class Customer(VersionedModel):
     customer_id = models.IntegerField(unique=True)
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
@@ -16,11 +41,16 @@ class Customer(models.Model):
     def __str__(self):
         return f"{self.first_name} {self.last_name} - {self.customer_id}"
 
+    @staticmethod
+    def bump_versions(queryset):
+        """New versions for the customers in queryset, e.g. after their loans changed"""
+        return queryset.update(version=models.F('version') + 1, updated_at=timezone.now())
+
     class Meta:
         db_table = 'customer'
 
 
-class Loan(models.Model):
+class Loan(VersionedModel):
     loan_id = models.IntegerField(unique=True)
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='loans')
     loan_amount = models.DecimalField(max_digits=12, decimal_places=2)
@@ -28,6 +58,7 @@ class Loan(models.Model):
     interest_rate = models.DecimalField(max_digits=5, decimal_places=2)
     monthly_repayment = models.DecimalField(max_digits=10, decimal_places=2)
     emis_paid_on_time = models.IntegerField(default=0)
+    emis_paid_late = models.IntegerField(default=0)
     start_date = models.DateField()
     end_date = models.DateField()
     created_at = models.DateTimeField(auto_now_add=True)
@@ -35,9 +66,116 @@ class Loan(models.Model):
     def __str__(self):
         return f"Loan {self.loan_id} - {self.customer.first_name} {self.customer.last_name}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # A customer's version also covers its list of loans
+        Customer.bump_versions(Customer.objects.using(self._state.db).filter(pk=self.customer_id))
+
+    def delete(self, *args, **kwargs):
+        customers = Customer.objects.using(self._state.db).filter(pk=self.customer_id)
+        deleted = super().delete(*args, **kwargs)
+        Customer.bump_versions(customers)
+        return deleted
+
     @property
     def repayments_left(self):
-        return max(0, self.tenure - self.emis_paid_on_time)
+        return max(0, self.tenure - self.emis_paid_on_time - self.emis_paid_late)
 
     class Meta:
         db_table = 'loan'
+
+
+class IngestionError(models.Model):
+    """A spreadsheet row rejected by ingest_excel_data"""
+    task_id = models.CharField(max_length=255, db_index=True)
+    source = models.CharField(max_length=20)  # 'customer' or 'loan'
+    row_number = models.IntegerField()  # spreadsheet row, header is row 1
+    reason = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.source} row {self.row_number}: {self.reason}"
+
+    class Meta:
+        db_table = 'ingestion_error'
+
+
+class IngestionJob(models.Model):
+    """
+    Progress and outcome of one ingest_excel_data run. progress holds row
+    counts per stage (sheet), updated after every chunk of rows is written.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (SUCCEEDED, 'Succeeded'), (FAILED, 'Failed')]
+
+    task_id = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=20, blank=True)  # stage being processed
+    progress = models.JSONField(default=dict)
+    results = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Ingestion {self.task_id} ({self.status})"
+
+    class Meta:
+        db_table = 'ingestion_job'
+
+
+class OutboxEvent(models.Model):
+    """
+    A side effect of a committed write, recorded in the same transaction and
+    applied later by loans.outbox.drain
+    """
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return f"{self.event_type} #{self.pk}"
+
+    class Meta:
+        db_table = 'outbox_event'
+        indexes = [
+            # Only unprocessed events are scanned by the consumer
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True),
+                         name='outbox_event_pending_idx'),
+        ]
+
+
+class RepaymentBatch(models.Model):
+    """
+    A batch of repayment entries that has been applied, recorded in the
+    batch's own transaction so a retried request or redelivered task skips it
+    """
+    key = models.CharField(max_length=255, unique=True)  # idempotency key:shard:batch number
+    results = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        db_table = 'repayment_batch'
+
+
+class LoanIndex(models.Model):
+    """
+    Where each loan lives when customers are sharded (loans.sharding): loan_id
+    to its customer's customer_id. Kept on the default database only, which
+    also makes loan_ids unique across shards.
+    """
+    loan_id = models.IntegerField(primary_key=True)
+    customer_id = models.IntegerField()
+
+    class Meta:
+        db_table = 'loan_index'
@@ -0,0 +1,118 @@
+"""
+Integer money for the scoring and EMI compute path.
+
+Amounts are ints in paise (Rs 1 = 100 paise) and interest rates are ints in
+basis points (12.50% = 1250), so arithmetic is exact, NumPy-friendly (int64)
+and free of Decimal/str round-tripping. Values are converted from Decimal at
+the API and database boundary with to_paise/to_basis_points and back with
+from_paise/from_basis_points.
+
+The functions here are equivalent to the Decimal ones in loans.utils, which
+remain the reference implementation (see MoneyEquivalenceTestCase). The one
+difference is that EMIs are computed exactly, so an EMI whose exact value is
+a half paisa is always rounded up, where Decimal's 28-digit arithmetic can
+land either side of it.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+from math import gcd
+from typing import NewType
+
+
+Paise = NewType('Paise', int)
+BasisPoints = NewType('BasisPoints', int)
+
+PAISE_PER_RUPEE = 100
+BASIS_POINTS_PER_PERCENT = 100
+LAKH = Paise(100000 * PAISE_PER_RUPEE)
+# 12 months x 100% in basis points: the monthly rate is rate / MONTHLY_RATE_DIVISOR
+MONTHLY_RATE_DIVISOR = 12 * 100 * BASIS_POINTS_PER_PERCENT
+
+
+def _hundredths(value):
+    if type(value) is int:
+        return value * 100
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return int(value.scaleb(2).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def to_paise(amount) -> Paise:
+    """Rupees (Decimal, int or str) to paise, rounding sub-paisa amounts half up"""
+    return Paise(_hundredths(amount))
+
+
+def from_paise(paise) -> Decimal:
+    """Paise to a 2dp Decimal of rupees"""
+    return Decimal(int(paise)).scaleb(-2)
+
+
+def to_basis_points(rate) -> BasisPoints:
+    """An annual percentage rate (Decimal, int or str) to basis points"""
+    return BasisPoints(_hundredths(rate))
+
+
+def from_basis_points(basis_points) -> Decimal:
+    """Basis points to a 2dp Decimal percentage"""
+    return Decimal(int(basis_points)).scaleb(-2)
+
+
+# Defaults for loans.policy.ScoringPolicy: proposed loans are checked against
+# the EMI cap at the highest slab rate, and current EMIs plus the proposed EMI
+# may not exceed this percentage of salary
+WORST_CASE_RATE = BasisPoints(1600)
+MAX_EMI_TO_SALARY_PERCENT = 50
+
+
+def divide_half_up(numerator, denominator):
+    """numerator / denominator rounded half away from zero, for a positive denominator"""
+    if numerator < 0:
+        return -divide_half_up(-numerator, denominator)
+    quotient, remainder = divmod(numerator, denominator)
+    return quotient + (2 * remainder >= denominator)
+
+
+def round_nearest_lakh(amount: Paise) -> Paise:
+    """Round to the nearest lakh, like utils.round_nearest_lakh"""
+    return Paise(divide_half_up(amount, LAKH) * LAKH)
+
+
+@lru_cache(maxsize=4096)
+def _emi_fraction(rate: BasisPoints, n_months):
+    """
+    EMI per paisa of principal as an exact fraction:
+    R x (1+R)^N / ((1+R)^N - 1) with R = rate / D is rate x (D+rate)^N / (D x ((D+rate)^N - D^N))
+    """
+    growth = (MONTHLY_RATE_DIVISOR + rate) ** n_months
+    base = MONTHLY_RATE_DIVISOR ** n_months
+    numerator = rate * growth
+    denominator = MONTHLY_RATE_DIVISOR * (growth - base)
+    divisor = gcd(numerator, denominator)
+    return numerator // divisor, denominator // divisor
+
+
+def calculate_emi(principal: Paise, rate: BasisPoints, n_months) -> Paise:
+    """EMI in paise, rounded half up like utils.calculate_emi"""
+    if rate == 0:
+        return Paise(divide_half_up(principal, n_months))
+    numerator, denominator = _emi_fraction(rate, n_months)
+    return Paise(divide_half_up(principal * numerator, denominator))
+
+
+def exceeds_emi_cap(total_emi: Paise, monthly_salary: Paise, max_percent=MAX_EMI_TO_SALARY_PERCENT):
+    """Whether EMIs exceed max_percent of the salary"""
+    return total_emi * 100 > monthly_salary * max_percent
+
+
+def emi_headroom(monthly_salary: Paise, total_emi: Paise, max_percent=MAX_EMI_TO_SALARY_PERCENT) -> Paise:
+    """The largest further EMI in paise that stays within the cap"""
+    return Paise(max(0, (monthly_salary * max_percent - total_emi * 100) // 100))
+
+
+def outstanding_principal(loan_amount: Paise, tenure, emis_paid) -> Paise:
+    """
+    Principal left after emis_paid (at most tenure) EMIs. Principal is repaid
+    straight-line and rounded half up to the paisa, as in loans.repayments.
+    Also works elementwise on int64 arrays.
+    """
+    return loan_amount - (2 * loan_amount * emis_paid + tenure) // (2 * tenure)
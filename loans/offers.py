@@ -0,0 +1,56 @@
+import numpy as np
+
+from .money import calculate_emi, from_paise
+from .policy import CURRENT_POLICY
+
+
+TENURES = np.arange(1, 121)
+
+
+def emi_factors(annual_rate, tenures):
+    """
+    EMI per unit of principal for each tenure at an annual rate in basis
+    points: R x (1+R)^N / ((1+R)^N - 1), or 1/N at a zero rate
+    """
+    monthly_rate = annual_rate / 120000
+    if monthly_rate == 0:
+        return 1.0 / tenures
+    growth = (1 + monthly_rate) ** tenures
+    return monthly_rate * growth / (growth - 1)
+
+
+def largest_principal(estimate, emi_headroom, tenure, policy=CURRENT_POLICY):
+    """
+    The largest principal in paise whose exact proposed EMI fits in
+    emi_headroom, searched from an estimate that is at most a paisa or two off
+    """
+    principal = max(0, estimate)
+    while principal > 0 and policy.proposed_emi(principal, tenure) > emi_headroom:
+        principal -= 1
+    while policy.proposed_emi(principal + 1, tenure) <= emi_headroom:
+        principal += 1
+    return principal
+
+
+def loan_offer_table(emi_headroom, corrected_interest_rate, tenures=TENURES, policy=CURRENT_POLICY):
+    """
+    Solve for the largest principal per tenure whose EMI at the worst-case
+    rate still fits in emi_headroom paise (the check_eligibility cap), and its
+    installment at the corrected interest rate (basis points).
+    """
+    if emi_headroom <= 0:
+        return []
+
+    # The EMI is rounded to paise, so any principal whose exact EMI is below
+    # headroom + half a paisa passes the cap. The float estimate is then
+    # settled with the exact integer EMI that check_eligibility uses.
+    estimates = np.floor((emi_headroom + 0.5) / emi_factors(policy.worst_case_rate, tenures)).astype(np.int64)
+    offers = []
+    for tenure, estimate in zip(tenures.tolist(), estimates.tolist()):
+        principal = largest_principal(estimate, emi_headroom, tenure, policy)
+        offers.append({
+            'tenure': tenure,
+            'max_loan_amount': from_paise(principal),
+            'monthly_installment': from_paise(calculate_emi(principal, corrected_interest_rate, tenure)),
+        })
+    return offers
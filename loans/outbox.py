@@ -0,0 +1,170 @@
+"""
+Transactional outbox: views record side effects as OutboxEvent rows inside
+their write transaction, and the drain_outbox Celery task applies them in
+batches after commit. Each shard (loans.sharding) has its own outbox, written
+in the same transaction as the shard's data.
+
+Delivery is at-least-once. An event is marked processed in the same
+transaction as the database effects of its handler, but a handler's external
+effects (Redis, notifications) may be repeated if a worker dies before
+committing, so handlers must be idempotent.
+"""
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from .models import OutboxEvent
+from .profile_cache import invalidate_customers
+from .sharding import shard_aliases
+
+
+logger = logging.getLogger(__name__)
+
+LOAN_CREATED = 'loan.created'
+REPAYMENTS_POSTED = 'repayments.posted'
+
+# event_type -> handlers called with the batch's payloads of that type and the
+# alias of the database whose outbox is being drained
+HANDLERS = defaultdict(list)
+_broker_down_until = 0
+
+
+def handles(event_type):
+    """Register a handler(payloads, using) for a batch of payloads of event_type"""
+    def register(handler):
+        HANDLERS[event_type].append(handler)
+        return handler
+    return register
+
+
+def publish(event_type, payload, using=None):
+    """
+    Record an event in the current transaction (on the `using` database) and
+    ask a worker to drain the outbox once it commits. Events missed by the
+    worker are picked up by the periodic drain.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    event = OutboxEvent.objects.using(using).create(event_type=event_type, payload=payload)
+    transaction.on_commit(_schedule_drain, using=using)
+    return event
+
+
+def _schedule_drain():
+    global _broker_down_until
+    if time.monotonic() < _broker_down_until:
+        return
+    from .tasks import drain_outbox
+    try:
+        drain_outbox.apply_async(retry=False)
+    except Exception:
+        # Don't make every request wait on the broker's connect timeout
+        _broker_down_until = time.monotonic() + settings.OUTBOX_DRAIN_INTERVAL
+        logger.warning('Could not enqueue drain_outbox, leaving events to the periodic drain', exc_info=True)
+
+
+def drain(batch_size=None, using=None):
+    """
+    Apply one batch of pending events from the `using` database's outbox and
+    mark them processed. Returns the number of events processed.
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    using = using or DEFAULT_DB_ALIAS
+    events_on_db = OutboxEvent.objects.using(using)
+    with transaction.atomic(using=using):
+        # Concurrent drains take disjoint batches instead of waiting on each other
+        events = list(
+            events_on_db
+            .select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True, attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+            .order_by('id')[:batch_size]
+        )
+        by_type = defaultdict(list)
+        for event in events:
+            by_type[event.event_type].append(event)
+
+        processed = []
+        for event_type, typed_events in by_type.items():
+            try:
+                _handle(event_type, typed_events, using)
+            except Exception as e:
+                if len(typed_events) == 1:
+                    _record_failure(typed_events[0], e, using)
+                    continue
+                # Find the bad events so only they are charged an attempt
+                logger.warning('Outbox handler for %s failed on %d events, retrying one at a time',
+                               event_type, len(typed_events), exc_info=True)
+                for event in typed_events:
+                    try:
+                        _handle(event_type, [event], using)
+                    except Exception as e:
+                        _record_failure(event, e, using)
+                    else:
+                        processed.append(event.pk)
+            else:
+                processed.extend(event.pk for event in typed_events)
+
+        events_on_db.filter(pk__in=processed).update(processed_at=timezone.now())
+    return len(processed)
+
+
+def _handle(event_type, events, using):
+    """Run event_type's handlers on events, rolling back their writes if one fails"""
+    payloads = [event.payload for event in events]
+    with transaction.atomic(using=using):
+        for handler in HANDLERS[event_type]:
+            handler(payloads, using)
+
+
+def _record_failure(event, e, using):
+    """Log the handler error e and charge the event an attempt"""
+    logger.exception('Outbox handler for %s failed on event %d', event.event_type, event.pk)
+    OutboxEvent.objects.using(using).filter(pk=event.pk).update(
+        attempts=F('attempts') + 1, last_error=f'{type(e).__name__}: {e}'[:255],
+    )
+
+
+def purge_processed(older_than=None, using=None):
+    """Delete processed events older than OUTBOX_RETENTION_DAYS"""
+    older_than = older_than or timezone.now() - timedelta(days=settings.OUTBOX_RETENTION_DAYS)
+    deleted, _ = (OutboxEvent.objects.using(using or DEFAULT_DB_ALIAS)
+                  .filter(processed_at__lt=older_than).delete())
+    return deleted
+
+
+def outbox_lag():
+    """Pending and dead events on all shards, and the age of the oldest pending one"""
+    pending = dead = 0
+    oldest = None
+    for alias in shard_aliases():
+        unprocessed = OutboxEvent.objects.using(alias or DEFAULT_DB_ALIAS).filter(processed_at__isnull=True)
+        stats = (unprocessed.filter(attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+                 .aggregate(count=Count('id'), oldest=Min('created_at')))
+        pending += stats['count']
+        dead += unprocessed.filter(attempts__gte=settings.OUTBOX_MAX_ATTEMPTS).count()
+        if stats['oldest'] and (oldest is None or stats['oldest'] < oldest):
+            oldest = stats['oldest']
+    return {
+        'pending': pending,
+        'dead': dead,
+        'oldest_pending_seconds': round((timezone.now() - oldest).total_seconds(), 3) if oldest else 0,
+    }
+
+
+@handles(LOAN_CREATED)
+def invalidate_loan_customers(payloads, using):
+    """Cached profiles of customers with new loans are stale"""
+    invalidate_customers((payload['customer_id'] for payload in payloads), using=using)
+
+
+@handles(REPAYMENTS_POSTED)
+def invalidate_repaying_customers(payloads, using):
+    """Repayments change the score inputs and debt of cached profiles"""
+    invalidate_customers(
+        (customer_id for payload in payloads for customer_id in payload['customer_ids']), using=using,
+    )
@@ -0,0 +1,96 @@
+from datetime import date
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+def loan_partition_name(year):
+    """Name of the yearly partition of the loan table"""
+    return f'loan_y{year}'
+
+
+def is_loan_partitioned(using=DEFAULT_DB_ALIAS):
+    """Check whether the loan table is range-partitioned on start_date"""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'loan'::regclass"
+        )
+        return cursor.fetchone() is not None
+
+
+def loan_partitions(using=DEFAULT_DB_ALIAS):
+    """List existing loan partitions"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'loan'::regclass
+            ORDER BY child.relname
+            """
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_loan_partition(year, using=DEFAULT_DB_ALIAS):
+    """
+    Create the partition holding loans that start in the given year.
+    Rows for that year already sitting in the default partition are moved
+    into the new partition.
+    Returns True if the partition was created.
+    """
+    name = loan_partition_name(year)
+    start = date(year, 1, 1).isoformat()
+    end = date(year + 1, 1, 1).isoformat()
+
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [name])
+        if cursor.fetchone()[0] is not None:
+            return False
+
+        cursor.execute(
+            f'CREATE TABLE "{name}" (LIKE loan INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        )
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM loan_default
+                WHERE start_date >= %s AND start_date < %s
+                RETURNING *
+            )
+            INSERT INTO "{name}" SELECT * FROM moved
+            """,
+            [start, end],
+        )
+        # The delete trigger on loan_default dropped the moved loan_ids
+        cursor.execute(
+            f'INSERT INTO loan_id_registry (loan_id, id) SELECT loan_id, id FROM "{name}" '
+            'ON CONFLICT DO NOTHING'
+        )
+        cursor.execute(
+            f'ALTER TABLE loan ATTACH PARTITION "{name}" '
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+    return True
+
+
+def ensure_loan_partitions(years_ahead=1, today=None, years=(), using=DEFAULT_DB_ALIAS):
+    """
+    Make sure partitions exist for the current year, the next `years_ahead`
+    years and any extra `years` (e.g. historical years being ingested).
+    Does nothing if the loan table is not partitioned.
+    Returns the names of the partitions that were created.
+    """
+    if not is_loan_partitioned(using):
+        return []
+
+    today = today or date.today()
+    wanted = set(range(today.year, today.year + years_ahead + 1)) | {int(year) for year in years}
+    created = []
+    for year in sorted(wanted):
+        if create_loan_partition(year, using):
+            created.append(loan_partition_name(year))
+    return created
@@ -0,0 +1,135 @@
+"""
+Approval policy for loan requests: the interest rate slabs and the EMI cap
+that check-eligibility, loan-offers and create-loan apply to a credit score.
+
+A ScoringPolicy is plain data. CURRENT_POLICY is the one the API uses, and
+candidate policies can be written as JSON (see ScoringPolicy.from_dict) and
+compared with it over the whole book by `manage.py backtest_policy`.
+"""
+import json
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .money import (
+    MAX_EMI_TO_SALARY_PERCENT, WORST_CASE_RATE, BasisPoints, Paise, calculate_emi,
+    emi_headroom, exceeds_emi_cap, from_basis_points, to_basis_points,
+)
+
+
+@dataclass(frozen=True)
+class RateSlab:
+    """Scores above min_score are approved at no less than rate_floor basis points"""
+    min_score: int
+    rate_floor: BasisPoints = BasisPoints(0)
+
+
+@dataclass(frozen=True)
+class ScoringPolicy:
+    """
+    Rate slabs, checked from the highest min_score down, and the cap on
+    current plus proposed EMIs as a percentage of salary. Proposed EMIs are
+    estimated at worst_case_rate.
+    """
+    name: str
+    slabs: tuple = field(default=())
+    max_emi_to_salary_percent: int = MAX_EMI_TO_SALARY_PERCENT
+    worst_case_rate: BasisPoints = WORST_CASE_RATE
+
+    def __post_init__(self):
+        slabs = tuple(sorted(self.slabs, key=lambda slab: slab.min_score, reverse=True))
+        if not slabs:
+            raise ValueError('A policy needs at least one rate slab')
+        if len({slab.min_score for slab in slabs}) != len(slabs):
+            raise ValueError('Rate slabs must have distinct min_score values')
+        if not all(0 <= slab.min_score < 100 for slab in slabs):
+            raise ValueError('Slab min_score must be between 0 and 99')
+        if any(slab.rate_floor < 0 for slab in slabs):
+            raise ValueError('Slab rate_floor cannot be negative')
+        if not 0 < self.max_emi_to_salary_percent <= 100:
+            raise ValueError('max_emi_to_salary_percent must be between 1 and 100')
+        if self.worst_case_rate <= 0:
+            raise ValueError('worst_case_interest_rate must be positive')
+        object.__setattr__(self, 'slabs', slabs)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        A policy from its JSON form, with rates as percentages:
+        {"name": "...", "slabs": [{"min_score": 50, "rate_floor": "0"}, ...],
+         "max_emi_to_salary_percent": 50, "worst_case_interest_rate": "16.00"}
+        Raises ValueError for malformed policies.
+        """
+        try:
+            return cls(
+                name=str(data['name']),
+                slabs=tuple(
+                    RateSlab(int(slab['min_score']), to_basis_points(slab.get('rate_floor', 0)))
+                    for slab in data['slabs']
+                ),
+                max_emi_to_salary_percent=int(data.get('max_emi_to_salary_percent', MAX_EMI_TO_SALARY_PERCENT)),
+                worst_case_rate=to_basis_points(data.get('worst_case_interest_rate', from_basis_points(WORST_CASE_RATE))),
+            )
+        except (KeyError, TypeError, ArithmeticError) as e:
+            raise ValueError(f'Invalid policy: {e!r}') from e
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'slabs': [
+                {'min_score': slab.min_score, 'rate_floor': str(from_basis_points(slab.rate_floor))}
+                for slab in self.slabs
+            ],
+            'max_emi_to_salary_percent': self.max_emi_to_salary_percent,
+            'worst_case_interest_rate': str(from_basis_points(self.worst_case_rate)),
+        }
+
+    def proposed_emi(self, loan_amount: Paise, tenure) -> Paise:
+        """EMI of a requested loan for the cap check, at the worst-case rate"""
+        return calculate_emi(loan_amount, self.worst_case_rate, tenure)
+
+    def exceeds_emi_cap(self, total_emi: Paise, monthly_salary: Paise):
+        return exceeds_emi_cap(total_emi, monthly_salary, self.max_emi_to_salary_percent)
+
+    def emi_headroom(self, monthly_salary: Paise, total_emi: Paise) -> Paise:
+        return emi_headroom(monthly_salary, total_emi, self.max_emi_to_salary_percent)
+
+    def apply_interest_rate_slab(self, credit_score, rate: BasisPoints):
+        """Returns (approval, corrected_rate) for a requested rate in basis points"""
+        for slab in self.slabs:
+            if credit_score > slab.min_score:
+                return True, max(rate, slab.rate_floor)
+        return False, rate
+
+    def decide(self, credit_scores, rate: BasisPoints, total_emi, monthly_salary, proposed_emi: Paise):
+        """
+        Vectorised check-eligibility for many customers requesting the same
+        loan: arrays of approvals and corrected rates, from int64 arrays of
+        scores, current EMIs and salaries in paise
+        """
+        within_cap = (total_emi + proposed_emi) * 100 <= monthly_salary * self.max_emi_to_salary_percent
+        approved = np.zeros(len(credit_scores), dtype=bool)
+        corrected = np.full(len(credit_scores), rate, dtype=np.int64)
+        undecided = within_cap
+        for slab in self.slabs:
+            matched = undecided & (credit_scores > slab.min_score)
+            approved |= matched
+            corrected[matched] = max(rate, slab.rate_floor)
+            undecided = undecided & ~matched
+        return approved, corrected
+
+
+# The slabs documented under "Approval Rules" in the README
+CURRENT_POLICY = ScoringPolicy(
+    name='current',
+    slabs=(
+        RateSlab(50),
+        RateSlab(30, BasisPoints(1200)),
+        RateSlab(10, BasisPoints(1600)),
+    ),
+)
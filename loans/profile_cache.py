@@ -0,0 +1,291 @@
+"""
+Two-tier cache of customer profiles: the customer fields and loan aggregates
+that eligibility checks need.
+
+Tier 1 is a small LRU of compact records in each worker process, tier 2 is a
+shared Redis key per customer. Writers call invalidate_customers() after
+commit, which deletes the Redis keys and publishes the ids so every process
+drops its local copy.
+
+Invalidations also bump a per-customer generation counter in Redis. A miss
+reads the generation along with the profile key, and the profile it loads
+from the database is only written back if the generation is unchanged, so a
+load that raced an invalidation can't store the data it made stale.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from .models import Customer, Loan
+from .money import to_paise
+from .redis_client import get_redis
+from .sharding import shard_for_customer
+from .utils import credit_score_from_inputs, loan_score_inputs
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the CustomerProfile encoding changes
+KEY_PREFIX = 'customer-profile:v2:'
+GENERATION_PREFIX = 'customer-profile-generation:'
+INVALIDATION_CHANNEL = 'customer-profile-invalidations'
+# Ids per invalidation message / DEL command during bulk invalidation
+INVALIDATION_BATCH_SIZE = 500
+# SET KEYS[1] to ARGV[2] for ARGV[3] seconds if the generation in KEYS[2] is still ARGV[1]
+SET_IF_CURRENT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+class CustomerProfile:
+    """
+    Customer fields and loan aggregates needed to score a loan request.
+    Money fields are integer paise (loans.money).
+    """
+    __slots__ = (
+        'id', 'customer_id', 'monthly_salary', 'approved_limit', 'current_debt',
+        'total_tenure', 'emis_paid_on_time', 'loan_count', 'current_year_loans',
+        'total_emi', 'year', 'cached_at',
+    )
+    MONEY_FIELDS = ('monthly_salary', 'approved_limit', 'current_debt', 'total_emi')
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values[field])
+        self.cached_at = time.monotonic()
+
+    @classmethod
+    def load(cls, customer_id):
+        """Build a profile from the customer's primary database, or None for unknown customers"""
+        # Read from the primary so a lagging replica can't refill the shared tier
+        # with data an invalidation has just removed
+        db = shard_for_customer(customer_id) or 'default'
+        customer = (Customer.objects.using(db)
+                    .filter(customer_id=customer_id)
+                    .values('id', 'customer_id', 'monthly_salary', 'approved_limit', 'current_debt')
+                    .first())
+        if customer is None:
+            return None
+        year = datetime.now().year
+        loans = loan_score_inputs(Loan.objects.using(db).filter(customer_id=customer['id']), year)
+        values = {**customer, **loans}
+        for field in cls.MONEY_FIELDS:
+            values[field] = to_paise(values[field])
+        return cls(year=year, **values)
+
+    def credit_score(self):
+        return credit_score_from_inputs(
+            self.current_debt, self.approved_limit, self.total_tenure,
+            self.emis_paid_on_time, self.loan_count, self.current_year_loans,
+        )
+
+    def dumps(self):
+        return json.dumps([getattr(self, field) for field in self.FIELDS], separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw):
+        return cls(**dict(zip(cls.FIELDS, json.loads(raw))))
+
+
+class TierStats:
+    __slots__ = ('hits', 'misses', 'errors')
+
+    def __init__(self):
+        self.hits = self.misses = self.errors = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class LocalProfileCache:
+    """Per-process LRU bounded by entry count and entry age"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = TierStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, customer_id):
+        with self._lock:
+            profile = self._entries.get(customer_id)
+            if profile is not None and time.monotonic() - profile.cached_at > self.ttl:
+                del self._entries[customer_id]
+                profile = None
+            if profile is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(customer_id)
+            self.stats.hits += 1
+            return profile
+
+    def set(self, profile):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[profile.customer_id] = profile
+            self._entries.move_to_end(profile.customer_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, customer_ids):
+        with self._lock:
+            for customer_id in customer_ids:
+                self._entries.pop(customer_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LocalProfileCache(settings.CUSTOMER_CACHE_LOCAL_SIZE, settings.CUSTOMER_CACHE_LOCAL_TTL)
+redis_stats = TierStats()
+_subscriber = None
+_subscriber_lock = threading.Lock()
+
+
+def _listen_for_invalidations():
+    """Drop local entries named in invalidation messages, reconnecting forever"""
+    # A dedicated connection: the shared client's short timeouts don't suit a
+    # blocking subscription
+    client = redis.Redis.from_url(settings.REDIS_URL, health_check_interval=30)
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Messages may have been missed while disconnected
+            local_cache.clear()
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    local_cache.discard(int(i) for i in message['data'].split(b','))
+        except Exception:
+            logger.warning('Customer profile invalidation subscription lost, retrying', exc_info=True)
+            local_cache.clear()
+            time.sleep(1)
+
+
+def _ensure_subscriber():
+    """Start the invalidation listener lazily, so it runs in each forked worker"""
+    global _subscriber
+    if _subscriber is not None and _subscriber.is_alive():
+        return
+    with _subscriber_lock:
+        if _subscriber is None or not _subscriber.is_alive():
+            _subscriber = threading.Thread(
+                target=_listen_for_invalidations, name='profile-cache-invalidations', daemon=True,
+            )
+            _subscriber.start()
+
+
+def get_customer_profile(customer_id):
+    """
+    Profile of a customer from the local tier, then Redis, then the database.
+    Returns None for unknown customers.
+    """
+    if not settings.CUSTOMER_CACHE_ENABLED:
+        return CustomerProfile.load(customer_id)
+
+    year = datetime.now().year
+    profile = local_cache.get(customer_id)
+    if profile is not None and profile.year == year:
+        return profile
+
+    client = get_redis()
+    generation = None
+    if client is not None:
+        _ensure_subscriber()
+        try:
+            raw, generation = client.mget(f'{KEY_PREFIX}{customer_id}', f'{GENERATION_PREFIX}{customer_id}')
+        except redis.RedisError:
+            redis_stats.errors += 1
+            raw = None
+        else:
+            generation = (generation or b'0').decode()
+            if raw is None:
+                redis_stats.misses += 1
+            else:
+                redis_stats.hits += 1
+                profile = CustomerProfile.loads(raw)
+                if profile.year == year:
+                    local_cache.set(profile)
+                    return profile
+
+    profile = CustomerProfile.load(customer_id)
+    if profile is None:
+        return None
+    if generation is not None:
+        try:
+            stored = client.register_script(SET_IF_CURRENT)(
+                keys=[f'{KEY_PREFIX}{customer_id}', f'{GENERATION_PREFIX}{customer_id}'],
+                args=[generation, profile.dumps(), settings.CUSTOMER_CACHE_REDIS_TTL],
+            )
+        except redis.RedisError:
+            redis_stats.errors += 1
+        else:
+            if not stored:
+                # Invalidated since the lookup; the profile may predate the write
+                return profile
+    local_cache.set(profile)
+    return profile
+
+
+def invalidate_customers(customer_ids, using=None):
+    """
+    Drop cached profiles in every tier and process once the current
+    transaction on the `using` database commits
+    """
+    customer_ids = sorted({int(customer_id) for customer_id in customer_ids})
+    if customer_ids:
+        transaction.on_commit(lambda: _invalidate(customer_ids), using=using)
+
+
+def _invalidate(customer_ids):
+    local_cache.discard(customer_ids)
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        for start in range(0, len(customer_ids), INVALIDATION_BATCH_SIZE):
+            batch = customer_ids[start:start + INVALIDATION_BATCH_SIZE]
+            pipeline = client.pipeline(transaction=False)
+            pipeline.delete(*(f'{KEY_PREFIX}{customer_id}' for customer_id in batch))
+            for customer_id in batch:
+                pipeline.incr(f'{GENERATION_PREFIX}{customer_id}')
+                # Only loads still in flight need the generation
+                pipeline.expire(f'{GENERATION_PREFIX}{customer_id}', settings.CUSTOMER_CACHE_REDIS_TTL)
+            pipeline.publish(INVALIDATION_CHANNEL, ','.join(map(str, batch)))
+            pipeline.execute()
+    except redis.RedisError:
+        # Remaining entries expire after CUSTOMER_CACHE_LOCAL_TTL / CUSTOMER_CACHE_REDIS_TTL
+        redis_stats.errors += 1
+        logger.warning('Could not invalidate %d customer profiles in Redis', len(customer_ids), exc_info=True)
+
+
+def cache_stats():
+    """Hit rates and sizes of both tiers as seen by this process"""
+    return {
+        'local': {**local_cache.stats.as_dict(), 'entries': len(local_cache), 'max_entries': local_cache.max_entries},
+        'redis': redis_stats.as_dict(),
+    }
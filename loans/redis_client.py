@@ -0,0 +1,22 @@
+import redis
+from django.conf import settings
+
+
+_client = None
+
+
+def get_redis():
+    """
+    Shared Redis client for request-path features, or None when REDIS_URL is
+    not configured. Timeouts are short so a slow Redis can't stall requests.
+    """
+    global _client
+    if not settings.REDIS_URL:
+        return None
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        )
+    return _client
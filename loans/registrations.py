@@ -0,0 +1,136 @@
+"""
+Customer registration writes, one at a time or group-committed.
+
+With REGISTER_GROUP_COMMIT on, registrations that reach a worker process
+within REGISTER_BATCH_WINDOW_MS of each other are written together. The
+first request of a window waits for it to close, or for
+REGISTER_BATCH_MAX_SIZE requests to queue up, then inserts the whole batch
+with one multi-row INSERT ... RETURNING per shard in a single transaction
+and hands every waiting request its own customer. Only requests served
+concurrently by one process can share a batch, so gunicorn needs
+GUNICORN_THREADS > 1.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, router, transaction
+
+from .models import Customer
+from .money import from_paise, round_nearest_lakh, to_paise
+from .sharding import next_customer_id, shard_for_customer
+
+
+# Registrations hold this transaction-level advisory lock on the default
+# database while they pick customer_ids and insert. Writers that don't take
+# it (ingestion) can still collide, and the losers retry.
+CUSTOMER_ID_LOCK = 0x637573746f6d6572
+CUSTOMER_ID_ATTEMPTS = 5
+
+
+def new_customer(customer_id, registration):
+    """An unsaved Customer for validated CustomerRegistrationSerializer data"""
+    return Customer(
+        customer_id=customer_id,
+        first_name=registration['first_name'],
+        last_name=registration['last_name'],
+        age=registration['age'],
+        phone_number=registration['phone_number'],
+        monthly_salary=registration['monthly_income'],
+        approved_limit=from_paise(round_nearest_lakh(36 * to_paise(registration['monthly_income']))),
+        current_debt=Decimal('0.00'),
+    )
+
+
+def create_customers(registrations):
+    """
+    Save customers for a list of registrations with consecutive new
+    customer_ids, in one transaction per shard, and return them in order
+    """
+    for _ in range(CUSTOMER_ID_ATTEMPTS):
+        try:
+            # Nested so that a collision on any shard rolls back every shard
+            with ExitStack() as stack:
+                stack.enter_context(transaction.atomic(using=DEFAULT_DB_ALIAS))
+                _lock_customer_ids()
+                first_id = next_customer_id()
+                customers = [new_customer(first_id + i, registration)
+                             for i, registration in enumerate(registrations)]
+                by_shard = {}
+                for customer in customers:
+                    by_shard.setdefault(shard_for_customer(customer.customer_id), []).append(customer)
+                for shard in by_shard:
+                    stack.enter_context(transaction.atomic(using=shard))
+                for shard, shard_customers in by_shard.items():
+                    Customer.objects.using(shard).bulk_create(shard_customers)
+        except IntegrityError:
+            continue
+        return customers
+    raise IntegrityError(f'Could not allocate customer_ids after {CUSTOMER_ID_ATTEMPTS} attempts')
+
+
+def _lock_customer_ids():
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CUSTOMER_ID_LOCK])
+
+
+class RegistrationBatcher:
+    """Collects concurrent registrations in a process into group-committed batches"""
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._full = threading.Condition(self._lock)
+
+    def register(self, registration):
+        """Save a registration with the rest of its batch and return its Customer"""
+        future = Future()
+        with self._lock:
+            self._pending.append((registration, future))
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_size:
+                self._full.notify()
+        if leader:
+            self._write_batch()
+        customer = future.result()
+        # Routing state is per thread, and followers' customers were written by
+        # the leader: pin this request's client to the primary itself
+        router.db_for_write(Customer)
+        return customer
+
+    def _write_batch(self):
+        deadline = time.monotonic() + self.window
+        with self._lock:
+            while len(self._pending) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._full.wait(remaining)
+            # Requests arriving from here on start the next batch
+            batch, self._pending = self._pending, []
+
+        try:
+            customers = create_customers([registration for registration, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), customer in zip(batch, customers):
+                future.set_result(customer)
+
+
+batcher = RegistrationBatcher(settings.REGISTER_BATCH_WINDOW_MS / 1000, settings.REGISTER_BATCH_MAX_SIZE)
+
+
+def register_customer(registration):
+    """Save a validated registration, group-committed when REGISTER_GROUP_COMMIT is on"""
+    if settings.REGISTER_GROUP_COMMIT:
+        return batcher.register(registration)
+    return create_customers([registration])[0]
@@ -0,0 +1,222 @@
+"""
+Set-based posting of EMI repayments.
+
+Each entry is (loan_id, emis_paid, on_time). A batch is passed to
+PostgreSQL as three arrays and applied with one statement: payments are summed per loan, capped at the EMIs the loan has
+left, added to emis_paid_on_time or emis_paid_late, and the principal they
+repay comes off the customer's current_debt.
+
+Principal is repaid straight-line: after k of N EMIs a loan has repaid
+round(loan_amount * k / N, 2) (money.outstanding_principal). create-loan adds
+a loan's loan_amount to current_debt and ingestion adds what the loan's past
+EMIs haven't repaid, so current_debt is always the principal outstanding on
+the customer's loans and a fully paid loan has removed exactly what it added.
+
+When customers are sharded (loans.sharding), entries are split by the shard
+of their loan and each shard's batches are applied in its own transactions.
+
+Every batch commits together with a RepaymentBatch row keyed by the
+client's idempotency key, the shard and the batch number. A retried request
+or a redelivered task with the same key and entries skips the batches that
+were already applied and reports their recorded results.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import outbox
+from .models import Customer, Loan, RepaymentBatch
+from .sharding import is_sharded, loan_customers, shard_for_customer
+
+
+POST_REPAYMENTS_SQL = """
+WITH batch AS (
+    SELECT loan_id, SUM(on_time) AS on_time, SUM(late) AS late
+    FROM unnest(%s::integer[], %s::integer[], %s::integer[]) AS entries (loan_id, on_time, late)
+    GROUP BY loan_id
+),
+applied AS (
+    SELECT l.id, l.start_date, l.loan_id, l.customer_id, l.loan_amount, l.tenure,
+           l.emis_paid_on_time + l.emis_paid_late AS paid_before,
+           LEAST(b.on_time, remaining) AS on_time,
+           LEAST(b.late, remaining - LEAST(b.on_time, remaining)) AS late
+    FROM loan l
+    JOIN batch b ON b.loan_id = l.loan_id
+    CROSS JOIN LATERAL (
+        SELECT GREATEST(l.tenure - l.emis_paid_on_time - l.emis_paid_late, 0) AS remaining
+    ) r
+    -- Concurrent batches lock shared loans in the same order
+    ORDER BY l.id
+    FOR UPDATE OF l
+),
+updated_loans AS (
+    UPDATE loan l
+    SET emis_paid_on_time = l.emis_paid_on_time + a.on_time,
+        emis_paid_late = l.emis_paid_late + a.late,
+        version = l.version + 1,
+        updated_at = now()
+    FROM applied a
+    WHERE l.id = a.id AND l.start_date = a.start_date AND a.on_time + a.late > 0
+    RETURNING a.customer_id, a.on_time + a.late AS emis,
+              ROUND(a.loan_amount * (a.paid_before + a.on_time + a.late) / a.tenure, 2)
+              - ROUND(a.loan_amount * a.paid_before / a.tenure, 2) AS principal
+),
+updated_customers AS (
+    UPDATE customer c
+    SET current_debt = c.current_debt - d.principal,
+        version = c.version + 1,
+        updated_at = now()
+    FROM (
+        SELECT customer_id, SUM(principal) AS principal FROM updated_loans GROUP BY customer_id
+    ) d
+    WHERE c.id = d.customer_id
+    RETURNING c.customer_id
+)
+SELECT
+    (SELECT COUNT(*) FROM updated_loans),
+    (SELECT COALESCE(SUM(emis), 0)::bigint FROM updated_loans),
+    (SELECT COALESCE(SUM(principal), 0) FROM updated_loans),
+    (SELECT array_agg(customer_id) FROM updated_customers),
+    (SELECT array_agg(loan_id) FROM batch b WHERE NOT EXISTS (SELECT 1 FROM applied a WHERE a.loan_id = b.loan_id))
+"""
+
+
+def _repaid(loan_amount, tenure, emis):
+    return (loan_amount * emis / tenure).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def _post_batch_sql(entries, using):
+    loan_ids, on_time, late = [], [], []
+    for loan_id, emis_paid, paid_on_time in entries:
+        loan_ids.append(loan_id)
+        on_time.append(emis_paid if paid_on_time else 0)
+        late.append(0 if paid_on_time else emis_paid)
+    with connections[using].cursor() as cursor:
+        cursor.execute(POST_REPAYMENTS_SQL, [loan_ids, on_time, late])
+        loans, emis, principal, customer_ids, unknown = cursor.fetchone()
+    return loans, emis, principal, customer_ids or [], unknown or []
+
+
+def _post_batch_orm(entries, using):
+    """Portable equivalent of POST_REPAYMENTS_SQL for other databases"""
+    paid = defaultdict(lambda: [0, 0])
+    for loan_id, emis_paid, on_time in entries:
+        paid[loan_id][0 if on_time else 1] += emis_paid
+
+    loans = list(Loan.objects.using(using).select_for_update().filter(loan_id__in=paid))
+    repaid = defaultdict(Decimal)
+    updated = []
+    emis = 0
+    now = timezone.now()
+    for loan in loans:
+        remaining = max(loan.tenure - loan.emis_paid_on_time - loan.emis_paid_late, 0)
+        on_time = min(paid[loan.loan_id][0], remaining)
+        late = min(paid[loan.loan_id][1], remaining - on_time)
+        if on_time + late == 0:
+            continue
+        paid_before = loan.emis_paid_on_time + loan.emis_paid_late
+        repaid[loan.customer_id] += (_repaid(loan.loan_amount, loan.tenure, paid_before + on_time + late)
+                                     - _repaid(loan.loan_amount, loan.tenure, paid_before))
+        loan.emis_paid_on_time += on_time
+        loan.emis_paid_late += late
+        loan.version = F('version') + 1
+        loan.updated_at = now
+        emis += on_time + late
+        updated.append(loan)
+    Loan.objects.using(using).bulk_update(updated, ['emis_paid_on_time', 'emis_paid_late', 'version', 'updated_at'])
+
+    customers = list(Customer.objects.using(using).select_for_update().filter(pk__in=repaid))
+    for customer in customers:
+        customer.current_debt -= repaid[customer.pk]
+        customer.version = F('version') + 1
+        customer.updated_at = now
+    Customer.objects.using(using).bulk_update(customers, ['current_debt', 'version', 'updated_at'])
+
+    unknown = sorted(set(paid) - {loan.loan_id for loan in loans})
+    return len(updated), emis, sum(repaid.values(), Decimal('0.00')), [c.customer_id for c in customers], unknown
+
+
+def _split_by_shard(entries):
+    """
+    {alias: entries} by the shard of each entry's loan, and the loan ids
+    missing from the loan index
+    """
+    if not is_sharded():
+        return {DEFAULT_DB_ALIAS: entries}, []
+    customers = loan_customers({entry[0] for entry in entries})
+    by_shard = defaultdict(list)
+    unknown = set()
+    for entry in entries:
+        customer_id = customers.get(entry[0])
+        if customer_id is None:
+            unknown.add(entry[0])
+        else:
+            by_shard[shard_for_customer(customer_id)].append(entry)
+    return by_shard, sorted(unknown)
+
+
+def _post_batch_once(entries, using, key):
+    """
+    Apply a batch unless its key is recorded. Returns the batch's results
+    and whether it was applied now.
+    """
+    recorded = RepaymentBatch.objects.using(using).filter(key=key).values_list('results', flat=True).first()
+    if recorded is not None:
+        return recorded, False
+    post_batch = _post_batch_sql if connections[using].vendor == 'postgresql' else _post_batch_orm
+    try:
+        with transaction.atomic(using=using):
+            loans, emis, principal, customer_ids, unknown = post_batch(entries, using)
+            if customer_ids:
+                outbox.publish(outbox.REPAYMENTS_POSTED, {'customer_ids': sorted(customer_ids)}, using=using)
+            results = {'loans_updated': loans, 'emis_applied': emis,
+                       'principal_repaid': str(principal), 'unknown_loan_ids': unknown}
+            # A concurrent retry of the same batch fails here and rolls back
+            RepaymentBatch.objects.using(using).create(key=key, results=results)
+    except IntegrityError:
+        return RepaymentBatch.objects.using(using).get(key=key).results, False
+    return results, True
+
+
+def post_repayments(entries, idempotency_key, batch_size=None):
+    """
+    Apply (loan_id, emis_paid, on_time) entries in batches of
+    REPAYMENT_BATCH_SIZE, one transaction per batch, skipping batches already
+    applied under idempotency_key. Returns totals and the loan ids that don't
+    exist.
+    """
+    batch_size = batch_size or settings.REPAYMENT_BATCH_SIZE
+    by_shard, unknown_loan_ids = _split_by_shard(entries)
+    results = {
+        'entries': len(entries),
+        'loans_updated': 0,
+        'emis_applied': 0,
+        'principal_repaid': Decimal('0.00'),
+        'unknown_loan_ids': unknown_loan_ids,
+        'batches_already_applied': 0,
+    }
+    for using, shard_entries in by_shard.items():
+        for number, start in enumerate(range(0, len(shard_entries), batch_size)):
+            batch, applied = _post_batch_once(
+                shard_entries[start:start + batch_size], using, f'{idempotency_key}:{using}:{number}'
+            )
+            results['loans_updated'] += batch['loans_updated']
+            results['emis_applied'] += batch['emis_applied']
+            results['principal_repaid'] += Decimal(batch['principal_repaid'])
+            results['unknown_loan_ids'].extend(batch['unknown_loan_ids'])
+            results['batches_already_applied'] += not applied
+    results['unknown_loan_ids'].sort()
+    return results
+
+
+def purge_applied_batches(older_than=None, using=None):
+    """Delete batch records older than REPAYMENT_KEY_RETENTION_DAYS"""
+    older_than = older_than or timezone.now() - timedelta(days=settings.REPAYMENT_KEY_RETENTION_DAYS)
+    deleted, _ = (RepaymentBatch.objects.using(using or DEFAULT_DB_ALIAS)
+                  .filter(created_at__lt=older_than).delete())
+    return deleted
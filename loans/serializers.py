@@ -1,7 +1,9 @@
+from django.conf import settings
 from rest_framework import serializers
-from decimal import Decimal
-from .models import Customer, Loan
-from .utils import round_nearest_lakh
+from django.utils import timezone
+from .ingest_jobs import stage_stats
+from .models import Customer, IngestionJob, Loan
+from .registrations import register_customer
 
 
 class CustomerRegistrationSerializer(serializers.Serializer):
@@ -12,24 +14,7 @@ class CustomerRegistrationSerializer(serializers.Serializer):
     phone_number = serializers.CharField(max_length=15)
 
     def create(self, validated_data):
-        # Generate customer_id (you might want to use a different strategy in production)
-        last_customer = Customer.objects.order_by('-customer_id').first()
-        customer_id = (last_customer.customer_id + 1) if last_customer else 1
-        
-        # Calculate approved limit
-        approved_limit = round_nearest_lakh(36 * validated_data['monthly_income'])
-        
-        customer = Customer.objects.create(
-            customer_id=customer_id,
-            first_name=validated_data['first_name'],
-            last_name=validated_data['last_name'],
-            age=validated_data['age'],
-            phone_number=validated_data['phone_number'],
-            monthly_salary=validated_data['monthly_income'],
-            approved_limit=approved_limit,
-            current_debt=Decimal('0.00')
-        )
-        return customer
+        return register_customer(validated_data)
 
 
 class CustomerRegistrationResponseSerializer(serializers.ModelSerializer):
@@ -75,6 +60,26 @@ class CreateLoanResponseSerializer(serializers.Serializer):
     monthly_installment = serializers.DecimalField(max_digits=10, decimal_places=2)
 
 
+class LoanOffersSerializer(serializers.Serializer):
+    customer_id = serializers.IntegerField()
+    interest_rate = serializers.DecimalField(max_digits=5, decimal_places=2, min_value=0)
+
+
+class LoanOfferSerializer(serializers.Serializer):
+    tenure = serializers.IntegerField()
+    max_loan_amount = serializers.DecimalField(max_digits=12, decimal_places=2)
+    monthly_installment = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+
+class LoanOffersResponseSerializer(serializers.Serializer):
+    customer_id = serializers.IntegerField()
+    approval = serializers.BooleanField()
+    interest_rate = serializers.DecimalField(max_digits=5, decimal_places=2)
+    corrected_interest_rate = serializers.DecimalField(max_digits=5, decimal_places=2)
+    available_monthly_installment = serializers.DecimalField(max_digits=12, decimal_places=2)
+    offers = LoanOfferSerializer(many=True)
+
+
 class CustomerDetailSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source='customer_id')
 
@@ -101,4 +106,67 @@ class CustomerLoansSerializer(serializers.ModelSerializer):
         fields = ['loan_id', 'loan_amount', 'interest_rate', 'monthly_installment', 'repayments_left']
 
     def get_repayments_left(self, obj):
-        return max(0, obj.tenure - obj.emis_paid_on_time)
+        return obj.repayments_left
+
+
+class CustomerLoansBatchSerializer(serializers.Serializer):
+    customer_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_customer_ids(self, value):
+        if len(value) > settings.LOAN_BATCH_MAX_CUSTOMERS:
+            raise serializers.ValidationError(
+                f'At most {settings.LOAN_BATCH_MAX_CUSTOMERS} customers per request'
+            )
+        return sorted(set(value))
+
+
+class BulkRepaymentSerializer(serializers.Serializer):
+    # Entries are checked in validate_repayments rather than by a nested
+    # serializer, which is too slow for files of this size
+    # Retries must reuse the key and resend the same entries in the same order
+    idempotency_key = serializers.CharField(max_length=100)
+    repayments = serializers.ListField(child=serializers.DictField(), allow_empty=False)
+
+    def validate_repayments(self, value):
+        if len(value) > settings.REPAYMENT_MAX_ENTRIES:
+            raise serializers.ValidationError(
+                f'At most {settings.REPAYMENT_MAX_ENTRIES} repayments per request'
+            )
+        entries = []
+        for index, entry in enumerate(value):
+            loan_id, emis_paid, on_time = entry.get('loan_id'), entry.get('emis_paid'), entry.get('on_time')
+            if (type(loan_id) is not int or not 0 < loan_id < 2 ** 31
+                    or type(emis_paid) is not int or not 1 <= emis_paid <= 120
+                    or type(on_time) is not bool):
+                raise serializers.ValidationError(
+                    f'Entry {index}: expected a loan_id, emis_paid between 1 and 120 and a boolean on_time'
+                )
+            entries.append((loan_id, emis_paid, on_time))
+        return entries
+
+
+class BulkRepaymentResponseSerializer(serializers.Serializer):
+    entries = serializers.IntegerField()
+    loans_updated = serializers.IntegerField()
+    emis_applied = serializers.IntegerField()
+    principal_repaid = serializers.DecimalField(max_digits=16, decimal_places=2)
+    unknown_loan_ids = serializers.ListField(child=serializers.IntegerField())
+    batches_already_applied = serializers.IntegerField()
+
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    stages = serializers.SerializerMethodField()
+    seconds_since_update = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestionJob
+        fields = ['task_id', 'status', 'stage', 'stages', 'results', 'created_at', 'started_at',
+                  'finished_at', 'updated_at', 'seconds_since_update']
+
+    def get_stages(self, obj):
+        now = timezone.now()
+        return {stage: stage_stats(counts, now) for stage, counts in obj.progress.items()}
+
+    def get_seconds_since_update(self, obj):
+        # A running job that stops updating has stalled
+        return round((timezone.now() - obj.updated_at).total_seconds(), 3)
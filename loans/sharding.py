@@ -0,0 +1,163 @@
+"""
+Hash sharding of customers and their loans across DATABASE_SHARDS.
+
+A customer and all of its loans live on the shard picked by hashing its
+customer_id. Loans are found by loan_id through LoanIndex, a loan_id ->
+customer_id table on the default database that also keeps loan_ids unique
+across shards.
+
+With a single shard (the default) the shard helpers return None, so
+`.using(shard)` falls through to the normal routers and read replicas.
+"""
+import zlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Max
+
+from .models import Customer, Loan, LoanIndex
+
+
+# Customer ids hash into SHARD_BUCKETS buckets and each shard owns a
+# contiguous range of buckets
+SHARD_BUCKETS = 4096
+SHARDED_MODELS = (Customer, Loan)
+LOOKUP_BATCH_SIZE = 10000
+LOAN_ID_ATTEMPTS = 5
+
+
+def is_sharded():
+    return len(settings.DATABASE_SHARDS) > 1
+
+
+def shard_bucket(customer_id):
+    return zlib.crc32(str(int(customer_id)).encode()) % SHARD_BUCKETS
+
+
+def shard_for_customer(customer_id):
+    """Database alias holding a customer and its loans, or None when unsharded"""
+    if not is_sharded():
+        return None
+    shards = settings.DATABASE_SHARDS
+    return shards[shard_bucket(customer_id) * len(shards) // SHARD_BUCKETS]
+
+
+def shard_aliases():
+    """Every shard alias, or [None] when unsharded"""
+    return list(settings.DATABASE_SHARDS) if is_sharded() else [None]
+
+
+def loan_customers(loan_ids):
+    """{loan_id: customer_id} for the indexed loans among loan_ids"""
+    loan_ids = list(loan_ids)
+    customers = {}
+    for start in range(0, len(loan_ids), LOOKUP_BATCH_SIZE):
+        customers.update(
+            LoanIndex.objects.using(DEFAULT_DB_ALIAS)
+            .filter(loan_id__in=loan_ids[start:start + LOOKUP_BATCH_SIZE])
+            .values_list('loan_id', 'customer_id')
+        )
+    return customers
+
+
+def shard_for_loan(loan_id):
+    """
+    Database alias holding a loan, or None when unsharded.
+    Raises Loan.DoesNotExist for loans missing from the index.
+    """
+    if not is_sharded():
+        return None
+    customer_id = loan_customers([loan_id]).get(loan_id)
+    if customer_id is None:
+        raise Loan.DoesNotExist(f'Loan {loan_id} is not in the loan index')
+    return shard_for_customer(customer_id)
+
+
+def next_customer_id():
+    """One past the largest customer_id on any shard"""
+    largest = [
+        Customer.objects.using(alias).aggregate(largest=Max('customer_id'))['largest'] or 0
+        for alias in shard_aliases()
+    ]
+    return max(largest) + 1
+
+
+def allocate_loan_id(customer_id):
+    """
+    Reserve a new loan_id for a customer's loan. When sharded the id is
+    claimed in LoanIndex first, so concurrent requests on different shards
+    can't both take it.
+    """
+    if not is_sharded():
+        last_loan = Loan.objects.order_by('-loan_id').first()
+        return (last_loan.loan_id + 1) if last_loan else 1
+
+    for _ in range(LOAN_ID_ATTEMPTS):
+        index = LoanIndex.objects.using(DEFAULT_DB_ALIAS)
+        loan_id = (index.aggregate(largest=Max('loan_id'))['largest'] or 0) + 1
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                index.create(loan_id=loan_id, customer_id=customer_id)
+        except IntegrityError:
+            continue
+        return loan_id
+    raise IntegrityError(f'Could not allocate a loan_id after {LOAN_ID_ATTEMPTS} attempts')
+
+
+def release_loan_ids(loan_ids):
+    """
+    Drop the LoanIndex entries of loan_ids claimed by allocate_loan_id or
+    index_loans whose loans were never written, so the index doesn't point at
+    missing loans
+    """
+    if is_sharded():
+        LoanIndex.objects.using(DEFAULT_DB_ALIAS).filter(loan_id__in=list(loan_ids)).delete()
+
+
+def index_loans(pairs):
+    """Record (loan_id, customer_id) pairs in LoanIndex, keeping existing entries"""
+    if is_sharded():
+        LoanIndex.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            [LoanIndex(loan_id=loan_id, customer_id=customer_id) for loan_id, customer_id in pairs],
+            batch_size=LOOKUP_BATCH_SIZE, ignore_conflicts=True,
+        )
+
+
+class ShardRouter:
+    """
+    Keeps customers and loans on the database of the instance they're
+    accessed through (related managers, saves of loaded rows); new customers
+    go to their shard and new loans to their customer's. Unhinted
+    queries must pick their shard with .using(); anything else falls through
+    to PrimaryReplicaRouter.
+    """
+
+    def _instance_db(self, model, hints):
+        if model not in SHARDED_MODELS or not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if isinstance(instance, Customer) and instance.customer_id is not None:
+            return shard_for_customer(instance.customer_id)
+        if isinstance(instance, Loan) and Loan.customer.is_cached(instance):
+            return instance.customer._state.db
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._instance_db(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._instance_db(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded() and isinstance(obj1, SHARDED_MODELS) and isinstance(obj2, SHARDED_MODELS):
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name == 'loanindex' and db != DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -1,133 +1,279 @@
 from celery import shared_task
-import pandas as pd
+from django.conf import settings
 import os
+import uuid
 from decimal import Decimal
-from datetime import datetime
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, DecimalField, F, Value, When
 from django.utils import timezone
-from .models import Customer, Loan
+from .models import Customer, IngestionError, Loan, LoanIndex
+from .partitioning import ensure_loan_partitions
+from .profile_cache import invalidate_customers
+from . import outbox, repayments
+from .ingest_jobs import JobProgress
+from .money import from_basis_points, from_paise, outstanding_principal
+from . import sharding
 
 
-@shared_task
-def ingest_excel_data():
+LOOKUP_BATCH_SIZE = 10000
+
+
+def _existing(queryset, field, values, *fields):
+    """values_list rows of queryset whose `field` is in values, looked up in batches"""
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), LOOKUP_BATCH_SIZE):
+        batch = values[start:start + LOOKUP_BATCH_SIZE]
+        rows.extend(queryset.filter(**{f'{field}__in': batch}).values_list(*fields))
+    return rows
+
+
+def _chunks(df):
+    """Consecutive slices of at most INGEST_CHUNK_SIZE rows"""
+    for start in range(0, len(df), settings.INGEST_CHUNK_SIZE):
+        yield df.iloc[start:start + settings.INGEST_CHUNK_SIZE]
+
+
+def _by_shard(df, column):
+    """(alias, rows) pairs splitting a frame by the shard of its customer ids"""
+    if not sharding.is_sharded():
+        return [(None, df)]
+    shards = df[column].astype(int).map(sharding.shard_for_customer)
+    return [(alias, df[shards == alias]) for alias in settings.DATABASE_SHARDS if (shards == alias).any()]
+
+
+@shared_task(bind=True)
+def ingest_excel_data(self):
     """
-    Celery task to ingest customer and loan data from Excel files
+    Celery task to ingest customer and loan data from Excel files.
+    Rows are validated column-wise; rejected rows go to the ingestion_error
+    table and the task result only holds counts and a pointer to them.
+    Customers and loans are written to the shard of their customer in
+    chunks of INGEST_CHUNK_SIZE rows, and progress is recorded on the
+    IngestionJob after each chunk.
     """
-    data_dir = '/app/data'
+    data_dir = settings.INGEST_DATA_DIR
     customer_file = os.path.join(data_dir, 'customer_data.xlsx')
     loan_file = os.path.join(data_dir, 'loan_data.xlsx')
+    task_id = self.request.id or uuid.uuid4().hex
+    progress = JobProgress(self, task_id)
+    
+    # pandas/openpyxl are only imported when ingesting, keeping worker and
+    # management command start-up light
+    import pandas as pd
+    from .ingestion import (
+        loan_customer_ids, record_errors, validate_customers, validate_loans
+    )
     
     results = {
         'customers_created': 0,
         'customers_updated': 0,
         'loans_created': 0,
-        'errors': []
+        'rows_rejected': 0,
+        'error_report': {'table': IngestionError._meta.db_table, 'task_id': task_id},
     }
     
     try:
         # Process customer data
         if os.path.exists(customer_file):
+            progress.start_stage('customers')
             customer_df = pd.read_excel(customer_file)
+            progress.add(rows_read=len(customer_df))
+            customers, rejected = validate_customers(customer_df)
+            record_errors(task_id, 'customer', rejected)
+            results['rows_rejected'] += len(rejected)
+            progress.add(rows_validated=len(customers), rows_rejected=len(rejected))
             
-            # Expected columns: customer_id, first_name, last_name, age, phone_number, monthly_salary, approved_limit, current_debt
-            customers_to_create = []
-            customers_to_update = []
-            
-            for index, row in customer_df.iterrows():
-                try:
-                    customer_data = {
-                        'customer_id': int(row.get('Customer ID', 0)),
-                        'first_name': str(row.get('First Name', '')),
-                        'last_name': str(row.get('Last Name', '')),
-                        'age': int(row.get('Age', 0)),
-                        'phone_number': str(row.get('Phone Number', '')),
-                        'monthly_salary': Decimal(str(row.get('Monthly Salary', 0))),
-                        'approved_limit': Decimal(str(row.get('Approved Limit', 0))),
-                        'current_debt': Decimal('0'),  # Set to 0 initially
-                    }
-                    
-                    # Check if customer exists
-                    try:
-                        customer = Customer.objects.get(customer_id=customer_data['customer_id'])
-                        # Update existing customer
-                        for key, value in customer_data.items():
-                            setattr(customer, key, value)
-                        customers_to_update.append(customer)
-                    except Customer.DoesNotExist:
-                        # Create new customer
-                        customers_to_create.append(Customer(**customer_data))
-                
-                except Exception as e:
-                    results['errors'].append(f"Error processing customer row {index}: {str(e)}")
-            
-            # Bulk create/update customers
-            if customers_to_create:
-                Customer.objects.bulk_create(customers_to_create, ignore_conflicts=True)
-                results['customers_created'] = len(customers_to_create)
-            
-            if customers_to_update:
-                Customer.objects.bulk_update(
-                    customers_to_update,
-                    ['first_name', 'last_name', 'age', 'phone_number', 'monthly_salary', 'approved_limit', 'current_debt']
-                )
-                results['customers_updated'] = len(customers_to_update)
+            for shard, shard_customers in _by_shard(customers, 'customer_id'):
+                for chunk in _chunks(shard_customers):
+                    created, updated = _save_customers(shard, chunk)
+                    results['customers_created'] += created
+                    results['customers_updated'] += updated
+                    progress.add(rows_written=created + updated)
+            progress.finish_stage()
         
         # Process loan data
         if os.path.exists(loan_file):
+            progress.start_stage('loans')
             loan_df = pd.read_excel(loan_file)
+            progress.add(rows_read=len(loan_df))
             
-            # Expected columns: loan_id, customer_id, loan_amount, tenure, interest_rate, monthly_repayment, emis_paid_on_time, start_date, end_date
-            loans_to_create = []
+            # Orphan loans are found by set difference against known customers
+            wanted = loan_customer_ids(loan_df)
+            customer_ids = {}
+            for shard in sharding.shard_aliases():
+                customer_ids.update(_existing(Customer.objects.using(shard), 'customer_id', wanted,
+                                              'customer_id', 'id'))
+            loans, rejected = validate_loans(loan_df, customer_ids.keys())
+            record_errors(task_id, 'loan', rejected)
+            results['rows_rejected'] += len(rejected)
             
-            for index, row in loan_df.iterrows():
-                try:
-                    customer_id = int(row.get('Customer ID', 0))
-                    
-                    # Get customer
-                    try:
-                        customer = Customer.objects.get(customer_id=customer_id)
-                    except Customer.DoesNotExist:
-                        results['errors'].append(f"Customer with ID {customer_id} not found for loan row {index}")
-                        continue
-                    
-                    # Parse dates
-                    start_date = row.get('Date of Approval')
-                    end_date = row.get('End Date')
-                    
-                    if isinstance(start_date, str):
-                        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-                    elif hasattr(start_date, 'date'):
-                        start_date = start_date.date()
-                    
-                    if isinstance(end_date, str):
-                        end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-                    elif hasattr(end_date, 'date'):
-                        end_date = end_date.date()
-                    
-                    loan_data = {
-                        'loan_id': int(row.get('Loan ID', 0)),
-                        'customer': customer,
-                        'loan_amount': Decimal(str(row.get('Loan Amount', 0))),
-                        'tenure': int(row.get('Tenure', 0)),
-                        'interest_rate': Decimal(str(row.get('Interest Rate', 0))),
-                        'monthly_repayment': Decimal(str(row.get('Monthly payment', 0))),
-                        'emis_paid_on_time': int(row.get('EMIs paid on Time', 0)),
-                        'start_date': start_date,
-                        'end_date': end_date,
-                    }
-                    
-                    # Check if loan exists
-                    if not Loan.objects.filter(loan_id=loan_data['loan_id']).exists():
-                        loans_to_create.append(Loan(**loan_data))
-                
-                except Exception as e:
-                    results['errors'].append(f"Error processing loan row {index}: {str(e)}")
+            # Existing loans are left untouched. loan_ids are unique across
+            # shards, so with sharding they're looked up in the loan index.
+            known_loans = LoanIndex.objects if sharding.is_sharded() else Loan.objects
+            existing = {row[0] for row in _existing(known_loans, 'loan_id', loans['loan_id'].astype(int), 'loan_id')}
+            is_new = ~loans['loan_id'].isin(existing)
+            progress.add(rows_validated=len(loans), rows_rejected=len(rejected), rows_skipped=(~is_new).sum())
+            loans = loans[is_new]
             
-            # Bulk create loans
-            if loans_to_create:
-                Loan.objects.bulk_create(loans_to_create, ignore_conflicts=True)
-                results['loans_created'] = len(loans_to_create)
+            for shard, shard_loans in _by_shard(loans, 'customer_id'):
+                # Give historical years their own partitions instead of
+                # filling the default one
+                ensure_loan_partitions(years=shard_loans['start_date'].dt.year.unique(), using=shard or 'default')
+                for chunk in _chunks(shard_loans):
+                    created = _save_loans(shard, chunk, customer_ids)
+                    results['loans_created'] += created
+                    progress.add(rows_written=created)
+            progress.finish_stage()
     
     except Exception as e:
-        results['errors'].append(f"General error: {str(e)}")
+        results['error'] = f"General error: {str(e)}"[:500]
+    
+    progress.finish(results)
+    return results
+
+
+def _save_customers(shard, customers):
+    """Create or update validated customer rows on one shard"""
+    existing = dict(_existing(Customer.objects.using(shard), 'customer_id', customers['customer_id'].astype(int),
+                              'customer_id', 'id'))
+    customers_to_create = []
+    customers_to_update = []
+    now = timezone.now()
+    
+    for row in customers.itertuples(index=False):
+        customer = Customer(
+            id=existing.get(int(row.customer_id)),
+            customer_id=int(row.customer_id),
+            first_name=row.first_name,
+            last_name=row.last_name,
+            age=int(row.age),
+            phone_number=row.phone_number,
+            monthly_salary=from_paise(row.monthly_salary),
+            approved_limit=from_paise(row.approved_limit),
+            current_debt=Decimal('0'),  # New customers' loans add to it as they are ingested
+        )
+        if customer.id is None:
+            customers_to_create.append(customer)
+        else:
+            customer.version = F('version') + 1
+            customer.updated_at = now
+            customers_to_update.append(customer)
+    
+    # Bulk create/update customers
+    if customers_to_create:
+        Customer.objects.using(shard).bulk_create(customers_to_create, ignore_conflicts=True)
+    
+    if customers_to_update:
+        Customer.objects.using(shard).bulk_update(
+            customers_to_update,
+            # current_debt is kept: it is the principal outstanding on the loans
+            ['first_name', 'last_name', 'age', 'phone_number', 'monthly_salary', 'approved_limit',
+             'version', 'updated_at']
+        )
+        invalidate_customers((customer.customer_id for customer in customers_to_update), using=shard)
+    return len(customers_to_create), len(customers_to_update)
+
+
+def _save_loans(shard, loans, customer_ids):
+    """
+    Create new validated loan rows on one shard and add the principal still
+    outstanding on them to their customers' current_debt
+    """
+    if loans.empty:
+        return 0
+    loans_to_create = [
+        Loan(
+            loan_id=int(row.loan_id),
+            customer_id=customer_ids[int(row.customer_id)],
+            loan_amount=from_paise(row.loan_amount),
+            tenure=int(row.tenure),
+            interest_rate=from_basis_points(row.interest_rate),
+            monthly_repayment=from_paise(row.monthly_repayment),
+            emis_paid_on_time=int(row.emis_paid_on_time),
+            start_date=row.start_date.date(),
+            end_date=row.end_date.date(),
+        )
+        for row in loans.itertuples(index=False)
+    ]
     
+    # Claim the loan_ids before writing the loans, and release them if the
+    # loans can't be written so a re-run doesn't skip them
+    loan_ids = loans['loan_id'].astype(int).tolist()
+    sharding.index_loans(zip(loan_ids, loans['customer_id'].astype(int)))
+    try:
+        with transaction.atomic(using=shard or DEFAULT_DB_ALIAS):
+            Loan.objects.using(shard).bulk_create(loans_to_create, ignore_conflicts=True)
+
+            # Repayments take each EMI's principal off current_debt, so it must
+            # hold what the loans' past EMIs haven't repaid
+            tenure = loans['tenure'].astype('int64')
+            outstanding = outstanding_principal(
+                loans['loan_amount'].astype('int64'), tenure,
+                loans['emis_paid_on_time'].astype('int64').clip(upper=tenure),
+            )
+            debt = outstanding.groupby(loans['customer_id'].astype(int).map(customer_ids)).sum()
+            Customer.objects.using(shard).filter(pk__in=debt.index.tolist()).update(
+                current_debt=F('current_debt') + Case(
+                    *(When(pk=int(pk), then=Value(from_paise(paise))) for pk, paise in debt.items()),
+                    output_field=DecimalField(max_digits=12, decimal_places=2),
+                ),
+                version=F('version') + 1,
+                updated_at=timezone.now(),
+            )
+    except Exception:
+        sharding.release_loan_ids(loan_ids)
+        raise
+    invalidate_customers(loans['customer_id'].astype(int).unique(), using=shard)
+    return len(loans_to_create)
+
+
+@shared_task
+def create_loan_partitions(years_ahead=1):
+    """
+    Celery beat task creating yearly loan partitions ahead of time on every
+    shard so new loans never land in the default partition
+    """
+    created = []
+    for shard in sharding.shard_aliases():
+        created.extend(ensure_loan_partitions(years_ahead=years_ahead, using=shard or 'default'))
+    return created
+
+
+@shared_task
+def drain_outbox():
+    """
+    Apply pending outbox events batch by batch. Queued after each commit that
+    publishes events and run periodically by beat to catch missed ones.
+    """
+    processed = 0
+    for shard in sharding.shard_aliases():
+        while True:
+            batch = outbox.drain(using=shard)
+            processed += batch
+            if batch < settings.OUTBOX_BATCH_SIZE:
+                break
+    return processed
+
+
+@shared_task
+def purge_outbox():
+    """Celery beat task deleting processed outbox events past retention"""
+    return sum(outbox.purge_processed(using=shard) for shard in sharding.shard_aliases())
+
+
+@shared_task
+def purge_repayment_batches():
+    """Celery beat task deleting applied repayment batch records past retention"""
+    return sum(repayments.purge_applied_batches(using=shard) for shard in sharding.shard_aliases())
+
+
+@shared_task
+def post_repayments(entries, idempotency_key):
+    """
+    Apply a repayment file too large for one request transaction. A
+    redelivered task resumes after the batches it already applied.
+    """
+    results = repayments.post_repayments([tuple(entry) for entry in entries], idempotency_key)
+    results['principal_repaid'] = str(results['principal_repaid'])
     return results
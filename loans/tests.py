@@ -1,12 +1,44 @@
-from django.test import TestCase
-from rest_framework.test import APITestCase
+import io
+import json
+import subprocess
+import tempfile
+import sys
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APITestCase
 from rest_framework import status
 from decimal import Decimal
-from datetime import date
-from .models import Customer, Loan
+from fractions import Fraction
+from datetime import date, timedelta
+from django.utils import timezone
+from django.utils.http import http_date
+from .models import Customer, IngestionError, IngestionJob, Loan, LoanIndex, OutboxEvent, RepaymentBatch
 from .utils import calculate_emi, calculate_credit_score, round_nearest_lakh
+from . import (
+    admission, backtest, db_router, ingest_jobs, money, outbox, policy, profile_cache, registrations,
+    repayments, sharding, tasks, utils,
+)
+from .partitioning import ensure_loan_partitions, loan_partitions
+from .admission import TIMEOUT_HEADER
+from .ingestion import record_errors, validate_customers, validate_loans
+from .offers import loan_offer_table
+from .admin import LoanAdmin
 
 
+# Tests other than ShardedStorageTestCase run unsharded, on the default
+# database only, even when POSTGRES_SHARD_HOSTS is set
+@override_settings(DATABASE_SHARDS=['default'])
 class UtilsTestCase(TestCase):
     """Test utility functions"""
 
@@ -78,9 +110,15 @@ class UtilsTestCase(TestCase):
         self.assertEqual(score, 0)
 
 
+# Test mirrors can't see data created inside a TestCase transaction, so API
+# tests read from the primary even when replicas are configured.
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'])
 class APITestCase(APITestCase):
     """Test API endpoints"""
 
+    def setUp(self):
+        profile_cache.local_cache.clear()
+
     def test_register_customer(self):
         """Test customer registration API"""
         data = {
@@ -93,6 +131,7 @@ class APITestCase(APITestCase):
         
         response = self.client.post('/register', data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
         self.assertIn('customer_id', response.data)
         self.assertIn('approved_limit', response.data)
         
@@ -153,3 +192,1524 @@ class APITestCase(APITestCase):
         
         response = self.client.post('/check-eligibility', data, format='json')
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class DatabaseRouterTestCase(SimpleTestCase):
+    """Test read-replica routing"""
+
+    def setUp(self):
+        self.router = db_router.PrimaryReplicaRouter()
+        db_router._replica_health['replica'] = (time.monotonic(), True)
+
+    def tearDown(self):
+        db_router._replica_health.clear()
+
+    def test_reads_default_to_primary(self):
+        """Reads outside replica-enabled views go to the primary"""
+        self.assertEqual(self.router.db_for_read(Customer), 'default')
+
+    def test_replica_reads(self):
+        """Reads inside replica_reads() go to a healthy replica"""
+        with db_router.replica_reads():
+            self.assertEqual(self.router.db_for_read(Customer), 'replica')
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'replica_2'])
+    def test_one_replica_per_request(self):
+        """Every read of a request goes to the replica chosen for its first read"""
+        db_router._replica_health['replica_2'] = (time.monotonic(), True)
+        with mock.patch.object(db_router.random, 'choice', side_effect=lambda aliases: aliases[-1]) as choice:
+            with db_router.replica_reads():
+                self.assertEqual({self.router.db_for_read(model) for model in (Loan, Customer, Loan)},
+                                 {'replica_2'})
+        self.assertEqual(choice.call_count, 1)
+
+    def test_write_pins_to_primary(self):
+        """After a write, reads in the same context stay on the primary"""
+        with db_router.replica_reads():
+            self.assertEqual(self.router.db_for_write(Loan), 'default')
+            self.assertEqual(self.router.db_for_read(Loan), 'default')
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        """Unhealthy replicas are skipped"""
+        db_router._replica_health['replica'] = (time.monotonic(), False)
+        with db_router.replica_reads():
+            self.assertEqual(self.router.db_for_read(Customer), 'default')
+
+    def test_replicas_are_not_migrated(self):
+        """Migrations never run against replicas"""
+        self.assertFalse(self.router.allow_migrate('replica', 'loans'))
+        self.assertIsNone(self.router.allow_migrate('default', 'loans'))
+
+
+@override_settings(DATABASE_SHARDS=['default'])
+class LoanPartitioningTestCase(TestCase):
+    """Test the loan table partitioning helpers"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            customer_id=1,
+            first_name="Test",
+            last_name="User",
+            age=30,
+            phone_number="1234567890",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+        )
+
+    def create_loan(self, loan_id, start_date):
+        return Loan.objects.create(
+            loan_id=loan_id,
+            customer=self.customer,
+            loan_amount=Decimal('100000'),
+            tenure=12,
+            interest_rate=Decimal('12.00'),
+            monthly_repayment=Decimal('8884.88'),
+            start_date=start_date,
+            end_date=start_date,
+        )
+
+    def test_duplicate_loan_id_rejected(self):
+        """loan_id stays unique across partitions"""
+        self.create_loan(1, date(2023, 1, 1))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.create_loan(1, date(2024, 6, 1))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Partitioning requires PostgreSQL')
+    def test_ensure_loan_partitions(self):
+        """Upcoming partitions are created and pick up rows from the default partition"""
+        future_year = date.today().year + 5
+        loan = self.create_loan(1, date(future_year, 3, 1))
+
+        created = ensure_loan_partitions(years_ahead=5)
+        self.assertIn(f'loan_y{future_year}', created)
+        self.assertIn(f'loan_y{future_year}', loan_partitions())
+        self.assertEqual(ensure_loan_partitions(years_ahead=5), [])
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text FROM loan WHERE id = %s', [loan.id])
+            self.assertEqual(cursor.fetchone()[0], f'loan_y{future_year}')
+
+        # Moved rows still count towards loan_id uniqueness
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.create_loan(1, date(2023, 1, 1))
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'])
+class AdmissionControlTestCase(TestCase):
+    """Test load shedding in front of check-eligibility and create-loan"""
+    client_class = APIClient
+
+    def setUp(self):
+        profile_cache.local_cache.clear()
+        Customer.objects.create(
+            customer_id=1,
+            first_name="John",
+            last_name="Doe",
+            age=30,
+            phone_number="9999999999",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+        )
+        self.data = {"customer_id": 1, "loan_amount": 100000, "interest_rate": 10, "tenure": 12}
+
+    def test_expired_deadline_rejected(self):
+        """Requests without enough of their timeout left are rejected before any work"""
+        headers = {TIMEOUT_HEADER: '5'}
+        response = self.client.post('/create-loan', self.data, format='json', headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(Loan.objects.exists())
+
+    def test_future_deadline_admitted(self):
+        """Requests with time left are served normally, whatever the client's clock says"""
+        headers = {TIMEOUT_HEADER: '30000'}
+        with mock.patch('time.time', return_value=0):
+            response = self.client.post('/check-eligibility', self.data, format='json', headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(ADMISSION_TRUSTED_PROXIES={'10.0.0.2'})
+    def test_rate_limit(self):
+        """Buckets are keyed on the remote address unless a trusted proxy names the client"""
+        redis_client = mock.MagicMock()
+        bucket = redis_client.register_script.return_value
+        bucket.return_value = [1, 0]
+        with mock.patch('loans.admission.get_redis', return_value=redis_client), \
+                mock.patch('loans.admission._token_bucket', None):
+            headers = {'X-Client-ID': 'partner-1'}
+            response = self.client.post('/check-eligibility', self.data, format='json', headers=headers,
+                                        REMOTE_ADDR='203.0.113.7')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(bucket.call_args.kwargs['keys'], ['admission:check_eligibility:203.0.113.7'])
+            self.assertEqual(bucket.call_args.kwargs['args'], [settings.ADMISSION_RATE_PER_SECOND,
+                                                               settings.ADMISSION_BURST])
+
+            self.client.post('/check-eligibility', self.data, format='json', headers=headers, REMOTE_ADDR='10.0.0.2')
+            self.assertEqual(bucket.call_args.kwargs['keys'], ['admission:check_eligibility:partner-1'])
+
+            bucket.return_value = [0, 1500]
+            response = self.client.post('/create-loan', self.data, format='json', REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertFalse(Loan.objects.exists())
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=2)
+    def test_concurrency_limit(self):
+        """Requests beyond the per-worker in-flight limit get 503 with Retry-After"""
+        with mock.patch.object(admission._in_flight, 'count', 1):
+            response = self.client.post('/check-eligibility', self.data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(admission._in_flight.count, 1)
+        with mock.patch.object(admission._in_flight, 'count', 2):
+            response = self.client.post('/check-eligibility', self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=0)
+    def test_no_concurrency_limit_by_default(self):
+        """Without ADMISSION_MAX_IN_FLIGHT concurrent requests are all admitted"""
+        with mock.patch.object(admission._in_flight, 'count', 8):
+            response = self.client.post('/check-eligibility', self.data, format='json')
+            self.assertEqual(admission._in_flight.count, 8)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(DATABASE_SHARDS=['default'])
+class IngestionValidationTestCase(TestCase):
+    """Test column-wise validation of the ingestion spreadsheets"""
+
+    def test_validate_customers(self):
+        """Invalid and duplicate customer rows are rejected with their spreadsheet row"""
+        df = pd.DataFrame({
+            'Customer ID': [1, 2, 2, 'x'],
+            'First Name': ['A', 'B', 'C', 'D'],
+            'Last Name': ['A', 'B', 'C', 'D'],
+            'Age': [30, 12, 40, 50],
+            'Phone Number': [9999999999, 9999999998, 9999999997, 9999999996],
+            'Monthly Salary': [50000, 60000, 70000, 80000],
+            'Approved Limit': [1800000, 2200000, 2500000, 2900000],
+        })
+        valid, rejected = validate_customers(df)
+        self.assertEqual(list(valid['customer_id']), [1])
+        self.assertEqual(valid.iloc[0]['phone_number'], '9999999999')
+        self.assertEqual(list(rejected['row_number']), [3, 4, 5])
+        self.assertEqual(rejected.iloc[0]['reason'], 'invalid Age')
+        self.assertEqual(rejected.iloc[1]['reason'], 'duplicate Customer ID')
+        self.assertEqual(rejected.iloc[2]['reason'], 'invalid Customer ID')
+
+    def test_validate_loans(self):
+        """Orphans, bad dates and out-of-range values are rejected"""
+        df = pd.DataFrame({
+            'Customer ID': [1, 2, 1, 1],
+            'Loan ID': [10, 11, 12, 13],
+            'Loan Amount': [100000, 100000, 100000, -5],
+            'Tenure': [12, 12, 12, 12],
+            'Interest Rate': [10.5, 10.5, 10.5, 10.5],
+            'Monthly payment': [8800, 8800, 8800, 8800],
+            'EMIs paid on Time': [12, 12, 12, 13],
+            'Date of Approval': ['2023-01-15', '2023-01-15', 'not a date', '2023-01-15'],
+            'End Date': ['2024-01-15', '2024-01-15', '2024-01-15', '2024-01-15'],
+        })
+        valid, rejected = validate_loans(df, {1})
+        self.assertEqual(list(valid['loan_id']), [10])
+        self.assertEqual(valid.iloc[0]['start_date'].date(), date(2023, 1, 15))
+        self.assertEqual(
+            list(rejected['reason']),
+            ['Customer ID not found', 'invalid Date of Approval',
+             'invalid Loan Amount; invalid EMIs paid on Time'],
+        )
+
+    def test_money_rounds_half_up_like_to_paise(self):
+        """Sub-paisa amounts round half up from their decimal value, not from a float product"""
+        df = pd.DataFrame({
+            'Customer ID': [1, 1, 1],
+            'Loan ID': [10, 11, 12],
+            'Loan Amount': [100000.005, 100000, '100000.125'],
+            'Tenure': [12, 12, 12],
+            'Interest Rate': [10.125, 2.675, 10.5],
+            'Monthly payment': [8884.885, 8800, 8800],
+            'EMIs paid on Time': [12, 12, 12],
+            'Date of Approval': ['2023-01-15'] * 3,
+            'End Date': ['2024-01-15'] * 3,
+        })
+        valid, _ = validate_loans(df, {1})
+        for column, amounts in [('loan_amount', df['Loan Amount']), ('interest_rate', df['Interest Rate']),
+                                ('monthly_repayment', df['Monthly payment'])]:
+            self.assertEqual(list(valid[column]), [money.to_paise(amount) for amount in amounts])
+        self.assertEqual(list(valid['interest_rate']), [1013, 268, 1050])
+
+    def test_record_errors(self):
+        """Rejected rows are stored out of band, keyed by task"""
+        _, rejected = validate_loans(pd.DataFrame({'Loan ID': [1]}), set())
+        record_errors('task-1', 'loan', rejected)
+        error = IngestionError.objects.get(task_id='task-1')
+        self.assertEqual(error.row_number, 2)
+        self.assertIn('Customer ID not found', error.reason)
+
+
+class StartupTestCase(SimpleTestCase):
+    """Test that light process types don't import the ingestion stack"""
+
+    def test_tasks_import_without_pandas(self):
+        """Loading Celery tasks and enqueue_ingest must not import pandas"""
+        code = (
+            'import django, sys\n'
+            'django.setup()\n'
+            'from credit_system.celery import app\n'
+            'app.loader.import_default_modules()\n'
+            'import loans.management.commands.enqueue_ingest\n'
+            'sys.exit("pandas" in sys.modules)\n'
+        )
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+@override_settings(DATABASE_SHARDS=['default'])
+class AdminChangelistTestCase(TestCase):
+    """Test that admin changelists stay cheap as tables grow"""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def create_loans(self, start, count):
+        for i in range(start, start + count):
+            customer = Customer.objects.create(
+                customer_id=i,
+                first_name=f"First{i}",
+                last_name=f"Last{i}",
+                age=30,
+                phone_number=str(9000000000 + i),
+                monthly_salary=Decimal('50000'),
+                approved_limit=Decimal('1800000'),
+            )
+            Loan.objects.create(
+                loan_id=i,
+                customer=customer,
+                loan_amount=Decimal('100000'),
+                tenure=12,
+                interest_rate=Decimal('12.00'),
+                monthly_repayment=Decimal('8884.88'),
+                start_date=date(2023, 1, 1),
+                end_date=date(2024, 1, 1),
+            )
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_loan_changelist_query_count_is_constant(self):
+        """Listing loans doesn't issue a query per row"""
+        self.create_loans(1, 3)
+        small = self.changelist_queries('/admin/loans/loan/')
+        self.create_loans(4, 30)
+        self.assertEqual(self.changelist_queries('/admin/loans/loan/'), small)
+
+    def test_keyset_next_page(self):
+        """Full pages link to the next page by loan_id instead of offset"""
+        self.create_loans(1, 3)
+        with mock.patch.object(LoanAdmin, 'list_per_page', 2):
+            response = self.client.get('/admin/loans/loan/')
+            self.assertEqual(response.context['cl'].keyset_next_url, '?loan_id__gt=2')
+            response = self.client.get('/admin/loans/loan/?loan_id__gt=2')
+            self.assertEqual([loan.loan_id for loan in response.context['cl'].result_list], [3])
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'])
+class LoanOffersTestCase(TestCase):
+    """Test the loan offer table endpoint"""
+    client_class = APIClient
+
+    def setUp(self):
+        profile_cache.local_cache.clear()
+        self.customer = Customer.objects.create(
+            customer_id=1,
+            first_name="John",
+            last_name="Doe",
+            age=30,
+            phone_number="9999999999",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+            current_debt=Decimal('1500000'),
+        )
+        # All EMIs on time, one past loan, 83% utilization: score 42, 12% floor
+        Loan.objects.create(
+            loan_id=1,
+            customer=self.customer,
+            loan_amount=Decimal('100000'),
+            tenure=12,
+            interest_rate=Decimal('12.00'),
+            monthly_repayment=Decimal('8884.88'),
+            emis_paid_on_time=12,
+            start_date=date(2020, 1, 1),
+            end_date=date(2021, 1, 1),
+        )
+
+    def test_offers_match_eligibility_rules(self):
+        """Every offer is the largest amount check-eligibility would approve"""
+        response = self.client.post('/loan-offers', {"customer_id": 1, "interest_rate": 10}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['approval'])
+        self.assertEqual(Decimal(response.data['corrected_interest_rate']), Decimal('12.00'))
+
+        headroom = Decimal('25000.00') - Decimal('8884.88')
+        self.assertEqual(Decimal(response.data['available_monthly_installment']), headroom)
+        self.assertEqual([offer['tenure'] for offer in response.data['offers']], list(range(1, 121)))
+        for offer in response.data['offers']:
+            amount = Decimal(offer['max_loan_amount'])
+            self.assertLessEqual(calculate_emi(amount, Decimal('16.00'), offer['tenure']), headroom)
+            self.assertGreater(calculate_emi(amount + Decimal('0.01'), Decimal('16.00'), offer['tenure']), headroom)
+            self.assertEqual(Decimal(offer['monthly_installment']), calculate_emi(amount, Decimal('12.00'), offer['tenure']))
+
+        offer = response.data['offers'][23]
+        eligibility = self.client.post('/check-eligibility', {
+            "customer_id": 1, "loan_amount": offer['max_loan_amount'], "interest_rate": 10, "tenure": 24,
+        }, format='json')
+        self.assertTrue(eligibility.data['approval'])
+        self.assertEqual(eligibility.data['monthly_installment'], offer['monthly_installment'])
+
+    def test_offers_agree_with_check_eligibility_arithmetic(self):
+        """Over a range of headrooms, tenures and rates, offers are exactly what check-eligibility allows"""
+        rng = np.random.default_rng(32)
+        headrooms = [452393800] + rng.integers(1, 2 * 10 ** 9, 40).tolist() + rng.integers(1, 10 ** 5, 10).tolist()
+        for headroom in headrooms:
+            rate = int(rng.choice([1200, 1600, 1050, 2399, 0]))
+            offers = loan_offer_table(headroom, rate)
+            self.assertEqual([offer['tenure'] for offer in offers], list(range(1, 121)))
+            for offer in offers:
+                with self.subTest(headroom=headroom, rate=rate, tenure=offer['tenure']):
+                    amount = money.to_paise(offer['max_loan_amount'])
+                    # The check-eligibility cap for a customer with no EMIs and twice the headroom as salary
+                    salary = headroom * 2
+                    self.assertFalse(policy.CURRENT_POLICY.exceeds_emi_cap(
+                        policy.CURRENT_POLICY.proposed_emi(amount, offer['tenure']), salary))
+                    self.assertTrue(policy.CURRENT_POLICY.exceeds_emi_cap(
+                        policy.CURRENT_POLICY.proposed_emi(amount + 1, offer['tenure']), salary))
+                    self.assertEqual(money.to_paise(offer['monthly_installment']),
+                                     money.calculate_emi(amount, rate, offer['tenure']))
+
+        # And through the endpoints, at a headroom of 4523938.00
+        self.customer.monthly_salary = Decimal('9065645.76')
+        self.customer.save()
+        offer = self.client.post('/loan-offers', {"customer_id": 1, "interest_rate": 10}, format='json').data['offers'][2]
+        for amount, approved in ((Decimal(offer['max_loan_amount']), True),
+                                 (Decimal(offer['max_loan_amount']) + Decimal('0.01'), False)):
+            eligibility = self.client.post('/check-eligibility', {
+                "customer_id": 1, "loan_amount": amount, "interest_rate": 10, "tenure": 3,
+            }, format='json')
+            self.assertEqual(eligibility.data['approval'], approved)
+        self.assertEqual(Decimal(offer['max_loan_amount']), Decimal('13217783.62'))
+
+    def test_no_offers_without_headroom(self):
+        """Customers already at the EMI cap get no offers"""
+        self.customer.monthly_salary = Decimal('10000')
+        self.customer.save()
+        response = self.client.post('/loan-offers', {"customer_id": 1, "interest_rate": 10}, format='json')
+        self.assertFalse(response.data['approval'])
+        self.assertEqual(response.data['offers'], [])
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class CustomerProfileCacheTestCase(TestCase):
+    """Test the two-tier customer profile cache"""
+    client_class = APIClient
+
+    def setUp(self):
+        profile_cache.local_cache.clear()
+        self.customer = Customer.objects.create(
+            customer_id=1,
+            first_name="John",
+            last_name="Doe",
+            age=30,
+            phone_number="9999999999",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+            current_debt=Decimal('100000'),
+        )
+        Loan.objects.create(
+            loan_id=1,
+            customer=self.customer,
+            loan_amount=Decimal('100000'),
+            tenure=12,
+            interest_rate=Decimal('12.00'),
+            monthly_repayment=Decimal('8884.88'),
+            emis_paid_on_time=10,
+            start_date=date.today(),
+            end_date=date.today(),
+        )
+
+    def test_profile_matches_database(self):
+        """Cached score inputs give the same score and EMI total as the database"""
+        profile = profile_cache.get_customer_profile(1)
+        self.assertEqual(profile.credit_score(), calculate_credit_score(self.customer))
+        self.assertEqual(profile.total_emi, 888488)
+        self.assertIsNone(profile_cache.get_customer_profile(999))
+
+    def test_local_hit_skips_database(self):
+        """A second lookup is served from the local tier"""
+        profile_cache.get_customer_profile(1)
+        hits = profile_cache.local_cache.stats.hits
+        with self.assertNumQueries(0):
+            self.client.post('/check-eligibility', {
+                "customer_id": 1, "loan_amount": 100000, "interest_rate": 10, "tenure": 12,
+            }, format='json')
+        self.assertEqual(profile_cache.local_cache.stats.hits, hits + 1)
+        self.assertIn('hit_rate', self.client.get('/metrics').data['customer_cache']['local'])
+
+    def test_create_loan_invalidates_profile(self):
+        """Profiles are reloaded after create-loan commits"""
+        self.assertEqual(profile_cache.get_customer_profile(1).loan_count, 1)
+        with mock.patch.object(outbox, '_schedule_drain'):
+            response = self.client.post('/create-loan', {
+                "customer_id": 1, "loan_amount": 100000, "interest_rate": 14, "tenure": 12,
+            }, format='json')
+        self.assertTrue(response.data['loan_approved'])
+        with self.captureOnCommitCallbacks(execute=True):
+            outbox.drain()
+        profile = profile_cache.get_customer_profile(1)
+        self.assertEqual(profile.loan_count, 2)
+        self.assertEqual(profile.current_debt, 20000000)
+
+    def test_local_tier_evicts_least_recently_used(self):
+        """The local tier holds at most max_entries profiles"""
+        cache = profile_cache.LocalProfileCache(max_entries=2, ttl=60)
+        profiles = [profile_cache.CustomerProfile.load(1) for _ in range(3)]
+        for customer_id, profile in enumerate(profiles, start=1):
+            profile.customer_id = customer_id
+            cache.set(profile)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(1))
+        self.assertIs(cache.get(3), profiles[2])
+
+    def test_redis_tier(self):
+        """Local misses are served from Redis, and invalidations are published"""
+        redis_client = mock.MagicMock()
+        redis_client.mget.return_value = [profile_cache.CustomerProfile.load(1).dumps(), None]
+        with mock.patch.object(profile_cache, 'get_redis', return_value=redis_client), \
+                mock.patch.object(profile_cache, '_ensure_subscriber'):
+            with self.assertNumQueries(0):
+                profile = profile_cache.get_customer_profile(1)
+            self.assertEqual(profile.total_emi, 888488)
+            self.assertGreaterEqual(profile_cache.cache_stats()['redis']['hits'], 1)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                profile_cache.invalidate_customers([2, 1])
+        pipeline = redis_client.pipeline.return_value
+        pipeline.delete.assert_called_once_with(f'{profile_cache.KEY_PREFIX}1', f'{profile_cache.KEY_PREFIX}2')
+        pipeline.publish.assert_called_once_with(profile_cache.INVALIDATION_CHANNEL, '1,2')
+        self.assertIsNone(profile_cache.local_cache.get(1))
+
+    def test_invalidation_during_load_is_not_overwritten(self):
+        """A profile loaded before an invalidation is not written back to either tier"""
+        generations = {}
+        redis_client = mock.MagicMock()
+        redis_client.mget.side_effect = lambda *keys: [None, generations.get(keys[1])]
+        pipeline = redis_client.pipeline.return_value
+        pipeline.incr.side_effect = lambda key: generations.__setitem__(key, str(int(generations.get(key, 0)) + 1).encode())
+
+        def set_if_current(keys, args):
+            # SET_IF_CURRENT
+            return int((generations.get(keys[1]) or b'0').decode() == args[0])
+
+        redis_client.register_script.return_value.side_effect = set_if_current
+        load = profile_cache.CustomerProfile.load
+
+        def load_then_invalidate(customer_id):
+            profile = load(customer_id)
+            profile_cache._invalidate([customer_id])
+            return profile
+
+        with mock.patch.object(profile_cache, 'get_redis', return_value=redis_client), \
+                mock.patch.object(profile_cache, '_ensure_subscriber'):
+            with mock.patch.object(profile_cache.CustomerProfile, 'load', load_then_invalidate):
+                self.assertEqual(profile_cache.get_customer_profile(1).loan_count, 1)
+            self.assertEqual(redis_client.register_script.return_value.call_args.kwargs['args'][0], '0')
+            self.assertIsNone(profile_cache.local_cache.get(1))
+
+            # The next miss reads the new generation and may store its profile
+            profile_cache.get_customer_profile(1)
+        self.assertEqual(redis_client.register_script.return_value.call_args.kwargs['args'][0], '1')
+        self.assertIsNotNone(profile_cache.local_cache.get(1))
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class OutboxTestCase(TestCase):
+    """Test the transactional outbox behind create-loan"""
+    client_class = APIClient
+
+    def setUp(self):
+        Customer.objects.create(
+            customer_id=1,
+            first_name="John",
+            last_name="Doe",
+            age=30,
+            phone_number="9999999999",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+        )
+        self.data = {"customer_id": 1, "loan_amount": 100000, "interest_rate": 14, "tenure": 12}
+
+    def create_loan(self):
+        with mock.patch.object(outbox, '_schedule_drain') as schedule_drain, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/create-loan', self.data, format='json')
+        schedule_drain.assert_called_once_with()
+        return response
+
+    def test_event_written_with_loan(self):
+        """The loan, its debt and its outbox event are written together"""
+        response = self.create_loan()
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.event_type, outbox.LOAN_CREATED)
+        self.assertEqual(event.payload['loan_id'], response.data['loan_id'])
+        self.assertEqual(Customer.objects.get().current_debt, Decimal('100000'))
+        self.assertEqual(outbox.outbox_lag()['pending'], 1)
+
+    def test_drain_is_at_least_once(self):
+        """Failed batches stay pending, processed ones are not delivered again"""
+        self.create_loan()
+        handler = mock.Mock(side_effect=[RuntimeError('down'), None])
+        with mock.patch.dict(outbox.HANDLERS, {outbox.LOAN_CREATED: [handler]}):
+            with self.assertLogs('loans.outbox', 'ERROR'):
+                self.assertEqual(outbox.drain(), 0)
+            event = OutboxEvent.objects.get()
+            self.assertEqual((event.attempts, event.last_error), (1, 'RuntimeError: down'))
+
+            self.assertEqual(outbox.drain(), 1)
+            self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(handler.call_count, 2)
+        self.assertEqual(outbox.outbox_lag(), {'pending': 0, 'dead': 0, 'oldest_pending_seconds': 0})
+
+    def test_failing_event_does_not_charge_its_batch(self):
+        """Only the event a handler fails on is charged an attempt"""
+        for loan_id in range(1, 4):
+            outbox.publish(outbox.LOAN_CREATED, {'loan_id': loan_id, 'customer_id': 1})
+
+        def handler(payloads, using):
+            if any(payload['loan_id'] == 2 for payload in payloads):
+                raise RuntimeError('bad payload')
+        with mock.patch.object(outbox, '_schedule_drain'), \
+                mock.patch.dict(outbox.HANDLERS, {outbox.LOAN_CREATED: [handler]}), \
+                self.assertLogs('loans.outbox', 'WARNING'):
+            self.assertEqual(outbox.drain(), 2)
+        self.assertEqual(
+            [(event.payload['loan_id'], event.attempts, event.processed_at is None)
+             for event in OutboxEvent.objects.order_by('id')],
+            [(1, 0, False), (2, 1, True), (3, 0, False)],
+        )
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=1)
+    def test_failing_events_are_set_aside(self):
+        """Events past OUTBOX_MAX_ATTEMPTS no longer block the outbox"""
+        self.create_loan()
+        with mock.patch.dict(outbox.HANDLERS, {outbox.LOAN_CREATED: [mock.Mock(side_effect=RuntimeError)]}), \
+                self.assertLogs('loans.outbox', 'ERROR'):
+            outbox.drain()
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(outbox.outbox_lag()['dead'], 1)
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class BulkRepaymentTestCase(TestCase):
+    """Test set-based repayment posting"""
+    client_class = APIClient
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            customer_id=1,
+            first_name="John",
+            last_name="Doe",
+            age=30,
+            phone_number="9999999999",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+            current_debt=Decimal('400000'),
+        )
+        for loan_id, loan_amount in [(1, Decimal('100000')), (2, Decimal('300000'))]:
+            Loan.objects.create(
+                loan_id=loan_id,
+                customer=self.customer,
+                loan_amount=loan_amount,
+                tenure=3,
+                interest_rate=Decimal('12.00'),
+                monthly_repayment=Decimal('34002.21'),
+                start_date=date(2024, 1, 1),
+                end_date=date(2024, 4, 1),
+            )
+
+    def post(self, repayments, idempotency_key=None):
+        idempotency_key = idempotency_key or str(uuid.uuid4())
+        with mock.patch.object(outbox, '_schedule_drain'):
+            return self.client.post('/repayments/bulk', {'idempotency_key': idempotency_key, 'repayments': repayments},
+                                    format='json')
+
+    def test_bulk_post(self):
+        """Payments are summed per loan, capped at the tenure and taken off current_debt"""
+        response = self.post([
+            {"loan_id": 1, "emis_paid": 1, "on_time": True},
+            {"loan_id": 1, "emis_paid": 1, "on_time": False},
+            {"loan_id": 2, "emis_paid": 5, "on_time": True},
+            {"loan_id": 99, "emis_paid": 1, "on_time": True},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['loans_updated'], 2)
+        self.assertEqual(response.data['emis_applied'], 5)
+        self.assertEqual(response.data['unknown_loan_ids'], [99])
+        # 2/3 of 100000 and all of 300000
+        self.assertEqual(Decimal(response.data['principal_repaid']), Decimal('366666.67'))
+
+        first, second = Loan.objects.order_by('loan_id')
+        self.assertEqual((first.emis_paid_on_time, first.emis_paid_late, first.repayments_left), (1, 1, 1))
+        self.assertEqual((second.emis_paid_on_time, second.repayments_left), (3, 0))
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.current_debt, Decimal('33333.33'))
+        self.assertEqual(OutboxEvent.objects.get().payload, {'customer_ids': [1]})
+
+        # The last EMI repays exactly the rest of the loan
+        self.post([{"loan_id": 1, "emis_paid": 1, "on_time": True}])
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.current_debt, Decimal('0.00'))
+
+    @skipUnless(connection.vendor == 'postgresql', 'The set-based statement requires PostgreSQL')
+    def test_portable_batch_matches_sql(self):
+        """The ORM fallback applies a batch exactly like the SQL statement"""
+        entries = [(1, 2, False), (2, 1, True), (2, 1, True), (7, 1, False)]
+        with transaction.atomic():
+            sql_result = repayments._post_batch_sql(entries, 'default')
+            sql_state = list(Loan.objects.order_by('loan_id').values_list('emis_paid_on_time', 'emis_paid_late'))
+            sql_debt = Customer.objects.get().current_debt
+            transaction.set_rollback(True)
+        orm_result = repayments._post_batch_orm(entries, 'default')
+        self.assertEqual(orm_result, sql_result)
+        self.assertEqual(list(Loan.objects.order_by('loan_id').values_list('emis_paid_on_time', 'emis_paid_late')),
+                         sql_state)
+        self.assertEqual(Customer.objects.get().current_debt, sql_debt)
+
+    def test_invalid_entries_rejected(self):
+        """Malformed entries fail the whole request"""
+        response = self.post([{"loan_id": 1, "emis_paid": 0, "on_time": True}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Loan.objects.filter(emis_paid_on_time__gt=0).exists())
+
+    @override_settings(REPAYMENT_BATCH_SIZE=1)
+    def test_large_requests_queued(self):
+        """Requests larger than one batch are handed to Celery"""
+        with mock.patch('loans.tasks.post_repayments.delay') as delay:
+            delay.return_value.id = 'task-1'
+            response = self.post([{"loan_id": 1, "emis_paid": 1, "on_time": True}] * 2, idempotency_key='file-1')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data, {'task_id': 'task-1', 'entries': 2})
+        delay.assert_called_once_with([(1, 1, True)] * 2, 'file-1')
+
+    def test_retried_request_is_not_applied_twice(self):
+        entries = [{"loan_id": 1, "emis_paid": 1, "on_time": True}, {"loan_id": 2, "emis_paid": 1, "on_time": False}]
+        first = self.post(entries, idempotency_key='file-1')
+        retry = self.post(entries, idempotency_key='file-1')
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual((first.data['batches_already_applied'], retry.data['batches_already_applied']), (0, 1))
+        for field in ('loans_updated', 'emis_applied', 'principal_repaid', 'unknown_loan_ids'):
+            self.assertEqual(retry.data[field], first.data[field])
+        self.assertEqual(list(Loan.objects.order_by('loan_id').values_list('emis_paid_on_time', 'emis_paid_late')),
+                         [(1, 0), (0, 1)])
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.current_debt, Decimal('266666.67'))
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+        self.assertEqual(self.post(entries, idempotency_key='file-2').data['batches_already_applied'], 0)
+        self.assertEqual(Loan.objects.get(loan_id=1).emis_paid_on_time, 2)
+        response = self.client.post('/repayments/bulk', {'repayments': entries}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_redelivered_task_resumes(self):
+        """A task that failed part-way only applies the remaining batches when run again"""
+        entries = [(1, 1, True), (2, 1, True), (2, 1, False)]
+        post_batch = repayments._post_batch_sql if connection.vendor == 'postgresql' else repayments._post_batch_orm
+        calls = []
+
+        def fail_on_third(batch, using):
+            calls.append(batch)
+            if len(calls) == 3:
+                raise ConnectionError('worker lost')
+            return post_batch(batch, using)
+
+        with mock.patch.object(outbox, '_schedule_drain'), override_settings(REPAYMENT_BATCH_SIZE=1):
+            with mock.patch.object(repayments, '_post_batch_sql', fail_on_third), \
+                    mock.patch.object(repayments, '_post_batch_orm', fail_on_third):
+                with self.assertRaises(ConnectionError):
+                    tasks.post_repayments.apply(args=(entries, 'file-1'), throw=True)
+            results = tasks.post_repayments.apply(args=(entries, 'file-1')).get()
+        self.assertEqual(results['batches_already_applied'], 2)
+        self.assertEqual(results['emis_applied'], 3)
+        self.assertEqual(list(Loan.objects.order_by('loan_id').values_list('emis_paid_on_time', 'emis_paid_late')),
+                         [(1, 0), (1, 1)])
+        self.assertEqual(RepaymentBatch.objects.count(), 3)
+
+    def test_purge_applied_batches(self):
+        self.post([{"loan_id": 1, "emis_paid": 1, "on_time": True}], idempotency_key='file-1')
+        self.assertEqual(repayments.purge_applied_batches(), 0)
+        self.assertEqual(repayments.purge_applied_batches(older_than=timezone.now() + timedelta(seconds=1)), 1)
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class LoanListBatchTestCase(TestCase):
+    """Test loan lists for many customers in one request"""
+    client_class = APIClient
+
+    def setUp(self):
+        profile_cache.local_cache.clear()
+        for customer_id in (1, 2, 3):
+            customer = Customer.objects.create(
+                customer_id=customer_id,
+                first_name="John",
+                last_name="Doe",
+                age=30,
+                phone_number="9999999999",
+                monthly_salary=Decimal('50000'),
+                approved_limit=Decimal('1800000'),
+            )
+            # Customer 3 has no loans
+            for loan_id in range(customer_id * 10, customer_id * 10 + 3 - customer_id):
+                Loan.objects.create(
+                    loan_id=loan_id,
+                    customer=customer,
+                    loan_amount=Decimal('100000'),
+                    tenure=12,
+                    interest_rate=Decimal('12.00'),
+                    monthly_repayment=Decimal('8884.88'),
+                    emis_paid_on_time=loan_id % 5,
+                    start_date=date(2024, 1, 1),
+                    end_date=date(2025, 1, 1),
+                )
+
+    def test_batch_matches_single_customer_lists(self):
+        with self.assertNumQueries(2):
+            response = self.client.post('/view-loans/batch', {'customer_ids': [3, 99, 1, 2, 1]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        customers = response.data['customers']
+        self.assertEqual([customer['customer_id'] for customer in customers], [1, 2, 3, 99])
+        self.assertEqual(customers[3], {'customer_id': 99, 'error': 'Customer not found'})
+        self.assertEqual(customers[2]['loans'], [])
+        for customer in customers[:3]:
+            single = self.client.get(f"/view-loans/{customer['customer_id']}")
+            self.assertEqual(customer['loans'], single.json())
+        self.assertEqual([loan['loan_id'] for loan in customers[0]['loans']], [10, 11])
+
+    def test_streamed_batch(self):
+        body = {'customer_ids': [1, 2, 3, 99]}
+        response = self.client.post('/view-loans/batch?stream=1', body, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        expected = self.client.post('/view-loans/batch', body, format='json').json()['customers']
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+    @override_settings(LOAN_BATCH_MAX_CUSTOMERS=2)
+    def test_invalid_batches(self):
+        for body in ({'customer_ids': []}, {'customer_ids': [1, 2, 3]}, {'customer_ids': ['x']}, {}):
+            response = self.client.post('/view-loans/batch', body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class ConditionalGetTestCase(TestCase):
+    """Test ETag and Last-Modified validators on the loan read endpoints"""
+    client_class = APIClient
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            customer_id=1,
+            first_name="John",
+            last_name="Doe",
+            age=30,
+            phone_number="9999999999",
+            monthly_salary=Decimal('50000'),
+            approved_limit=Decimal('1800000'),
+            current_debt=Decimal('100000'),
+        )
+        self.loan = Loan.objects.create(
+            loan_id=1,
+            customer=self.customer,
+            loan_amount=Decimal('100000'),
+            tenure=12,
+            interest_rate=Decimal('12.00'),
+            monthly_repayment=Decimal('8884.88'),
+            start_date=date(2024, 1, 1),
+            end_date=date(2025, 1, 1),
+        )
+
+    def assertRevalidates(self, url):
+        """
+        The URL's ETag, and its Last-Modified once the data is a second old,
+        give 304s without reading any loan rows
+        """
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        # Just written: a write later in this second could share a Last-Modified
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date()).status_code, status.HTTP_200_OK)
+
+        with mock.patch('loans.views.timezone.now', return_value=timezone.now() + timedelta(seconds=1)):
+            last_modified = self.client.get(url)['Last-Modified']
+            for headers in ({'HTTP_IF_NONE_MATCH': etag}, {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+                with self.assertNumQueries(1):
+                    not_modified = self.client.get(url, **headers)
+                self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(not_modified['ETag'], etag)
+                self.assertEqual(not_modified.content, b'')
+        return etag
+
+    def test_saves_bump_versions(self):
+        self.assertEqual(Customer.objects.get().version, 2)  # the loan was added
+        self.customer.refresh_from_db()
+        self.customer.first_name = "Jane"
+        self.customer.save(update_fields=['first_name'])
+        self.assertEqual(self.customer.version, 3)
+        self.loan.tenure = 24
+        self.loan.save()
+        self.assertEqual((self.loan.version, Customer.objects.get().version), (2, 4))
+
+    def test_view_loan(self):
+        etag = self.assertRevalidates('/view-loan/1')
+        with mock.patch.object(outbox, '_schedule_drain'):
+            self.client.post('/repayments/bulk', {'idempotency_key': 'file-1',
+                                                  'repayments': [{'loan_id': 1, 'emis_paid': 1, 'on_time': True}]},
+                             format='json')
+        response = self.client.get('/view-loan/1', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['loan_id'], 1)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertRevalidates('/view-loan/1')
+
+    def test_view_customer_loans(self):
+        etag = self.assertRevalidates('/view-loans/1')
+        Loan.objects.create(
+            loan_id=2,
+            customer=self.customer,
+            loan_amount=Decimal('50000'),
+            tenure=6,
+            interest_rate=Decimal('12.00'),
+            monthly_repayment=Decimal('8627.42'),
+            start_date=date(2024, 6, 1),
+            end_date=date(2024, 12, 1),
+        )
+        response = self.client.get('/view-loans/1', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertRevalidates('/view-loans/1')
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None, INGEST_CHUNK_SIZE=2)
+class IngestionJobTestCase(TestCase):
+    """Test ingestion progress tracking and the /ingest-jobs API"""
+    client_class = APIClient
+
+    def setUp(self):
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+        pd.DataFrame({
+            'Customer ID': [1, 2, 3, 4, 'x'],
+            'First Name': ['A', 'B', 'C', 'D', 'E'],
+            'Last Name': ['A', 'B', 'C', 'D', 'E'],
+            'Age': [30, 31, 32, 33, 34],
+            'Phone Number': [9999999999, 9999999998, 9999999997, 9999999996, 9999999995],
+            'Monthly Salary': [50000, 60000, 70000, 80000, 90000],
+            'Approved Limit': [1800000, 2200000, 2500000, 2900000, 3200000],
+        }).to_excel(f'{data_dir.name}/customer_data.xlsx', index=False)
+        pd.DataFrame({
+            'Customer ID': [1, 2, 3, 9],
+            'Loan ID': [10, 11, 12, 13],
+            'Loan Amount': [100000] * 4,
+            'Tenure': [12] * 4,
+            'Interest Rate': [10.5] * 4,
+            'Monthly payment': [8800] * 4,
+            'EMIs paid on Time': [3] * 4,
+            'Date of Approval': ['2023-01-15'] * 4,
+            'End Date': ['2024-01-15'] * 4,
+        }).to_excel(f'{data_dir.name}/loan_data.xlsx', index=False)
+        self.settings_override = override_settings(INGEST_DATA_DIR=data_dir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_progress_is_recorded_per_chunk(self):
+        with mock.patch.object(tasks.ingest_excel_data, 'update_state') as update_state:
+            results = tasks.ingest_excel_data.apply(task_id='job-1').get()
+        self.assertEqual((results['customers_created'], results['loans_created'], results['rows_rejected']), (4, 3, 2))
+
+        job = IngestionJob.objects.get(task_id='job-1')
+        self.assertEqual(job.status, IngestionJob.SUCCEEDED)
+        self.assertEqual(job.results, results)
+        self.assertLessEqual(job.started_at, job.finished_at)
+        self.assertEqual(
+            {stage: {counter: counts[counter] for counter in ingest_jobs.COUNTERS}
+             for stage, counts in job.progress.items()},
+            {
+                'customers': {'rows_read': 5, 'rows_validated': 4, 'rows_rejected': 1,
+                              'rows_skipped': 0, 'rows_written': 4},
+                'loans': {'rows_read': 4, 'rows_validated': 3, 'rows_rejected': 1,
+                          'rows_skipped': 0, 'rows_written': 3},
+            },
+        )
+        # Start, read, validation and end of both stages, plus two chunks of 2 rows per stage
+        self.assertEqual(update_state.call_count, 2 * 4 + 2 + 2)
+        self.assertEqual({c.kwargs['state'] for c in update_state.call_args_list}, {ingest_jobs.PROGRESS})
+        self.assertEqual(update_state.call_args.kwargs['task_id'], 'job-1')
+
+        # Re-running skips the loans that already exist
+        with mock.patch.object(tasks.ingest_excel_data, 'update_state'):
+            tasks.ingest_excel_data.apply(task_id='job-2')
+        progress = IngestionJob.objects.get(task_id='job-2').progress
+        self.assertEqual((progress['loans']['rows_skipped'], progress['loans']['rows_written']), (3, 0))
+
+    def test_ingested_loans_count_toward_debt(self):
+        """Ingested and API loans add what they owe to current_debt, and repaying either takes only that off"""
+        with mock.patch.object(tasks.ingest_excel_data, 'update_state'):
+            tasks.ingest_excel_data.apply(task_id='job-1')
+        # 9 of 12 EMIs of 100000 are outstanding
+        self.assertEqual(Customer.objects.get(customer_id=1).current_debt, Decimal('75000.00'))
+        with mock.patch.object(outbox, '_schedule_drain'):
+            response = self.client.post('/create-loan', {
+                'customer_id': 1, 'loan_amount': 60000, 'interest_rate': 16, 'tenure': 6,
+            }, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+            self.assertEqual(Customer.objects.get(customer_id=1).current_debt, Decimal('135000.00'))
+
+            # Re-ingesting the customer keeps its debt
+            tasks.ingest_excel_data.apply(task_id='job-2')
+            self.assertEqual(Customer.objects.get(customer_id=1).current_debt, Decimal('135000.00'))
+
+            repayments.post_repayments([(10, 9, True)], 'file-1')
+            self.assertEqual(Customer.objects.get(customer_id=1).current_debt, Decimal('60000.00'))
+            repayments.post_repayments([(response.data['loan_id'], 2, True)], 'file-2')
+            self.assertEqual(Customer.objects.get(customer_id=1).current_debt, Decimal('40000.00'))
+            repayments.post_repayments([(10, 1, True), (response.data['loan_id'], 4, False)], 'file-3')
+        self.assertEqual(Customer.objects.get(customer_id=1).current_debt, Decimal('0.00'))
+
+    def test_ingest_jobs_api(self):
+        with mock.patch.object(tasks.ingest_excel_data, 'update_state'):
+            tasks.ingest_excel_data.apply(task_id='job-1')
+        IngestionJob.objects.create(task_id='job-2')
+
+        response = self.client.get('/ingest-jobs')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([job['task_id'] for job in response.data], ['job-2', 'job-1'])
+        self.assertEqual(response.data[0]['status'], IngestionJob.QUEUED)
+        self.assertEqual(len(self.client.get('/ingest-jobs?limit=1').data), 1)
+        self.assertEqual(self.client.get('/ingest-jobs?limit=x').status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get('/ingest-jobs/job-1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        loans = response.data['stages']['loans']
+        self.assertEqual(loans['rows_written'], 3)
+        self.assertGreater(loans['rows_per_second'], 0)
+        self.assertIsNone(loans['eta_seconds'])
+        self.assertEqual(self.client.get('/ingest-jobs/missing').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stage_stats(self):
+        started = timezone.now()
+        counts = {**dict.fromkeys(ingest_jobs.COUNTERS, 0), 'rows_validated': 1000, 'rows_written': 250,
+                  'started_at': started.isoformat(), 'finished_at': None}
+        stats = ingest_jobs.stage_stats(counts, now=started + timedelta(seconds=10))
+        self.assertEqual((stats['rows_per_second'], stats['eta_seconds']), (25.0, 30.0))
+
+
+class BacktestBookMixin:
+    """40 customers with 0-5 loans each and a stricter candidate policy"""
+
+    candidate = policy.ScoringPolicy.from_dict({
+        'name': 'stricter',
+        'slabs': [{'min_score': 60}, {'min_score': 40, 'rate_floor': '13.5'}, {'min_score': 20, 'rate_floor': '17'}],
+        'max_emi_to_salary_percent': 40,
+    })
+
+    def setUp(self):
+        this_year = date.today().year
+        for customer_id in range(1, 41):
+            customer = Customer.objects.create(
+                customer_id=customer_id, first_name='Test', last_name='User', age=30,
+                phone_number=9000000000 + customer_id, monthly_salary=20000 + customer_id * 5000,
+                approved_limit=1800000, current_debt=customer_id * 30000,
+            )
+            for n in range(customer_id % 6):
+                Loan.objects.create(
+                    customer=customer, loan_id=customer_id * 10 + n, loan_amount=100000, tenure=12,
+                    interest_rate=Decimal('10.5'), monthly_repayment=Decimal('1000.50') * (customer_id % 4),
+                    emis_paid_on_time=(customer_id + n) % 13,
+                    start_date=date(this_year - n % 2, 1, 15), end_date=date(this_year + 1, 1, 15),
+                )
+        self.application = backtest.Application(loan_amount=money.to_paise(300000), interest_rate=1100, tenure=24)
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None, CUSTOMER_CACHE_ENABLED=False)
+class PolicyBacktestTestCase(BacktestBookMixin, TestCase):
+    """Test scoring policies and the backtest_policy command"""
+
+    def test_policy_round_trip_and_validation(self):
+        self.assertEqual(policy.ScoringPolicy.from_dict(policy.CURRENT_POLICY.to_dict()), policy.CURRENT_POLICY)
+        self.assertEqual([slab.min_score for slab in self.candidate.slabs], [60, 40, 20])
+        for invalid in ({'name': 'x', 'slabs': []},
+                        {'name': 'x', 'slabs': [{'min_score': 10}, {'min_score': 10}]},
+                        {'name': 'x', 'slabs': [{'min_score': 10, 'rate_floor': 'high'}]},
+                        {'name': 'x', 'slabs': [{'min_score': 10}], 'max_emi_to_salary_percent': 0},
+                        {'slabs': [{'min_score': 10}]}):
+            with self.assertRaises(ValueError):
+                policy.ScoringPolicy.from_dict(invalid)
+
+    def test_chunks_match_profiles(self):
+        """Vectorised score inputs, scores and decisions agree with the scalar request path"""
+        year = date.today().year
+        chunks = [backtest.score_inputs(*ids, year) for ids in backtest.customer_ranges('default', 7)]
+        self.assertEqual([len(chunk['loan_count']) for chunk in chunks], [7] * 5 + [5])
+        customer_ids = iter(range(1, 41))
+        for chunk in chunks:
+            scores = backtest.credit_scores(chunk)
+            decisions = [p.decide(scores, self.application.interest_rate, chunk['total_emi'], chunk['monthly_salary'],
+                                  p.proposed_emi(self.application.loan_amount, self.application.tenure))
+                         for p in (policy.CURRENT_POLICY, self.candidate)]
+            for i in range(len(scores)):
+                profile = profile_cache.CustomerProfile.load(next(customer_ids))
+                for field in backtest.SCORE_INPUTS:
+                    self.assertEqual(chunk[field][i], getattr(profile, field), field)
+                self.assertEqual(scores[i], profile.credit_score())
+                for p, (approved, corrected) in zip((policy.CURRENT_POLICY, self.candidate), decisions):
+                    burden = profile.total_emi + p.proposed_emi(self.application.loan_amount, self.application.tenure)
+                    expected = (False, self.application.interest_rate)
+                    if not p.exceeds_emi_cap(burden, profile.monthly_salary):
+                        expected = p.apply_interest_rate_slab(profile.credit_score(), self.application.interest_rate)
+                    self.assertEqual((approved[i], corrected[i]), expected)
+
+    def test_credit_scores_match_reference(self):
+        rng = np.random.default_rng(7)
+        chunk = {
+            'approved_limit': rng.integers(0, 1000, 5000),
+            'current_debt': rng.integers(0, 1000, 5000),
+            'total_tenure': rng.integers(0, 200, 5000),
+            'loan_count': rng.integers(0, 15, 5000),
+            'current_year_loans': rng.integers(0, 6, 5000),
+        }
+        chunk['emis_paid_on_time'] = rng.integers(0, chunk['total_tenure'] + 1)
+        scores = backtest.credit_scores(chunk)
+        for i in range(5000):
+            self.assertEqual(scores[i], utils.credit_score_from_inputs(*(
+                int(chunk[field][i]) for field in ('current_debt', 'approved_limit', 'total_tenure',
+                                                   'emis_paid_on_time', 'loan_count', 'current_year_loans')
+            )))
+
+    def test_backtest_report(self):
+        year = date.today().year
+        ranges = backtest.customer_ranges('default', 9)
+        same = backtest.run_backtest(policy.CURRENT_POLICY, policy.CURRENT_POLICY, self.application, ranges, year)
+        self.assertEqual(same['overall']['customers'], 40)
+        self.assertEqual((same['overall']['newly_approved'], same['overall']['newly_rejected'],
+                          same['overall']['mean_rate_change']), (0, 0, 0))
+
+        report = backtest.run_backtest(policy.CURRENT_POLICY, self.candidate, self.application, ranges, year)
+        overall = report['overall']
+        self.assertGreater(overall['newly_rejected'], 0)
+        self.assertEqual(overall['candidate_approved'] - overall['baseline_approved'],
+                         overall['newly_approved'] - overall['newly_rejected'])
+        for segment, rows in report['segments'].items():
+            self.assertEqual(sum(row['customers'] for row in rows), 40, segment)
+            self.assertEqual(sum(row['newly_rejected'] for row in rows), overall['newly_rejected'], segment)
+        self.assertEqual([row['band'] for row in report['segments']['credit_score']],
+                         ['0-10', '11-20', '21-30', '31-40', '41-50', '51-60', '61+'])
+        self.assertEqual([row['band'] for row in report['segments']['loan_count']], ['0', '1-2', '3-5', '6+'])
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(f'{directory}/candidate.json', 'w') as f:
+                json.dump(self.candidate.to_dict(), f)
+            call_command('backtest_policy', f'{directory}/candidate.json', '--loan-amount', '300000',
+                         '--interest-rate', '11', '--workers', '1', '--chunk-size', '9',
+                         '--output', f'{directory}/report.json', stdout=io.StringIO())
+            with open(f'{directory}/report.json') as f:
+                report = json.load(f)
+        expected = backtest.run_backtest(policy.CURRENT_POLICY, self.candidate, self.application,
+                                         backtest.customer_ranges('default', 40), date.today().year)
+        self.assertEqual(report['segments'], expected['segments'])
+        self.assertEqual(report['candidate']['name'], 'stricter')
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class ParallelBacktestTestCase(BacktestBookMixin, TransactionTestCase):
+    """Worker processes read committed rows over their own connections"""
+
+    def test_workers_match_single_process(self):
+        year = date.today().year
+        ranges = backtest.customer_ranges('default', 6)
+        report = backtest.run_backtest(policy.CURRENT_POLICY, self.candidate, self.application, ranges, year)
+        parallel = backtest.run_backtest(policy.CURRENT_POLICY, self.candidate, self.application, ranges, year,
+                                         workers=2)
+        self.assertEqual(parallel, report)
+        self.assertEqual(Customer.objects.count(), 40)
+
+
+
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=['default'], REDIS_URL=None)
+class RegistrationGroupCommitTestCase(TransactionTestCase):
+    """Concurrent registrations share one insert and commit"""
+
+    registration = {'first_name': 'Group', 'last_name': 'Commit', 'age': 30,
+                    'phone_number': '9876543210', 'monthly_income': Decimal('50000.00')}
+
+    def register_concurrently(self, batcher, count):
+        results = [None] * count
+
+        def register(i):
+            try:
+                results[i] = batcher.register({**self.registration, 'first_name': f'Group{i}'})
+            except Exception as e:
+                results[i] = e
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=register, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_registrations_share_a_batch(self):
+        batcher = registrations.RegistrationBatcher(window=5, max_size=6)
+        with mock.patch.object(registrations, 'create_customers', wraps=registrations.create_customers) as create:
+            started = time.monotonic()
+            customers = self.register_concurrently(batcher, 6)
+        # A full batch is written without waiting for the window to close
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(sorted(customer.customer_id for customer in customers), list(range(1, 7)))
+        for i, customer in enumerate(customers):
+            self.assertEqual(customer.first_name, f'Group{i}')
+            self.assertIsNotNone(customer.pk)
+            self.assertEqual(Customer.objects.get(customer_id=customer.customer_id).first_name, f'Group{i}')
+
+    def test_failed_batch_fails_every_request(self):
+        batcher = registrations.RegistrationBatcher(window=5, max_size=3)
+        with mock.patch.object(registrations, 'create_customers', side_effect=IntegrityError('boom')):
+            results = self.register_concurrently(batcher, 3)
+        self.assertTrue(all(isinstance(result, IntegrityError) for result in results))
+        self.assertFalse(Customer.objects.exists())
+
+    @override_settings(REGISTER_GROUP_COMMIT=True)
+    def test_register_endpoint(self):
+        response = APIClient().post('/register', {**self.registration, 'monthly_income': 50000}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['customer_id'], 1)
+        self.assertEqual(response.data['approved_limit'], '1800000.00')
+
+    @override_settings(REGISTER_GROUP_COMMIT=True)
+    def test_every_request_in_a_batch_is_pinned(self):
+        """Requests whose customers the leader wrote still get the primary_pin cookie"""
+        responses = [None] * 3
+
+        def register(i):
+            try:
+                responses[i] = APIClient().post('/register', {**self.registration, 'monthly_income': 50000},
+                                                format='json')
+            finally:
+                connection.close()
+
+        with mock.patch.object(registrations, 'batcher', registrations.RegistrationBatcher(window=5, max_size=3)), \
+                mock.patch.object(registrations, 'create_customers', wraps=registrations.create_customers) as create:
+            threads = [threading.Thread(target=register, args=(i,)) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(create.call_count, 1)
+        for response in responses:
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertIn(db_router.PIN_COOKIE, response.cookies)
+
+    def test_customer_id_collisions_are_retried(self):
+        Customer.objects.create(customer_id=1, first_name='A', last_name='B', age=30, phone_number='1',
+                                monthly_salary=1, approved_limit=1, current_debt=0)
+        with mock.patch.object(registrations, 'next_customer_id', side_effect=[1, 2]):
+            customers = registrations.create_customers([self.registration, self.registration])
+        self.assertEqual([customer.customer_id for customer in customers], [2, 3])
+        self.assertEqual(Customer.objects.count(), 3)
+
+
+class MoneyEquivalenceTestCase(SimpleTestCase):
+    """The integer paise compute path agrees with the Decimal reference in loans.utils"""
+
+    def test_boundary_round_trip(self):
+        for value in ['0.00', '0.01', '8884.88', '99999999.99', '1800000']:
+            self.assertEqual(money.from_paise(money.to_paise(Decimal(value))), Decimal(value))
+            self.assertEqual(money.from_basis_points(money.to_basis_points(Decimal(value))), Decimal(value))
+        self.assertEqual(money.to_paise(Decimal('0.005')), 1)
+        self.assertEqual(money.to_paise(25), 2500)
+
+    def test_round_nearest_lakh(self):
+        for rupees in list(range(0, 400001, 50)) + [149999, 150000, 1849999, 1850000]:
+            with self.subTest(rupees=rupees):
+                self.assertEqual(
+                    money.from_paise(money.round_nearest_lakh(money.to_paise(rupees))),
+                    round_nearest_lakh(rupees),
+                )
+
+    def test_emi(self):
+        """
+        Every EMI matches calculate_emi, except where the exact EMI is a half
+        paisa: the integer path rounds it up, Decimal can land either side
+        """
+        principals = list(range(1, 2001)) + list(range(100000, 100000000, 99991)) + [10 ** 11 - 1]
+        rates = [0, 1, 99, 500, 1000, 1199, 1200, 1450, 1600, 2499, 9999]
+        tenures = [1, 2, 3, 6, 12, 24, 36, 60, 119, 120]
+        for principal in principals:
+            for rate in rates[1:]:
+                for tenure in tenures:
+                    expected = utils.calculate_emi(money.from_paise(principal), money.from_basis_points(rate), tenure)
+                    emi = money.calculate_emi(principal, rate, tenure)
+                    if money.to_paise(expected) != emi:
+                        exact = Fraction(principal * rate * (120000 + rate) ** tenure,
+                                         120000 * ((120000 + rate) ** tenure - 120000 ** tenure))
+                        self.assertEqual(exact.denominator, 2, (principal, rate, tenure))
+                        self.assertEqual(emi, exact + Fraction(1, 2))
+        for principal in principals:
+            for tenure in tenures:
+                self.assertEqual(money.calculate_emi(principal, 0, tenure),
+                                 money.to_paise(utils.calculate_emi(money.from_paise(principal), Decimal('0'), tenure)))
+
+    def test_emi_cap_and_slabs(self):
+        for salary in range(0, 100001, 7):
+            for total_emi in (0, salary // 2 - 1, salary // 2, salary // 2 + 1, salary):
+                exceeds = Decimal(total_emi) / 100 > Decimal(salary) / 100 * Decimal('0.50')
+                self.assertEqual(money.exceeds_emi_cap(total_emi, salary), exceeds)
+                self.assertEqual(policy.CURRENT_POLICY.exceeds_emi_cap(total_emi, salary), exceeds)
+                headroom = money.emi_headroom(salary, total_emi)
+                self.assertFalse(money.exceeds_emi_cap(total_emi + headroom, salary) and headroom)
+                self.assertTrue(money.exceeds_emi_cap(total_emi + headroom + 1, salary))
+        for score in range(0, 101):
+            for rate in (0, 1, 1199, 1200, 1201, 1599, 1600, 1601, 2500):
+                # The slabs documented under "Approval Rules" in the README
+                expected = ((True, rate) if score > 50 else (True, max(rate, 1200)) if score > 30
+                            else (True, max(rate, 1600)) if score > 10 else (False, rate))
+                self.assertEqual(policy.CURRENT_POLICY.apply_interest_rate_slab(score, rate), expected)
+
+    def test_credit_score(self):
+        """Scores from paise and from Decimal rupees are identical"""
+        limits = [0, 1, 3, 4, 100, 180000000]
+        for limit in limits:
+            for debt in sorted({0, 1, limit // 2, limit // 2 + 1, limit * 3 // 4, limit * 3 // 4 + 1, limit, limit + 1}):
+                if limit:
+                    # The previous implementation divided Decimals
+                    ratio = money.from_paise(debt) / money.from_paise(limit)
+                    previous = (25 if ratio <= Decimal('0.5') else 15 if ratio <= Decimal('0.75')
+                                else 5 if ratio <= Decimal('1.0') else 0)
+                    self.assertEqual(utils.credit_score_from_inputs(debt, limit, 0, 0, 0, 0),
+                                     previous if debt <= limit else 0)
+                for inputs in [(0, 0, 0, 0), (12, 12, 1, 1), (100, 37, 6, 5)]:
+                    self.assertEqual(
+                        utils.credit_score_from_inputs(debt, limit, *inputs),
+                        utils.credit_score_from_inputs(money.from_paise(debt), money.from_paise(limit), *inputs),
+                    )
+
+
+class ShardMapTestCase(SimpleTestCase):
+    """Test the customer shard map and router"""
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard_1', 'shard_2'])
+    def test_customers_spread_over_shards(self):
+        counts = {}
+        for customer_id in range(1, 30001):
+            shard = sharding.shard_for_customer(customer_id)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(set(counts), {'default', 'shard_1', 'shard_2'})
+        for count in counts.values():
+            self.assertAlmostEqual(count / 30000, 1 / 3, delta=0.02)
+        self.assertEqual(sharding.shard_for_customer(42), sharding.shard_for_customer('42'))
+        self.assertEqual(sharding.shard_aliases(), ['default', 'shard_1', 'shard_2'])
+
+    @override_settings(DATABASE_SHARDS=['default'])
+    def test_unsharded_helpers_defer_to_routers(self):
+        self.assertIsNone(sharding.shard_for_customer(1))
+        self.assertIsNone(sharding.shard_for_loan(1))
+        self.assertEqual(sharding.shard_aliases(), [None])
+        router = sharding.ShardRouter()
+        self.assertIsNone(router.db_for_write(Customer, instance=Customer(customer_id=1)))
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard_1'])
+    def test_router(self):
+        router = sharding.ShardRouter()
+        customer = Customer(customer_id=next(i for i in range(1, 100) if sharding.shard_for_customer(i) == 'shard_1'))
+        self.assertEqual(router.db_for_write(Customer, instance=customer), 'shard_1')
+        self.assertEqual(router.db_for_write(Loan, instance=Loan(customer=customer)), 'shard_1')
+        self.assertIsNone(router.db_for_read(Loan))
+        self.assertIsNone(router.db_for_read(OutboxEvent, instance=OutboxEvent()))
+
+        other = Customer(customer_id=customer.customer_id)
+        other._state.db = 'default'
+        customer._state.db = 'shard_1'
+        self.assertFalse(router.allow_relation(customer, other))
+        self.assertTrue(router.allow_relation(customer, Loan(customer=customer)))
+        self.assertFalse(router.allow_migrate('shard_1', 'loans', model_name='loanindex'))
+        self.assertIsNone(router.allow_migrate('default', 'loans', model_name='loanindex'))
+        self.assertIsNone(router.allow_migrate('shard_1', 'loans', model_name='loan'))
+
+
+REPLICA_ALIASES = sorted(alias for alias in settings.DATABASES if alias.startswith('replica_'))
+
+
+@skipUnless(REPLICA_ALIASES, 'set POSTGRES_REPLICA_HOSTS to test replica reads')
+@override_settings(DATABASE_REPLICAS=REPLICA_ALIASES, DATABASE_SHARDS=['default'], REDIS_URL=None)
+class ReplicaReadTestCase(TestCase):
+    """Test reads from replicas that haven't caught up"""
+    databases = '__all__'
+
+    def setUp(self):
+        # Test mirrors can't see rows created inside the test's transaction,
+        # like a replica that hasn't replayed them yet
+        for alias in REPLICA_ALIASES:
+            db_router._replica_health[alias] = (time.monotonic(), True)
+        self.addCleanup(db_router._replica_health.clear)
+        customer = Customer.objects.create(customer_id=1, first_name='A', last_name='B', age=30, phone_number='1',
+                                           monthly_salary=1, approved_limit=1, current_debt=0)
+        Loan.objects.create(loan_id=1, customer=customer, loan_amount=Decimal('1000'), tenure=10,
+                            interest_rate=Decimal('12.00'), monthly_repayment=Decimal('105.58'),
+                            start_date=date(2024, 1, 1), end_date=date(2024, 11, 1))
+
+    def test_new_rows_are_read_from_the_primary(self):
+        """Clients without the primary_pin cookie still find loans the replica doesn't have yet"""
+        response = self.client.get('/view-loan/1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], '"1.1.2"')
+        self.assertEqual([loan['loan_id'] for loan in self.client.get('/view-loans/1').data], [1])
+        self.assertEqual(self.client.get('/view-loan/2').status_code, status.HTTP_404_NOT_FOUND)
+
+
+SHARD_ALIASES = ['default'] + sorted(alias for alias in settings.DATABASES if alias.startswith('shard_'))
+
+
+@skipUnless(len(SHARD_ALIASES) > 1, 'set POSTGRES_SHARD_HOSTS (and POSTGRES_SHARD_NAMES) to test sharding')
+@override_settings(DATABASE_REPLICAS=[], DATABASE_SHARDS=SHARD_ALIASES, REDIS_URL=None)
+class ShardedStorageTestCase(TestCase):
+    """Test customers and loans stored across several databases"""
+    databases = '__all__'
+    client_class = APIClient
+
+    def setUp(self):
+        profile_cache.local_cache.clear()
+
+    def register(self, monthly_income=50000):
+        response = self.client.post('/register', {
+            'first_name': 'John', 'last_name': 'Doe', 'age': 30,
+            'monthly_income': monthly_income, 'phone_number': '9999999999',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['customer_id']
+
+    def create_loan(self, customer_id, loan_amount=100000):
+        with mock.patch.object(outbox, '_schedule_drain'):
+            response = self.client.post('/create-loan', {
+                'customer_id': customer_id, 'loan_amount': loan_amount,
+                'interest_rate': 14, 'tenure': 12,
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        return response.data['loan_id']
+
+    def test_failed_loan_write_releases_loan_id(self):
+        """A loan_id whose shard write fails is dropped from the index and reused"""
+        customer_id = self.register()
+        with mock.patch.object(outbox, 'publish', side_effect=DatabaseError('shard down')):
+            with self.assertRaises(DatabaseError):
+                self.create_loan(customer_id)
+        self.assertFalse(LoanIndex.objects.exists())
+        self.assertFalse(Loan.objects.using(sharding.shard_for_customer(customer_id)).exists())
+        self.assertEqual(self.create_loan(customer_id), 1)
+        self.assertEqual(LoanIndex.objects.get().loan_id, 1)
+
+    def test_failed_loan_ingestion_releases_loan_ids(self):
+        """Ingested loans whose shard write fails are dropped from the index and written by the next run"""
+        customer_id = self.register()
+        shard = sharding.shard_for_customer(customer_id)
+        loans, _ = validate_loans(pd.DataFrame({
+            'Customer ID': [customer_id] * 2, 'Loan ID': [10, 11], 'Loan Amount': [100000] * 2,
+            'Tenure': [12] * 2, 'Interest Rate': [10.5] * 2, 'Monthly payment': [8800] * 2,
+            'EMIs paid on Time': [3] * 2, 'Date of Approval': ['2023-01-15'] * 2, 'End Date': ['2024-01-15'] * 2,
+        }), {customer_id})
+        customer_ids = {customer_id: Customer.objects.using(shard).get(customer_id=customer_id).pk}
+        bulk_create = QuerySet.bulk_create
+
+        def fail_on_loans(queryset, objs, *args, **kwargs):
+            if queryset.model is Loan:
+                raise DatabaseError('shard down')
+            return bulk_create(queryset, objs, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'bulk_create', fail_on_loans):
+            with self.assertRaises(DatabaseError):
+                tasks._save_loans(shard, loans, customer_ids)
+        self.assertFalse(LoanIndex.objects.exists())
+
+        self.assertEqual(tasks._save_loans(shard, loans, customer_ids), 2)
+        self.assertEqual(sorted(LoanIndex.objects.values_list('loan_id', flat=True)), [10, 11])
+        self.assertEqual(sharding.shard_for_loan(10), shard)
+        self.assertEqual(Loan.objects.using(shard).count(), 2)
+        self.assertEqual(Customer.objects.using(shard).get(customer_id=customer_id).current_debt,
+                         Decimal('150000.00'))
+
+    def test_shard_outbox_invalidates_after_shard_commit(self):
+        """Draining a shard's outbox drops cached profiles when that shard's transaction commits"""
+        customer_id = next(customer_id for customer_id in iter(self.register, None)
+                           if sharding.shard_for_customer(customer_id) != 'default')
+        shard = sharding.shard_for_customer(customer_id)
+        self.create_loan(customer_id)
+        with mock.patch.object(profile_cache, '_invalidate') as invalidate:
+            with self.captureOnCommitCallbacks(using=shard, execute=True):
+                self.assertEqual(outbox.drain(using=shard), 1)
+                invalidate.assert_not_called()
+        invalidate.assert_called_once_with([customer_id])
+
+    def test_customers_and_loans_live_on_their_shard(self):
+        customer_ids = [self.register() for _ in range(12)]
+        self.assertEqual(customer_ids, list(range(1, 13)))
+        loan_ids = [self.create_loan(customer_id) for customer_id in customer_ids]
+        self.assertEqual(loan_ids, list(range(1, 13)))
+
+        for customer_id, loan_id in zip(customer_ids, loan_ids):
+            shard = sharding.shard_for_customer(customer_id)
+            for alias in SHARD_ALIASES:
+                self.assertEqual(Customer.objects.using(alias).filter(customer_id=customer_id).exists(),
+                                 alias == shard)
+                self.assertEqual(Loan.objects.using(alias).filter(loan_id=loan_id).exists(), alias == shard)
+            self.assertEqual(sharding.shard_for_loan(loan_id), shard)
+            self.assertEqual(Customer.objects.using(shard).get(customer_id=customer_id).current_debt,
+                             Decimal('100000.00'))
+        self.assertEqual(LoanIndex.objects.count(), 12)
+        self.assertEqual(len({sharding.shard_for_customer(i) for i in customer_ids}), len(SHARD_ALIASES))
+
+        for customer_id, loan_id in zip(customer_ids, loan_ids):
+            response = self.client.get(f'/view-loan/{loan_id}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['customer']['id'], customer_id)
+            response = self.client.get(f'/view-loans/{customer_id}')
+            self.assertEqual([loan['loan_id'] for loan in response.data], [loan_id])
+        self.assertEqual(self.client.get('/view-loan/999').status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.post('/view-loans/batch?stream=1', {'customer_ids': customer_ids}, format='json')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([(line['customer_id'], [loan['loan_id'] for loan in line['loans']]) for line in lines],
+                         list(zip(customer_ids, [[loan_id] for loan_id in loan_ids])))
+
+        # Each shard's outbox holds the events of its own loans
+        self.assertEqual(outbox.outbox_lag()['pending'], 12)
+        self.assertEqual(tasks.drain_outbox(), 12)
+        self.assertEqual(outbox.outbox_lag()['pending'], 0)
+
+    def test_bulk_repayments_across_shards(self):
+        customer_ids = [self.register() for _ in range(6)]
+        loan_ids = [self.create_loan(customer_id, loan_amount=120000) for customer_id in customer_ids]
+        entries = [{'loan_id': loan_id, 'emis_paid': 3, 'on_time': True} for loan_id in loan_ids]
+        entries.append({'loan_id': 999, 'emis_paid': 1, 'on_time': True})
+        with mock.patch.object(outbox, '_schedule_drain'):
+            response = self.client.post('/repayments/bulk', {'idempotency_key': 'file-1', 'repayments': entries},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['loans_updated'], 6)
+        self.assertEqual(response.data['unknown_loan_ids'], [999])
+        for customer_id in customer_ids:
+            customer = Customer.objects.using(sharding.shard_for_customer(customer_id)).get(customer_id=customer_id)
+            self.assertEqual(customer.current_debt, Decimal('90000.00'))
@@ -4,7 +4,13 @@ from . import views
 urlpatterns = [
     path('register', views.register_customer, name='register_customer'),
     path('check-eligibility', views.check_eligibility, name='check_eligibility'),
+    path('loan-offers', views.loan_offers, name='loan_offers'),
     path('create-loan', views.create_loan, name='create_loan'),
     path('view-loan/<int:loan_id>', views.view_loan, name='view_loan'),
     path('view-loans/<int:customer_id>', views.view_customer_loans, name='view_customer_loans'),
+    path('view-loans/batch', views.view_customer_loans_batch, name='view_customer_loans_batch'),
+    path('repayments/bulk', views.bulk_repayments, name='bulk_repayments'),
+    path('ingest-jobs', views.ingest_jobs, name='ingest_jobs'),
+    path('ingest-jobs/<str:task_id>', views.ingest_job, name='ingest_job'),
+    path('metrics', views.metrics, name='metrics'),
 ]
@@ -1,6 +1,6 @@
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, date
-from django.db.models import Sum, Q
+from django.db.models import Count, Sum, Q
 import math
 
 
@@ -38,7 +38,27 @@ def calculate_emi(principal, annual_rate, n_months):
     return emi.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
 
-def calculate_credit_score(customer, loans_queryset=None):
+def loan_score_inputs(loans_queryset, year=None):
+    """
+    Credit score inputs and the EMI total of a customer's loans, aggregated
+    in a single query
+    """
+    year = year or datetime.now().year
+    inputs = loans_queryset.aggregate(
+        total_tenure=Sum('tenure'),
+        emis_paid_on_time=Sum('emis_paid_on_time'),
+        loan_count=Count('id'),
+        current_year_loans=Count('id', filter=Q(start_date__year=year)),
+        total_emi=Sum('monthly_repayment'),
+    )
+    inputs['total_tenure'] = inputs['total_tenure'] or 0
+    inputs['emis_paid_on_time'] = inputs['emis_paid_on_time'] or 0
+    inputs['total_emi'] = inputs['total_emi'] or Decimal('0.00')
+    return inputs
+
+
+def credit_score_from_inputs(current_debt, approved_limit, total_tenure, emis_paid_on_time,
+                             loan_count, current_year_loans):
     """
     Calculate credit score based on:
     - % EMIs paid on time (35 points)
@@ -46,46 +66,53 @@ def calculate_credit_score(customer, loans_queryset=None):
     - Loan activity in current year (20 points)
     - Loan volume vs approved limit (25 points)
     """
-    if loans_queryset is None:
-        loans_queryset = customer.loans.all()
-    
     # If total current debt exceeds approved limit, score = 0
-    if customer.current_debt > customer.approved_limit:
+    if current_debt > approved_limit:
         return 0
     
     score = 0
     
     # 1. EMIs paid on time (35 points max)
-    total_emis = loans_queryset.aggregate(
-        total_emis=Sum('tenure'),
-        paid_on_time=Sum('emis_paid_on_time')
-    )
-    
-    if total_emis['total_emis'] and total_emis['total_emis'] > 0:
-        emi_percentage = (total_emis['paid_on_time'] or 0) / total_emis['total_emis']
+    if total_tenure and total_tenure > 0:
+        emi_percentage = (emis_paid_on_time or 0) / total_tenure
         score += min(35, int(emi_percentage * 35))
     
     # 2. Number of past loans (20 points max)
-    loan_count = loans_queryset.count()
     if loan_count > 0:
         # More loans = better history, but cap at 20 points
         score += min(20, loan_count * 2)
     
     # 3. Loan activity in current year (20 points max)
-    current_year = datetime.now().year
-    current_year_loans = loans_queryset.filter(start_date__year=current_year).count()
     if current_year_loans > 0:
         score += min(20, current_year_loans * 5)
     
     # 4. Loan volume vs approved limit (25 points max)
-    if customer.approved_limit > 0:
-        volume_ratio = customer.current_debt / customer.approved_limit
-        if volume_ratio <= Decimal('0.5'):  # Less than 50% utilization
+    # Ratios are compared by cross-multiplying, so Decimal rupees and integer
+    # paise (loans.money) score identically
+    if approved_limit > 0:
+        if current_debt * 2 <= approved_limit:  # Less than 50% utilization
             score += 25
-        elif volume_ratio <= Decimal('0.75'):  # 50-75% utilization
+        elif current_debt * 4 <= approved_limit * 3:  # 50-75% utilization
             score += 15
-        elif volume_ratio <= Decimal('1.0'):  # 75-100% utilization
+        elif current_debt <= approved_limit:  # 75-100% utilization
             score += 5
         # Above 100% already handled above (returns 0)
     
     return min(100, max(0, score))
+
+
+def calculate_credit_score(customer, loans_queryset=None):
+    """Credit score of a customer from their loans (see credit_score_from_inputs)"""
+    if loans_queryset is None:
+        loans_queryset = customer.loans.all()
+    
+    # No need to look at the loans when debt already exceeds the limit
+    if customer.current_debt > customer.approved_limit:
+        return 0
+    
+    inputs = loan_score_inputs(loans_queryset)
+    return credit_score_from_inputs(
+        customer.current_debt, customer.approved_limit, inputs['total_tenure'],
+        inputs['emis_paid_on_time'], inputs['loan_count'], inputs['current_year_loans'],
+    )
+
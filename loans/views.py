@@ -1,18 +1,38 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.shortcuts import get_object_or_404
-from django.db import models
+from django.utils import timezone
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+import json
 from decimal import Decimal
 from datetime import date, timedelta
-from .models import Customer, Loan
+from .models import Customer, IngestionJob, Loan
 from .serializers import (
     CustomerRegistrationSerializer, CustomerRegistrationResponseSerializer,
     CheckEligibilitySerializer, CheckEligibilityResponseSerializer,
     CreateLoanSerializer, CreateLoanResponseSerializer,
-    LoanDetailSerializer, CustomerLoansSerializer
+    LoanOffersSerializer, LoanOffersResponseSerializer,
+    LoanDetailSerializer, CustomerLoansSerializer, CustomerLoansBatchSerializer,
+    BulkRepaymentSerializer, BulkRepaymentResponseSerializer,
+    IngestionJobSerializer
 )
-from .utils import calculate_credit_score, calculate_emi
+from .utils import calculate_credit_score
+from . import money
+from .db_router import use_replica
+from .admission import admission_control, check_deadline
+from .offers import loan_offer_table
+from .policy import CURRENT_POLICY
+from .profile_cache import cache_stats, get_customer_profile
+from . import outbox, tasks
+from .sharding import allocate_loan_id, release_loan_ids, shard_for_customer, shard_for_loan
+from .repayments import post_repayments
+from .listings import customer_loan_lists
 
 
 @api_view(['POST'])
@@ -27,6 +47,8 @@ def register_customer(request):
 
 
 @api_view(['POST'])
+@admission_control('check_eligibility')
+@use_replica
 def check_eligibility(request):
     """Check loan eligibility for a customer"""
     serializer = CheckEligibilitySerializer(data=request.data)
@@ -34,28 +56,23 @@ def check_eligibility(request):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     data = serializer.validated_data
-    try:
-        customer = Customer.objects.get(customer_id=data['customer_id'])
-    except Customer.DoesNotExist:
+    profile = get_customer_profile(data['customer_id'])
+    if profile is None:
         return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    # Calculate credit score
-    loans_queryset = customer.loans.all()
-    credit_score = calculate_credit_score(customer, loans_queryset)
+    # Money is integer paise and rates are basis points until the response
+    loan_amount = money.to_paise(data['loan_amount'])
+    interest_rate = money.to_basis_points(data['interest_rate'])
     
-    # Check if sum of current EMIs + proposed loan EMI > 50% of monthly salary
-    total_current_emis = loans_queryset.aggregate(
-        total_emi=models.Sum('monthly_repayment')
-    )['total_emi'] or Decimal('0.00')
+    # Calculate credit score
+    credit_score = profile.credit_score()
     
     # Calculate proposed loan EMI (assuming worst case interest rate for estimation)
-    proposed_emi = calculate_emi(data['loan_amount'], Decimal('16.00'), data['tenure'])
-    total_emi_burden = total_current_emis + proposed_emi
-    
-    max_allowed_emi = customer.monthly_salary * Decimal('0.50')  # 50% of monthly salary
+    proposed_emi = CURRENT_POLICY.proposed_emi(loan_amount, data['tenure'])
+    total_emi_burden = profile.total_emi + proposed_emi
     
-    # If total EMI burden exceeds 50% of salary, don't approve
-    if total_emi_burden > max_allowed_emi:
+    # If total EMI burden exceeds the policy's share of salary (50%), don't approve
+    if CURRENT_POLICY.exceeds_emi_cap(total_emi_burden, profile.monthly_salary):
         approval = False
         corrected_interest_rate = data['interest_rate']
         monthly_installment = Decimal('0.00')
@@ -75,42 +92,20 @@ def check_eligibility(request):
         return Response(response_serializer.errors, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     # Determine approval and corrected interest rate based on credit score
-    approval = False
-    corrected_interest_rate = data['interest_rate']
-    
-    if credit_score > 50:
-        approval = True
-    elif 30 < credit_score <= 50:
-        if data['interest_rate'] >= 12:
-            approval = True
-        else:
-            approval = True
-            corrected_interest_rate = Decimal('12.00')
-    elif 10 < credit_score <= 30:
-        if data['interest_rate'] >= 16:
-            approval = True
-        else:
-            approval = True
-            corrected_interest_rate = Decimal('16.00')
-    else:  # credit_score <= 10
-        approval = False
+    approval, corrected_interest_rate = CURRENT_POLICY.apply_interest_rate_slab(credit_score, interest_rate)
     
     # Calculate monthly installment using corrected interest rate
-    monthly_installment = Decimal('0.00')
+    monthly_installment = 0
     if approval:
-        monthly_installment = calculate_emi(
-            data['loan_amount'],
-            corrected_interest_rate,
-            data['tenure']
-        )
+        monthly_installment = money.calculate_emi(loan_amount, corrected_interest_rate, data['tenure'])
     
     response_data = {
         'customer_id': data['customer_id'],
         'approval': approval,
         'interest_rate': data['interest_rate'],
-        'corrected_interest_rate': corrected_interest_rate,
+        'corrected_interest_rate': money.from_basis_points(corrected_interest_rate),
         'tenure': data['tenure'],
-        'monthly_installment': monthly_installment
+        'monthly_installment': money.from_paise(monthly_installment)
     }
     
     response_serializer = CheckEligibilityResponseSerializer(data=response_data)
@@ -120,6 +115,44 @@ def check_eligibility(request):
 
 
 @api_view(['POST'])
+@admission_control('loan_offers')
+@use_replica
+def loan_offers(request):
+    """
+    Maximum loan amount per tenure (1-120 months) a customer qualifies for,
+    under the same rules as check_eligibility
+    """
+    serializer = LoanOffersSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    data = serializer.validated_data
+    profile = get_customer_profile(data['customer_id'])
+    if profile is None:
+        return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    # Score and EMI headroom are computed once for the whole table
+    credit_score = profile.credit_score()
+    emi_headroom = CURRENT_POLICY.emi_headroom(profile.monthly_salary, profile.total_emi)
+    
+    approval, corrected_interest_rate = CURRENT_POLICY.apply_interest_rate_slab(
+        credit_score, money.to_basis_points(data['interest_rate'])
+    )
+    offers = loan_offer_table(emi_headroom, corrected_interest_rate) if approval else []
+    
+    response_data = {
+        'customer_id': data['customer_id'],
+        'approval': bool(offers),
+        'interest_rate': data['interest_rate'],
+        'corrected_interest_rate': money.from_basis_points(corrected_interest_rate),
+        'available_monthly_installment': money.from_paise(emi_headroom),
+        'offers': offers,
+    }
+    return Response(LoanOffersResponseSerializer(response_data).data, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@admission_control('create_loan')
 def create_loan(request):
     """Create a new loan if customer is eligible"""
     serializer = CreateLoanSerializer(data=request.data)
@@ -128,7 +161,9 @@ def create_loan(request):
     
     data = serializer.validated_data
     try:
-        customer = Customer.objects.get(customer_id=data['customer_id'])
+        customer = Customer.objects.using(shard_for_customer(data['customer_id'])).get(
+            customer_id=data['customer_id']
+        )
     except Customer.DoesNotExist:
         return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
     
@@ -136,21 +171,23 @@ def create_loan(request):
     loans_queryset = customer.loans.all()
     credit_score = calculate_credit_score(customer, loans_queryset)
     
+    # Money is integer paise and rates are basis points until the loan is saved
+    loan_amount = money.to_paise(data['loan_amount'])
+    interest_rate = money.to_basis_points(data['interest_rate'])
+    
     # Check if sum of current EMIs + proposed loan EMI > 50% of monthly salary
-    total_current_emis = loans_queryset.aggregate(
+    total_current_emis = money.to_paise(loans_queryset.aggregate(
         total_emi=models.Sum('monthly_repayment')
-    )['total_emi'] or Decimal('0.00')
+    )['total_emi'] or 0)
     
     # Calculate proposed loan EMI (assuming worst case interest rate)
-    proposed_emi = calculate_emi(data['loan_amount'], Decimal('16.00'), data['tenure'])
+    proposed_emi = CURRENT_POLICY.proposed_emi(loan_amount, data['tenure'])
     total_emi_burden = total_current_emis + proposed_emi
     
-    max_allowed_emi = customer.monthly_salary * Decimal('0.50')  # 50% of monthly salary
-    
-    # If total EMI burden exceeds 50% of salary, don't approve
-    if total_emi_burden > max_allowed_emi:
+    # If total EMI burden exceeds the policy's share of salary (50%), don't approve
+    if CURRENT_POLICY.exceeds_emi_cap(total_emi_burden, money.to_paise(customer.monthly_salary)):
         approval = False
-        message = "Loan not approved: current EMIs exceed 50% of monthly salary"
+        message = f"Loan not approved: current EMIs exceed {CURRENT_POLICY.max_emi_to_salary_percent}% of monthly salary"
         
         response_data = {
             'loan_id': None,
@@ -166,63 +203,63 @@ def create_loan(request):
         return Response(response_serializer.errors, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     # Determine approval and corrected interest rate (same logic as check_eligibility)
-    approval = False
-    corrected_interest_rate = data['interest_rate']
-    message = "Loan not approved due to low credit score"
-    
-    if credit_score > 50:
-        approval = True
+    approval, corrected_rate = CURRENT_POLICY.apply_interest_rate_slab(credit_score, interest_rate)
+    corrected_interest_rate = money.from_basis_points(corrected_rate)
+    if not approval:
+        message = "Loan not approved due to low credit score"
+    elif corrected_rate != interest_rate:
+        message = f"Loan approved with corrected interest rate: {corrected_interest_rate}%"
+    else:
         message = "Loan approved"
-    elif 30 < credit_score <= 50:
-        if data['interest_rate'] >= 12:
-            approval = True
-            message = "Loan approved"
-        else:
-            approval = True
-            corrected_interest_rate = Decimal('12.00')
-            message = f"Loan approved with corrected interest rate: {corrected_interest_rate}%"
-    elif 10 < credit_score <= 30:
-        if data['interest_rate'] >= 16:
-            approval = True
-            message = "Loan approved"
-        else:
-            approval = True
-            corrected_interest_rate = Decimal('16.00')
-            message = f"Loan approved with corrected interest rate: {corrected_interest_rate}%"
     
     monthly_installment = Decimal('0.00')
     loan_id = None
     
     if approval:
+        # Don't write a loan the client has already given up on
+        check_deadline()
+
         # Calculate monthly installment
-        monthly_installment = calculate_emi(
-            data['loan_amount'],
-            corrected_interest_rate,
-            data['tenure']
-        )
+        monthly_installment = money.from_paise(money.calculate_emi(loan_amount, corrected_rate, data['tenure']))
         
-        # Generate loan_id
-        last_loan = Loan.objects.order_by('-loan_id').first()
-        loan_id = (last_loan.loan_id + 1) if last_loan else 1
+        # Generate loan_id. When sharded it is indexed on the default
+        # database before the loan is written, and released if that fails.
+        loan_id = allocate_loan_id(customer.customer_id)
         
         # Create loan
         start_date = date.today()
         end_date = start_date + timedelta(days=data['tenure'] * 30)  # Approximate
         
-        loan = Loan.objects.create(
-            loan_id=loan_id,
-            customer=customer,
-            loan_amount=data['loan_amount'],
-            tenure=data['tenure'],
-            interest_rate=corrected_interest_rate,
-            monthly_repayment=monthly_installment,
-            start_date=start_date,
-            end_date=end_date
-        )
-        
-        # Update customer's current debt
-        customer.current_debt += data['loan_amount']
-        customer.save()
+        # Only the loan, the debt it adds and its outbox event are written on
+        # the request path; derived updates are applied by drain_outbox. All of
+        # them go to the customer's shard.
+        db = customer._state.db
+        try:
+            with transaction.atomic(using=db):
+                loan = Loan.objects.using(db).create(
+                    loan_id=loan_id,
+                    customer=customer,
+                    loan_amount=data['loan_amount'],
+                    tenure=data['tenure'],
+                    interest_rate=corrected_interest_rate,
+                    monthly_repayment=monthly_installment,
+                    start_date=start_date,
+                    end_date=end_date
+                )
+                
+                # Update customer's current debt
+                Customer.objects.using(db).filter(pk=customer.pk).update(
+                    current_debt=models.F('current_debt') + data['loan_amount']
+                )
+                
+                outbox.publish(outbox.LOAN_CREATED, {
+                    'loan_id': loan.loan_id,
+                    'customer_id': customer.customer_id,
+                    'loan_amount': str(loan.loan_amount),
+                }, using=db)
+        except Exception:
+            release_loan_ids([loan_id])
+            raise
         
         loan_id = loan.loan_id
     
@@ -240,26 +277,171 @@ def create_loan(request):
     return Response(response_serializer.errors, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _last_modified(updated_at):
+    """
+    Last-Modified timestamp for data last written at updated_at, or None
+    while it is under a second old. A later write in the same second would
+    share the truncated timestamp and get If-Modified-Since clients a 304.
+    """
+    if timezone.now() - updated_at < timedelta(seconds=1):
+        return None
+    return int(updated_at.timestamp())
+
+
+def _with_validators(response, etag, updated_at):
+    response['ETag'] = etag
+    last_modified = _last_modified(updated_at)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _not_modified(request, etag, updated_at):
+    """
+    A 304 (or 412) response if the request's If-None-Match / If-Modified-Since
+    match the current validators, else None
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=_last_modified(updated_at))
+    return response and _with_validators(response, etag, updated_at)
+
+
 @api_view(['GET'])
+@use_replica
 def view_loan(request, loan_id):
     """View details of a specific loan"""
+    # The ETag and the body are read from the same database
     try:
-        loan = Loan.objects.select_related('customer').get(loan_id=loan_id)
+        db = shard_for_loan(loan_id) or router.db_for_read(Loan)
     except Loan.DoesNotExist:
         return Response({'error': 'Loan not found'}, status=status.HTTP_404_NOT_FOUND)
+    # Only the versions are read to answer a conditional request
+    version_query = (Loan.objects.filter(loan_id=loan_id)
+                     .values('version', 'updated_at', 'customer__version', 'customer__updated_at'))
+    versions = version_query.using(db).first()
+    if versions is None and db in settings.DATABASE_REPLICAS:
+        # The loan may be newer than the replica, for clients without the pin cookie
+        db = DEFAULT_DB_ALIAS
+        versions = version_query.using(db).first()
+    if versions is None:
+        return Response({'error': 'Loan not found'}, status=status.HTTP_404_NOT_FOUND)
+    loans = Loan.objects.using(db).filter(loan_id=loan_id)
+    
+    not_modified = _not_modified(
+        request, f'"{loan_id}.{versions["version"]}.{versions["customer__version"]}"',
+        max(versions['updated_at'], versions['customer__updated_at']),
+    )
+    if not_modified is not None:
+        return not_modified
     
+    loan = loans.select_related('customer').get()
     serializer = LoanDetailSerializer(loan)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return _with_validators(
+        Response(serializer.data, status=status.HTTP_200_OK),
+        f'"{loan_id}.{loan.version}.{loan.customer.version}"',
+        max(loan.updated_at, loan.customer.updated_at),
+    )
 
 
 @api_view(['GET'])
+@use_replica
 def view_customer_loans(request, customer_id):
     """View all loans for a specific customer"""
-    try:
-        customer = Customer.objects.get(customer_id=customer_id)
-    except Customer.DoesNotExist:
+    # A customer's version changes with any of its loans, so it is all a
+    # conditional request needs. The loans are read from the same database,
+    # so they are never older than the ETag.
+    db = shard_for_customer(customer_id) or router.db_for_read(Loan)
+    customers = Customer.objects.filter(customer_id=customer_id).values('id', 'version', 'updated_at')
+    customer = customers.using(db).first()
+    if customer is None and db in settings.DATABASE_REPLICAS:
+        # The customer may be newer than the replica, for clients without the pin cookie
+        db = DEFAULT_DB_ALIAS
+        customer = customers.using(db).first()
+    if customer is None:
         return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    loans = customer.loans.all()
+    etag = f'"{customer_id}.{customer["version"]}"'
+    not_modified = _not_modified(request, etag, customer['updated_at'])
+    if not_modified is not None:
+        return not_modified
+    
+    loans = Loan.objects.using(db).filter(customer_id=customer['id'])
     serializer = CustomerLoansSerializer(loans, many=True)
+    return _with_validators(Response(serializer.data, status=status.HTTP_200_OK), etag, customer['updated_at'])
+
+
+@api_view(['POST'])
+@use_replica
+def view_customer_loans_batch(request):
+    """
+    Loan lists of up to LOAN_BATCH_MAX_CUSTOMERS customers, in customer_id
+    order. With ?stream=1 each customer is sent as it is read, one JSON
+    object per line.
+    """
+    serializer = CustomerLoansBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    customers = customer_loan_lists(serializer.validated_data['customer_ids'])
+    if request.query_params.get('stream') in ('1', 'true'):
+        lines = (json.dumps(customer, cls=JSONEncoder) + '\n' for customer in customers)
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    return Response({'customers': list(customers)}, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+def bulk_repayments(request):
+    """
+    Record EMI repayments for many loans. Batches up to REPAYMENT_BATCH_SIZE
+    entries are applied immediately, larger ones by a Celery task. Requests
+    repeating an idempotency_key don't apply the same batch twice.
+    """
+    serializer = BulkRepaymentSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    entries = serializer.validated_data['repayments']
+    idempotency_key = serializer.validated_data['idempotency_key']
+    if len(entries) > settings.REPAYMENT_BATCH_SIZE:
+        try:
+            task = tasks.post_repayments.delay(entries, idempotency_key)
+        except Exception:
+            return Response({'error': 'Could not queue repayments, please retry'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'task_id': task.id, 'entries': len(entries)}, status=status.HTTP_202_ACCEPTED)
+    
+    results = post_repayments(entries, idempotency_key)
+    return Response(BulkRepaymentResponseSerializer(results).data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def ingest_jobs(request):
+    """Most recent ingestion jobs first, ?limit= of them (default 20, at most 100)"""
+    try:
+        limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    jobs = IngestionJob.objects.order_by('-created_at')[:limit]
+    serializer = IngestionJobSerializer(jobs, many=True)
     return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def ingest_job(request, task_id):
+    """Progress of one ingestion job, per stage with throughput and ETA"""
+    try:
+        job = IngestionJob.objects.get(task_id=task_id)
+    except IngestionJob.DoesNotExist:
+        return Response({'error': 'Ingestion job not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    serializer = IngestionJobSerializer(job)
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def metrics(request):
+    """
+    Cache hit rates and sizes seen by the worker process serving the request,
+    and the outbox backlog
+    """
+    return Response({'customer_cache': cache_stats(), 'outbox': outbox.outbox_lag()}, status=status.HTTP_200_OK)